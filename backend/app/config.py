@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import os
 from pathlib import Path
 
 
@@ -9,11 +10,45 @@ TEMPLATES_ROOT = DATA_DIR / "templates"
 IMAGES_DIR = DATA_DIR / "images"
 RUNS_DIR = DATA_DIR / "runs"
 DATASETS_DIR = DATA_DIR / "datasets"
+# Preprocessed template bundles (npz + manifest), rebuilt when templates.py changes.
+TEMPLATE_CACHE_DIR = DATA_DIR / "template_cache"
+# Load every template project on a background thread at startup (projects load on demand otherwise).
+TEMPLATE_WARMUP = True
+# Keep template edge/bin/mask maps bit-packed in memory (unpacked only when a scale is built).
+TEMPLATE_COMPACT = False
+# Threads preprocessing template files while a project loads.
+TEMPLATE_SCAN_WORKERS = min(8, os.cpu_count() or 1)
+# Seconds between polling rescans of TEMPLATES_ROOT for added/changed/removed templates (0 disables).
+TEMPLATE_WATCH_INTERVAL = 0.0
+# Match only one representative per group of near-identical templates of a class.
+TEMPLATE_DEDUP = False
+# Near-duplicate test: perceptual-hash bit distance and binary-map correlation at a 64px reference size.
+TEMPLATE_DEDUP_HASH_DISTANCE = 10
+TEMPLATE_DEDUP_MIN_CORR = 0.9
+# /detect/point re-matches the other members of a group whose representative hit.
+TEMPLATE_DEDUP_EXPAND = True
 
 DEFAULT_SCALE_MIN = 0.5
 DEFAULT_SCALE_MAX = 1.5
 DEFAULT_SCALE_STEPS = 12
 DEFAULT_TOPK = 3
 
+# Byte budget of the scaled-template bank shared by the matchers (LRU beyond this).
+TEMPLATE_BANK_MAX_BYTES = 256 * 1024 * 1024
+
+# Upper bound of threads one match_templates call may use (shared pool).
+MATCH_THREAD_WORKERS = min(16, os.cpu_count() or 1)
+
+# Worker processes for tiled matching (/detect/full, annotate_all_manual); 1 runs in-process.
+TILE_PROCESS_WORKERS = min(16, os.cpu_count() or 1)
+# Worker pools kept alive at once (one per template set, e.g. per project).
+TILE_POOL_MAX = 2
+# Start method of tile worker processes; never fork the threaded server process.
+TILE_POOL_START_METHOD = "forkserver" if os.name == "posix" else "spawn"
+
+# Per-image feature-map cache for repeated /detect/point clicks (LRU beyond the budget).
+FEATURE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+FEATURE_CACHE_TILE = 512
+
 SAM_CHECKPOINT = "/Users/hashimoto/vscode/_project/draft_seeker/models/sam_vit_l_0b3195.pth"
 SAM_MODEL_TYPE = "vit_l"
@@ -7,6 +7,7 @@ candidate bounding boxes using existing template matching, score them,
 filter by threshold, and export annotations.
 """
 
+import math
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, Iterable, List, Tuple
@@ -14,9 +15,45 @@ from typing import Dict, Iterable, List, Tuple
 import cv2
 import numpy as np
 
-from .matching import MatchResult, match_templates
+from .matching import MatchResult
+from .nms import greedy_nms
 from .templates import TemplateImage
+from .tile_scheduler import TileTask, max_template_extent, min_template_extent, run_tiles
 from .annotation_exporter import export_annotations
+from .binary_corr import PackedBits, overlap_counts
+from .feature_cache import ImageFeatures
+
+
+# annotate_all(search_mode="pyramid"): image downscale factors tried (largest first),
+# smallest downscaled template side, largest gap between coarse scales, coarse score
+# slack below the match threshold, requested scales re-scored per coarse hit, the
+# margin (in coarse pixels) of their full-resolution windows and the most coarse hits
+# kept per coarse scale (best first)
+PYRAMID_FACTORS = (4, 2)
+PYRAMID_MIN_TEMPLATE = 8
+PYRAMID_MAX_SCALE_STEP = 0.2
+PYRAMID_SCORE_SLACK = 0.1
+PYRAMID_REFINE_SCALES = 3
+PYRAMID_REFINE_MARGIN = 2
+PYRAMID_MAX_HITS = 2000
+
+# build_exclusion_mask: ruling lines are at least this fraction of the shorter image
+# side (and twice the largest scaled template), characters at most this fraction of
+# the smallest scaled template, a text line holds at least this many characters, kept
+# regions grow by this many pixels over adjacent ruling, and annotate_all searches the
+# unmasked area in blocks of at least this many top-left positions per side
+PRUNE_LINE_FRACTION = 0.1
+PRUNE_TEXT_HEIGHT_RATIO = 0.8
+PRUNE_TEXT_MIN_CHARS = 4
+PRUNE_MARGIN = 4
+PRUNE_BLOCK = 256
+
+# annotate_all: the black-pixel match ratio is counted per above-threshold position
+# while that reads fewer template pixels than this many per position of the correlated
+# bounding box (both cost about the same per element), and correlated over the box
+# otherwise; gathers are done in chunks of at most this many pixels
+MATCH_RATIO_DENSE_COST = 1.0
+MATCH_RATIO_GATHER = 1 << 20
 
 
 @dataclass(frozen=True)
@@ -29,6 +66,176 @@ class Candidate:
     template_name: str
 
 
+@dataclass(frozen=True)
+class PrunedRegion:
+    """Area left out of the search by build_exclusion_mask."""
+
+    kind: str  # 'margin', 'ruled' or 'text'
+    bbox: Tuple[int, int, int, int]
+
+
+class ExclusionMask:
+    """Pixels where no symbol centre can lie (mask nonzero = excluded)."""
+
+    def __init__(self, mask: np.ndarray, regions: List[PrunedRegion]) -> None:
+        self.mask = mask
+        self.regions = regions
+        self._kept = mask == 0
+        self._integral = cv2.integral((mask > 0).astype(np.uint8))
+
+    @property
+    def fraction(self) -> float:
+        """Excluded share of the image area."""
+        return float(self._integral[-1, -1]) / max(1, self.mask.size)
+
+    def _excluded_in(self, x0: int, y0: int, x1: int, y1: int) -> int:
+        ii = self._integral
+        return int(ii[y1, x1] - ii[y0, x1] - ii[y1, x0] + ii[y0, x0])
+
+    def covers(self, box: Tuple[int, int, int, int]) -> bool:
+        """True when every pixel of the [x0, y0, x1, y1) box is excluded."""
+        x0, y0, x1, y1 = box
+        return self._excluded_in(x0, y0, x1, y1) >= (x1 - x0) * (y1 - y0)
+
+    def keeps(self, bbox: Tuple[int, int, int, int]) -> bool:
+        """True when the centre of the (x, y, w, h) box is not excluded."""
+        height, width = self.mask.shape[:2]
+        cx = min(max(int(bbox[0] + bbox[2] / 2.0), 0), width - 1)
+        cy = min(max(int(bbox[1] + bbox[3] / 2.0), 0), height - 1)
+        return bool(self._kept[cy, cx])
+
+    def allowed(self, rw: int, rh: int) -> np.ndarray:
+        """Top-left positions of a rw x rh window whose centre is not excluded (a view)."""
+        height, width = self.mask.shape[:2]
+        return self._kept[rh // 2 : rh // 2 + height - rh + 1, rw // 2 : rw // 2 + width - rw + 1]
+
+    def search_windows(self, rw: int, rh: int, block: int) -> List[Tuple[int, int, int, int]]:
+        """[x0, y0, x1, y1) top-left windows holding every allowed position of a rw x rh window.
+
+        Positions are cut into block x block cells; cells without an allowed
+        position are dropped and the rest merged into runs along each row.
+        """
+        height, width = self.mask.shape[:2]
+        nx, ny = width - rw + 1, height - rh + 1
+        ox, oy = rw // 2, rh // 2
+        windows: List[List[int]] = []
+        for y0 in range(0, max(0, ny), block):
+            y1 = min(ny, y0 + block)
+            run: List[int] | None = None
+            for x0 in range(0, max(0, nx), block):
+                x1 = min(nx, x0 + block)
+                if self.covers((x0 + ox, y0 + oy, x1 + ox, y1 + oy)):
+                    run = None
+                    continue
+                if run is not None:
+                    run[2] = x1
+                else:
+                    run = [x0, y0, x1, y1]
+                    windows.append(run)
+        return [(w[0], w[1], w[2], w[3]) for w in windows]
+
+
+def build_exclusion_mask(image_bin: np.ndarray, min_symbol: int, max_symbol: int) -> ExclusionMask:
+    """Mask frame margins, ruled text-only areas and text lines of a drawing.
+
+    image_bin is nonzero on ink; min_symbol / max_symbol are the shortest and
+    longest template sides over the searched scales.
+
+    Horizontal and vertical runs longer than any template are ruling lines
+    (frame, title block, tables). They cut the page into regions, and a
+    region whose only ink is character-sized components (margin outside the
+    frame, title block and table cells) cannot hold a symbol. Elsewhere, rows
+    of at least PRUNE_TEXT_MIN_CHARS characters that no larger component
+    encloses are masked by their bounding box.
+    """
+    height, width = image_bin.shape[:2]
+    ink = (image_bin > 0).astype(np.uint8)
+    line_len = max(3, 2 * int(max_symbol), int(PRUNE_LINE_FRACTION * min(height, width)))
+    ruling = cv2.morphologyEx(
+        ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (line_len, 1))
+    ) | cv2.morphologyEx(
+        ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, line_len))
+    )
+    drawing = ink & (1 - ruling)
+    n_parts, parts, part_stats, _ = cv2.connectedComponentsWithStats(drawing, connectivity=8)
+    char_max = max(2, int(min_symbol * PRUNE_TEXT_HEIGHT_RATIO))
+    is_char = (part_stats[:, cv2.CC_STAT_HEIGHT] <= char_max) & (
+        part_stats[:, cv2.CC_STAT_WIDTH] <= 2 * char_max
+    )
+    is_char[0] = False
+    chars = is_char[parts]
+    symbol_ink = (drawing > 0) & ~chars
+
+    regions: List[PrunedRegion] = []
+    n_cells, cells, cell_stats, _ = cv2.connectedComponentsWithStats(1 - ruling, connectivity=4)
+    has_symbol = np.bincount(cells[symbol_ink], minlength=n_cells) > 0
+    has_symbol[0] = True  # label 0 is the ruling itself
+    kept = has_symbol[cells] & (cells > 0)
+    # ruling next to a kept region stays searchable (symbols sit on lines)
+    grow = 2 * PRUNE_MARGIN + 1
+    kept = cv2.dilate(kept.astype(np.uint8), np.ones((grow, grow), np.uint8)) > 0
+    excluded = ~kept
+    margin = False
+    for label in np.flatnonzero(~has_symbol).tolist():
+        x, y, w, h, area = (int(v) for v in cell_stats[label])
+        if x == 0 or y == 0 or x + w == width or y + h == height:
+            margin = True  # reported below as strips, its bbox is the whole page
+        elif area >= min_symbol * min_symbol:
+            regions.append(PrunedRegion("ruled", (x, y, w, h)))
+    if margin:
+        rows = np.flatnonzero(kept.any(axis=1))
+        cols = np.flatnonzero(kept.any(axis=0))
+        if rows.size == 0:
+            regions.insert(0, PrunedRegion("margin", (0, 0, width, height)))
+        else:
+            ky0, ky1 = int(rows[0]), int(rows[-1]) + 1
+            kx0, kx1 = int(cols[0]), int(cols[-1]) + 1
+            strips = [
+                (0, 0, width, ky0),
+                (0, ky1, width, height - ky1),
+                (0, ky0, kx0, ky1 - ky0),
+                (kx1, ky0, width - kx1, ky1 - ky0),
+            ]
+            regions[:0] = [PrunedRegion("margin", b) for b in strips if b[2] > 0 and b[3] > 0]
+
+    # text lines: characters joined across letter and word gaps
+    joined = cv2.dilate(chars.astype(np.uint8), np.ones((1, char_max), np.uint8))
+    n_lines, lines, line_stats, _ = cv2.connectedComponentsWithStats(joined, connectivity=8)
+    pairs = np.unique(lines[chars].astype(np.int64) * n_parts + parts[chars])
+    char_counts = np.bincount(pairs // n_parts, minlength=n_lines)
+    symbols = part_stats[1:][~is_char[1:]]
+    for label in range(1, n_lines):
+        x, y, w, h, _area = (int(v) for v in line_stats[label])
+        if char_counts[label] < PRUNE_TEXT_MIN_CHARS or h > 2 * char_max or w < 2 * h:
+            continue
+        if h < max(4, char_max // 3):
+            continue  # dashed lines, not text
+        if np.any(
+            (symbols[:, 0] <= x)
+            & (symbols[:, 1] <= y)
+            & (symbols[:, 0] + symbols[:, 2] >= x + w)
+            & (symbols[:, 1] + symbols[:, 3] >= y + h)
+        ):
+            continue  # label inside a symbol
+        if excluded[y : y + h, x : x + w].all():
+            continue
+        excluded[y : y + h, x : x + w] = True
+        regions.append(PrunedRegion("text", (x, y, w, h)))
+    return ExclusionMask(excluded.astype(np.uint8) * 255, regions)
+
+
+def _pruning_summary(exclusion: ExclusionMask | None, tiles_pruned: int | None = None) -> dict:
+    if exclusion is None:
+        return {}
+    summary = {
+        "pruned_fraction": exclusion.fraction,
+        "pruned_regions": [{"kind": r.kind, "bbox": r.bbox} for r in exclusion.regions],
+    }
+    if tiles_pruned is not None:
+        summary["tiles_pruned"] = tiles_pruned
+    return summary
+
+
 def _group_templates(templates: Iterable[TemplateImage]) -> Dict[str, List[TemplateImage]]:
     grouped: Dict[str, List[TemplateImage]] = {}
     for tpl in templates:
@@ -48,48 +255,91 @@ def _iter_tiles(width: int, height: int, tile_size: int, stride: int) -> Iterabl
         y += stride
 
 
-def _match_tile(
-    tile: np.ndarray,
-    x0: int,
-    y0: int,
-    templates: Dict[str, List[TemplateImage]],
-    scale_min: float,
-    scale_max: float,
-    scale_steps: int,
-    max_per_tile: int,
-    roi_size: int,
-) -> List[Candidate]:
-    h, w = tile.shape[:2]
-    cx = w // 2
-    cy = h // 2
-    roi_size = max(1, int(roi_size))
-    matches: List[MatchResult] = match_templates(
-        image_bgr=tile,
-        x=cx,
-        y=cy,
-        roi_size=roi_size,
-        templates=templates,
-        scale_min=scale_min,
-        scale_max=scale_max,
-        scale_steps=scale_steps,
-        trim_template_margin=True,
-        line_art_enhanced=True,
-    )
+def _local_peaks(score_map: np.ndarray, valid: np.ndarray, win_w: int, win_h: int) -> np.ndarray:
+    """Valid positions that are the maximum of their win_w x win_h neighbourhood."""
+    peaks = np.zeros_like(valid)
+    ys, xs = np.nonzero(valid)
+    if ys.size == 0:
+        return peaks
+    # invalid positions never win, so only the bounding box of valid ones matters
+    y0, y1 = int(ys.min()), int(ys.max()) + 1
+    x0, x1 = int(xs.min()), int(xs.max()) + 1
+    sub_valid = valid[y0:y1, x0:x1]
+    # float32 keeps the dilation fast; float32 ties are both kept and left to NMS
+    masked = np.where(sub_valid, score_map[y0:y1, x0:x1], -np.inf).astype(np.float32)
+    dilated = cv2.dilate(masked, np.ones((max(1, win_h), max(1, win_w)), dtype=np.uint8))
+    peaks[y0:y1, x0:x1] = sub_valid & (masked >= dilated)
+    return peaks
+
+
+def _duplicate_shift_window(width: int, height: int, iou_threshold: float) -> Tuple[int, int]:
+    """Odd window of the shifts that keep a width x height box above iou_threshold.
+
+    Two equal boxes have IoU = a / (2 - a) for overlap fraction a, so any shift
+    inside the window is a copy NMS would drop anyway; neighbours further away
+    are distinct instances and must survive peak suppression.
+    """
+    axis = 1.0 - math.sqrt(2.0 * iou_threshold / (1.0 + iou_threshold))
+    return 2 * int(width * axis) + 1, 2 * int(height * axis) + 1
+
+
+def _tile_candidates(matches: List[MatchResult], max_per_tile: int) -> List[Candidate]:
     if max_per_tile > 0:
         matches = matches[:max_per_tile]
-
-    candidates: List[Candidate] = []
-    for m in matches:
-        bx, by, bw, bh = m.bbox
-        candidates.append(
-            Candidate(
-                class_name=m.class_name,
-                bbox=(bx + x0, by + y0, bw, bh),
-                edge_score=float(0.6 * m.score + 0.4 * m.shape_ratio),
-                template_name=m.template_name,
-            )
+    return [
+        Candidate(
+            class_name=m.class_name,
+            bbox=m.bbox,
+            edge_score=float(0.6 * m.score + 0.4 * m.shape_ratio),
+            template_name=m.template_name,
         )
-    return candidates
+        for m in matches
+    ]
+
+
+def _merge_windows(
+    windows: np.ndarray, shape: Tuple[int, int], cell: int
+) -> List[Tuple[int, int, int, int]]:
+    """Disjoint [x0, y0, x1, y1) rectangles covering the windows, on a grid of cell-sized blocks.
+
+    The windows are painted on the block grid and merged with connected
+    components, again on the component bounding boxes until those are
+    rectangles (then they no longer overlap).
+    """
+    height, width = shape
+    grid_h, grid_w = -(-height // cell), -(-width // cell)
+    x0, y0 = windows[:, 0] // cell, windows[:, 1] // cell
+    x1, y1 = (windows[:, 2] - 1) // cell + 1, (windows[:, 3] - 1) // cell + 1
+    while True:
+        # +1/-1 at the corners, the integral image fills the rectangles
+        diff = np.zeros((grid_h + 1, grid_w + 1), dtype=np.float32)
+        np.add.at(diff, (y0, x0), 1)
+        np.add.at(diff, (y0, x1), -1)
+        np.add.at(diff, (y1, x0), -1)
+        np.add.at(diff, (y1, x1), 1)
+        grid = (cv2.integral(diff)[1 : grid_h + 1, 1 : grid_w + 1] > 0).astype(np.uint8)
+        _count, _labels, stats, _centroids = cv2.connectedComponentsWithStats(grid, connectivity=4)
+        stats = stats[1:].astype(np.int64)
+        x0, y0 = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+        x1 = x0 + stats[:, cv2.CC_STAT_WIDTH]
+        y1 = y0 + stats[:, cv2.CC_STAT_HEIGHT]
+        if np.array_equal(stats[:, cv2.CC_STAT_AREA], (x1 - x0) * (y1 - y0)):
+            break
+    return [
+        (int(a) * cell, int(b) * cell, min(width, int(c) * cell), min(height, int(d) * cell))
+        for a, b, c, d in zip(x0, y0, x1, y1)
+    ]
+
+
+def _interpolate_scale(
+    scales: List[float], s0: np.ndarray, s1: np.ndarray, s2: np.ndarray, k: int
+) -> np.ndarray:
+    """Vertices of the parabolas through the scores s0, s1, s2 at coarse scales k - 1, k, k + 1."""
+    denom = s0 - 2.0 * s1 + s2
+    curved = np.isfinite(denom) & (denom < 0)
+    offset = np.clip(0.5 * (s0 - s2) / np.where(curved, denom, -1.0), -1.0, 1.0)
+    step = np.where(offset > 0, scales[k + 1] - scales[k], scales[k] - scales[k - 1])
+    return np.where(curved, scales[k] + offset * step, scales[k])
 
 
 def annotate_all(
@@ -102,6 +352,10 @@ def annotate_all(
     scale_max: float = 1.5,
     scale_steps: int = 12,
     stride: int | None = None,
+    suppress_peaks: bool = False,
+    search_mode: str = "exhaustive",
+    correlation_backend: str = "spatial",
+    prune_mask: bool = False,
 ) -> dict:
     """Run full-image template matching and export annotations.
 
@@ -110,6 +364,20 @@ def annotate_all(
         templates: List[TemplateImage] or Dict[str, List[TemplateImage]].
         threshold: Final score threshold.
         output_format: 'yolo' or 'coco'.
+        suppress_peaks: Keep only local maxima of the combined score per
+            template/scale before NMS, within the shifts whose boxes NMS would
+            treat as duplicates (IoU above the NMS threshold).
+        search_mode: 'exhaustive' correlates every template scale with the full
+            image; 'pyramid' correlates a few scales with a downscaled image and
+            re-scores only the windows around coarse hits at the nearest
+            requested scales.
+        correlation_backend: 'spatial' counts matched black pixels with a float
+            correlation over the hit region; 'bitpack' keeps the binarized page
+            bit-packed and counts them with AND + popcount at the hit positions
+            only. Both give the same candidates and scores.
+        prune_mask: Skip frame margins, title blocks, tables and text lines
+            (build_exclusion_mask): matching only covers blocks with searchable
+            positions and candidates centred under the mask are dropped.
 
     Returns:
         dict containing annotations and export payload.
@@ -121,6 +389,11 @@ def annotate_all(
     img = cv2.imread(str(image_path))
     if img is None:
         raise ValueError(f"failed to read image: {image_path}")
+    if search_mode not in ("exhaustive", "pyramid"):
+        raise ValueError(f"unknown search_mode: {search_mode}")
+    if correlation_backend not in ("spatial", "bitpack"):
+        raise ValueError(f"unknown correlation_backend: {correlation_backend}")
+    bitpack = correlation_backend == "bitpack"
 
     if isinstance(templates, dict):
         templates_by_class = templates
@@ -133,6 +406,19 @@ def annotate_all(
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     image_bin = np.zeros_like(gray, dtype=np.uint8)
     image_bin[gray < 128] = 255
+    if bitpack:
+        # 1 bit per pixel instead of the 4-byte float copy below
+        image_bits = PackedBits(image_bin)
+    else:
+        # 0/1 copy: unnormalised correlation with a 0/1 template counts matched black pixels
+        image_ones = (image_bin > 0).astype(np.float32)
+    exclusion = None
+    if prune_mask:
+        exclusion = build_exclusion_mask(
+            image_bin,
+            min_template_extent(templates_by_class, scale_min),
+            max_template_extent(templates_by_class, scale_max),
+        )
 
     def _iter_scales() -> List[float]:
         if scale_steps <= 1:
@@ -142,49 +428,271 @@ def annotate_all(
             for i in range(scale_steps)
         ]
 
-    def _compute_match_ratio(black_coords: np.ndarray, patch: np.ndarray) -> float:
-        if patch.size == 0 or black_coords.size == 0:
-            return 0.0
-        ys = black_coords[:, 0]
-        xs = black_coords[:, 1]
-        if ys.size == 0:
-            return 0.0
-        matched = np.count_nonzero(patch[ys, xs])
-        return float(matched / len(black_coords))
-
     def _nms(cands: List[Dict], iou_threshold: float) -> List[Dict]:
         if not cands:
             return []
-        sorted_cands = sorted(cands, key=lambda c: c["final_score"], reverse=True)
-        kept: List[Dict] = []
-        for cand in sorted_cands:
-            x1, y1, w1, h1 = cand["bbox"]
-            x2 = x1 + w1
-            y2 = y1 + h1
-            overlap = False
-            for kept_c in kept:
-                kx1, ky1, kw, kh = kept_c["bbox"]
-                kx2 = kx1 + kw
-                ky2 = ky1 + kh
-                inter_w = max(0, min(x2, kx2) - max(x1, kx1))
-                inter_h = max(0, min(y2, ky2) - max(y1, ky1))
-                inter = inter_w * inter_h
-                if inter <= 0:
-                    continue
-                union = w1 * h1 + kw * kh - inter
-                iou = inter / union if union > 0 else 0.0
-                if iou >= iou_threshold:
-                    overlap = True
-                    break
-            if not overlap:
-                kept.append(cand)
-        return kept
+        order = sorted(range(len(cands)), key=lambda i: cands[i]["final_score"], reverse=True)
+        boxes = np.asarray([c["bbox"] for c in cands], dtype=np.int64)
+        return [cands[i] for i in greedy_nms(boxes, order, iou_threshold, inclusive=True)]
 
     match_threshold = float(threshold)
     black_match_threshold = 0.69
     nms_threshold = 0.8
 
     candidates: List[Dict] = []
+    raw_count = 0
+
+    def _resize_bin(template_bin: np.ndarray, scale: float) -> np.ndarray:
+        th, tw = template_bin.shape[:2]
+        return cv2.resize(
+            template_bin,
+            (max(1, int(tw * scale)), max(1, int(th * scale))),
+            interpolation=cv2.INTER_NEAREST,
+        )
+
+    def _hit_overlaps(resized: np.ndarray, ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+        """Template black pixels also black in image_bin, per top-left (ys[i], xs[i])."""
+        ty, tx = np.nonzero(resized)
+        counts = np.empty(ys.size, dtype=np.int64)
+        step = max(1, MATCH_RATIO_GATHER // ty.size)
+        for i in range(0, ys.size, step):
+            patch = image_bin[ys[i : i + step, None] + ty, xs[i : i + step, None] + tx]
+            counts[i : i + step] = np.count_nonzero(patch, axis=1)
+        return counts
+
+    def _scan(
+        class_name: str,
+        template_name: str,
+        resized: np.ndarray,
+        window: Tuple[int, int, int, int] | None = None,
+    ) -> None:
+        """Score the top-left positions [x0, x1) x [y0, y1) (all of them by default)."""
+        nonlocal raw_count
+        rh, rw = resized.shape[:2]
+        template_bits = PackedBits(resized) if bitpack else None
+        black_count = int(np.count_nonzero(resized))
+        if black_count == 0:
+            return
+        if window is None:
+            wx0, wy0 = 0, 0
+            result = cv2.matchTemplate(image_bin, resized, cv2.TM_CCORR_NORMED)
+        else:
+            wx0, wy0, wx1, wy1 = window
+            result = cv2.matchTemplate(
+                image_bin[wy0 : wy1 + rh - 1, wx0 : wx1 + rw - 1], resized, cv2.TM_CCORR_NORMED
+            )
+        above = result >= match_threshold
+        if exclusion is not None:
+            above &= exclusion.allowed(rw, rh)[
+                wy0 : wy0 + result.shape[0], wx0 : wx0 + result.shape[1]
+            ]
+        ys, xs = np.nonzero(above)
+        if ys.size == 0:
+            return
+        # fraction of the template's black pixels that are black in the image,
+        # for every position inside the bounding box of the above-threshold ones
+        by0, by1 = int(ys.min()), int(ys.max()) + 1
+        bx0, bx1 = int(xs.min()), int(xs.max()) + 1
+        box_area = (by1 - by0 + rh - 1) * (bx1 - bx0 + rw - 1)
+        dense = ys.size * black_count >= MATCH_RATIO_DENSE_COST * box_area
+        if bitpack or not dense:
+            # only the above-threshold positions can be kept, so only they are counted
+            if bitpack:
+                hit_overlaps = overlap_counts(image_bits, template_bits, xs + wx0, ys + wy0)
+            else:
+                hit_overlaps = _hit_overlaps(resized, ys + wy0, xs + wx0)
+            match_ratio_map = np.zeros((by1 - by0, bx1 - bx0), dtype=np.float64)
+            match_ratio_map[ys - by0, xs - bx0] = hit_overlaps / black_count
+        else:
+            resized_ones = (resized > 0).astype(np.float32)
+            matched = cv2.matchTemplate(
+                image_ones[wy0 + by0 : wy0 + by1 + rh - 1, wx0 + bx0 : wx0 + bx1 + rw - 1],
+                resized_ones,
+                cv2.TM_CCORR,
+            )
+            match_ratio_map = np.rint(matched).astype(np.float64) / black_count
+        keep = above[by0:by1, bx0:bx1] & (match_ratio_map >= black_match_threshold)
+        combined_map = (
+            result[by0:by1, bx0:bx1].astype(np.float64) + match_ratio_map
+        ) / 2.0
+        raw_count += int(np.count_nonzero(keep))
+        if suppress_peaks:
+            # one candidate per response peak instead of its whole plateau
+            keep = _local_peaks(combined_map, keep, *_duplicate_shift_window(rw, rh, nms_threshold))
+        ys, xs = np.nonzero(keep)
+        for x, y in zip((xs + bx0).tolist(), (ys + by0).tolist()):
+            match_score = float(result[y, x])
+            combined_score = float(combined_map[y - by0, x - bx0])
+            candidates.append(
+                {
+                    "class_name": class_name,
+                    "bbox": (int(x + wx0), int(y + wy0), int(rw), int(rh)),
+                    "edge_score": match_score,
+                    "contour_score": 0.0,
+                    "layout_score": 0.0,
+                    "shape_score": 0.0,
+                    "final_score": combined_score,
+                    "template_name": template_name,
+                }
+            )
+
+    def _scan_exhaustive(class_name: str, template_name: str, template_bin: np.ndarray) -> None:
+        for scale in _iter_scales():
+            if scale <= 0:
+                continue
+            resized = _resize_bin(template_bin, scale)
+            rh, rw = resized.shape[:2]
+            if rh <= 1 or rw <= 1:
+                continue
+            if rh > height or rw > width:
+                continue
+            if exclusion is None:
+                _scan(class_name, template_name, resized)
+                continue
+            block = max(PRUNE_BLOCK, 4 * max(rw, rh))  # bounds the overlap between windows
+            for window in exclusion.search_windows(rw, rh, block):
+                _scan(class_name, template_name, resized, window)
+
+    levels: Dict[int, np.ndarray] = {}
+
+    def _level(factor: int) -> np.ndarray:
+        if factor not in levels:
+            levels[factor] = cv2.resize(
+                image_bin,
+                (max(1, width // factor), max(1, height // factor)),
+                interpolation=cv2.INTER_AREA,
+            )
+        return levels[factor]
+
+    def _scan_pyramid(class_name: str, template_name: str, template_bin: np.ndarray) -> None:
+        scales = [s for s in _iter_scales() if s > 0]
+        if not scales:
+            return
+        th, tw = template_bin.shape[:2]
+        factor = next(
+            (f for f in PYRAMID_FACTORS if min(th, tw) * scales[0] / f >= PYRAMID_MIN_TEMPLATE),
+            1,
+        )
+        if factor == 1:
+            # too small to downsample
+            _scan_exhaustive(class_name, template_name, template_bin)
+            return
+        level = _level(factor)
+        lh, lw = level.shape[:2]
+        # line art decorrelates quickly with scale: keep coarse scales close together
+        step = (scales[-1] - scales[0]) / (len(scales) - 1) if len(scales) > 1 else 1.0
+        stride = max(1, int(PYRAMID_MAX_SCALE_STEP / step + 1e-9)) if step > 0 else 1
+        coarse_scales = scales[::stride]
+        if coarse_scales[-1] != scales[-1]:
+            coarse_scales.append(scales[-1])
+        coarse_maps: List[np.ndarray | None] = []
+        coarse_sizes: List[Tuple[int, int]] = []
+        for scale in coarse_scales:
+            # same area averaging as the image level, so thin lines keep their weight
+            scaled = _resize_bin(template_bin, scale)
+            coarse = cv2.resize(
+                scaled,
+                (max(1, scaled.shape[1] // factor), max(1, scaled.shape[0] // factor)),
+                interpolation=cv2.INTER_AREA,
+            )
+            ch, cw = coarse.shape[:2]
+            coarse_sizes.append((cw, ch))
+            if ch > lh or cw > lw or not np.any(coarse):
+                coarse_maps.append(None)
+                continue
+            coarse_maps.append(cv2.matchTemplate(level, coarse, cv2.TM_CCORR_NORMED))
+
+        # best coarse score within one coarse pixel of any position (-1 off the map)
+        around_maps: List[np.ndarray | None] = [
+            None
+            if cmap is None
+            else cv2.dilate(
+                cv2.copyMakeBorder(cmap, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=-1.0),
+                np.ones((3, 3), dtype=np.uint8),
+            )
+            for cmap in coarse_maps
+        ]
+
+        def _around(j: int, center_x: np.ndarray, center_y: np.ndarray) -> np.ndarray:
+            scores = np.full(center_x.shape, -1.0)
+            padded = around_maps[j]
+            if padded is None:
+                return scores
+            ox = np.rint(center_x - coarse_sizes[j][0] / 2.0).astype(np.int64) + 1
+            oy = np.rint(center_y - coarse_sizes[j][1] / 2.0).astype(np.int64) + 1
+            inside = (ox >= 0) & (ox < padded.shape[1]) & (oy >= 0) & (oy < padded.shape[0])
+            scores[inside] = padded[oy[inside], ox[inside]]
+            return scores
+
+        # coarse peaks: centres in full-resolution pixels and their nearest requested scales
+        peak_window = 2 * PYRAMID_REFINE_MARGIN + 1
+        centers_x: List[np.ndarray] = []
+        centers_y: List[np.ndarray] = []
+        nearest: List[np.ndarray] = []
+        for k, cmap in enumerate(coarse_maps):
+            if cmap is None:
+                continue
+            hit = cmap >= match_threshold - PYRAMID_SCORE_SLACK
+            if not hit.any():
+                continue
+            # positions one refinement window apart are re-scored separately, so
+            # adjacent instances keep their own peak
+            cys, cxs = np.nonzero(_local_peaks(cmap, hit, peak_window, peak_window))
+            if cys.size > PYRAMID_MAX_HITS:
+                top = np.argsort(-cmap[cys, cxs], kind="stable")[:PYRAMID_MAX_HITS]
+                cys, cxs = cys[top], cxs[top]
+            cw, ch = coarse_sizes[k]
+            center_x = cxs + cw / 2.0
+            center_y = cys + ch / 2.0
+            if 0 < k < len(coarse_scales) - 1:
+                # score around the same centre at the neighbouring coarse scales
+                best = _interpolate_scale(
+                    coarse_scales,
+                    _around(k - 1, center_x, center_y),
+                    _around(k, center_x, center_y),
+                    _around(k + 1, center_x, center_y),
+                    k,
+                )
+            else:
+                best = np.full(center_x.shape, coarse_scales[k])
+            distance = np.abs(np.asarray(scales)[None, :] - best[:, None])
+            nearest.append(np.argsort(distance, axis=1, kind="stable")[:, :PYRAMID_REFINE_SCALES])
+            centers_x.append(center_x * factor)
+            centers_y.append(center_y * factor)
+        if not nearest:
+            return
+        all_x = np.concatenate(centers_x)
+        all_y = np.concatenate(centers_y)
+        all_nearest = np.concatenate(nearest)
+
+        # windows of full-resolution top-left positions to re-score, per requested scale
+        margin = factor * PYRAMID_REFINE_MARGIN
+        for i, scale in enumerate(scales):
+            selected = (all_nearest == i).any(axis=1)
+            if not selected.any():
+                continue
+            resized = _resize_bin(template_bin, scale)
+            rh, rw = resized.shape[:2]
+            if rh <= 1 or rw <= 1 or rh > height or rw > width:
+                continue
+            x = np.rint(all_x[selected] - rw / 2.0).astype(np.int64)
+            y = np.rint(all_y[selected] - rh / 2.0).astype(np.int64)
+            positions = (height - rh + 1, width - rw + 1)
+            windows = np.column_stack(
+                (
+                    np.maximum(0, x - margin),
+                    np.maximum(0, y - margin),
+                    np.minimum(positions[1], x + margin + 1),
+                    np.minimum(positions[0], y + margin + 1),
+                )
+            )
+            windows = windows[(windows[:, 2] > windows[:, 0]) & (windows[:, 3] > windows[:, 1])]
+            if windows.size == 0:
+                continue
+            for window in _merge_windows(windows, positions, margin):
+                _scan(class_name, template_name, resized, window)
+
+    scan = _scan_pyramid if search_mode == "pyramid" else _scan_exhaustive
     for class_name, tpls in templates_by_class.items():
         for tpl in tpls:
             tpl_gray = tpl.image_gray
@@ -192,46 +700,7 @@ def annotate_all(
                 continue
             template_bin_base = np.zeros_like(tpl_gray, dtype=np.uint8)
             template_bin_base[tpl_gray < 128] = 255
-            for scale in _iter_scales():
-                if scale <= 0:
-                    continue
-                th, tw = template_bin_base.shape[:2]
-                resized = cv2.resize(
-                    template_bin_base,
-                    (max(1, int(tw * scale)), max(1, int(th * scale))),
-                    interpolation=cv2.INTER_NEAREST,
-                )
-                rh, rw = resized.shape[:2]
-                if rh <= 1 or rw <= 1:
-                    continue
-                if rh > height or rw > width:
-                    continue
-                black_coords = np.column_stack(np.where(resized > 0))
-                if black_coords.size == 0:
-                    continue
-                result = cv2.matchTemplate(image_bin, resized, cv2.TM_CCORR_NORMED)
-                ys, xs = np.where(result >= match_threshold)
-                for (x, y) in zip(xs, ys):
-                    patch = image_bin[y : y + rh, x : x + rw]
-                    if patch.shape[0] != rh or patch.shape[1] != rw:
-                        continue
-                    match_score = float(result[y, x])
-                    match_ratio = _compute_match_ratio(black_coords, patch)
-                    if match_ratio < black_match_threshold:
-                        continue
-                    combined_score = (match_score + match_ratio) / 2.0
-                    candidates.append(
-                        {
-                            "class_name": class_name,
-                            "bbox": (int(x), int(y), int(rw), int(rh)),
-                            "edge_score": match_score,
-                            "contour_score": 0.0,
-                            "layout_score": 0.0,
-                            "shape_score": 0.0,
-                            "final_score": combined_score,
-                            "template_name": tpl.template_name,
-                        }
-                    )
+            scan(class_name, tpl.template_name, template_bin_base)
 
     confirmed = _nms(candidates, nms_threshold)
 
@@ -246,8 +715,11 @@ def annotate_all(
         "image": str(image_path),
         "threshold": threshold,
         "total_candidates": len(candidates),
+        "candidates_before_suppression": raw_count,
+        "candidates_after_suppression": len(candidates),
         "confirmed": confirmed,
         "export": export_payload,
+        **_pruning_summary(exclusion),
     }
 
 
@@ -261,11 +733,24 @@ def annotate_all_manual(
     scale_max: float = 1.5,
     scale_steps: int = 12,
     stride: int | None = None,
+    workers: int = 1,
+    peaks_per_map: int = 1,
+    precompute_features: bool = False,
+    prune_mask: bool = False,
 ) -> dict:
     """Run full-image template matching using raw match scores only.
 
     This mode mirrors the manual matching pipeline (matching.py) and uses
-    edge_score as final_score without additional scoring.
+    edge_score as final_score without additional scoring. Tiles are matched
+    by `workers` processes (see tile_scheduler); results keep tile order.
+    With peaks_per_map > 1 every response map yields several instances, so
+    tiles only overlap by the largest scaled template instead of 75%.
+    With precompute_features the binary/edge/gradient maps are computed once
+    for the whole image (one Otsu threshold, see feature_cache.ImageFeatures)
+    and tiles are matched on views of them, so overlapping tiles do not redo
+    the preprocessing and results no longer depend on the tile position.
+    With prune_mask, tiles entirely under build_exclusion_mask are not
+    matched and candidates centred under the mask are dropped.
     """
     img = cv2.imread(str(image_path))
     if img is None:
@@ -279,29 +764,60 @@ def annotate_all_manual(
     height, width = img.shape[:2]
 
     tile_size = max(64, int(roi_size))
-    stride = max(1, int(stride if stride is not None else tile_size * 0.25))
+    if stride is None:
+        stride = int(tile_size * 0.25)
+        if peaks_per_map > 1:
+            halo = max_template_extent(templates_by_class, scale_max)
+            if halo < tile_size:
+                stride = tile_size - halo
+    stride = max(1, int(stride))
     # Keep more candidates per tile to reduce early misses before global dedup.
     max_per_tile = 120
 
-    candidates: List[Candidate] = []
+    exclusion = None
+    if prune_mask:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        exclusion = build_exclusion_mask(
+            (gray < 128).astype(np.uint8) * 255,
+            min_template_extent(templates_by_class, scale_min),
+            max_template_extent(templates_by_class, scale_max),
+        )
+
+    features = ImageFeatures(img) if precompute_features else None
+    tasks: List[TileTask] = []
+    tiles_pruned = 0
     for x0, y0, x1, y1 in _iter_tiles(width, height, tile_size, stride):
         tile = img[y0:y1, x0:x1]
         if tile.size == 0:
             continue
-        candidates.extend(
-            _match_tile(
-                tile,
-                x0,
-                y0,
-                templates_by_class,
-                scale_min,
-                scale_max,
-                scale_steps,
-                max_per_tile,
-                roi_size,
+        if exclusion is not None and exclusion.covers((x0, y0, x1, y1)):
+            # every match lies inside its tile, so all of them would be dropped
+            tiles_pruned += 1
+            continue
+        tasks.append(
+            TileTask(
+                x0=x0,
+                y0=y0,
+                tile=tile if features is None else None,
+                features=features.window(x0, y0, x1, y1) if features is not None else None,
+                roi_size=max(1, int(roi_size)),
+                match_kwargs={
+                    "scale_min": scale_min,
+                    "scale_max": scale_max,
+                    "scale_steps": scale_steps,
+                    "trim_template_margin": True,
+                    "line_art_enhanced": True,
+                    "peaks_per_map": peaks_per_map,
+                },
             )
         )
 
+    candidates: List[Candidate] = []
+    for tile_matches in run_tiles(tasks, templates_by_class, workers=workers):
+        if exclusion is not None:
+            tile_matches = [m for m in tile_matches if exclusion.keeps(m.bbox)]
+        candidates.extend(_tile_candidates(tile_matches, max_per_tile))
+
     scored = [
         {
             "class_name": c.class_name,
@@ -330,4 +846,5 @@ def annotate_all_manual(
         "total_candidates": len(scored),
         "confirmed": confirmed,
         "export": export_payload,
+        **_pruning_summary(exclusion, tiles_pruned),
     }
@@ -0,0 +1,256 @@
+"""Per-image cache of the decoded image used by `/detect/point`.
+
+Annotators click many times on the same image. The decoded image and its
+grayscale version are kept per `image_id`, so a click neither re-reads
+the file nor converts the whole image again. ROI maps are binarized with
+the ROI's own Otsu threshold, exactly as without the cache.
+
+`annotate_all_manual(precompute_features=True)` instead asks for windows
+of image-wide maps (one Otsu threshold for the whole image). Those are
+computed and stored tile by tile on first use, so an entry only holds
+(and is charged for) the tiles that were requested.
+
+Entries are evicted in LRU order beyond a byte budget and rebuilt when
+the image fingerprint (file mtime/size, or the in-memory upload) changes.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from functools import partial
+from threading import Lock
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .config import FEATURE_CACHE_MAX_BYTES, FEATURE_CACHE_TILE
+from .matching import RoiFeatures, binary_gradients, preprocess_roi
+
+
+# neighbourhood needed by the 3x3 blurs, Canny and Sobel around a tile
+FEATURE_TILE_HALO = 16
+
+
+class ImageFeatures:
+    """Decoded image and grayscale, with ROI maps and image-wide window maps.
+
+    roi() preprocesses the grayscale slice like a plain ROI (ROI-local Otsu).
+    window() slices image-wide maps binarized with Otsu's threshold of the
+    whole (blurred) image, so they are consistent across windows; they are
+    computed on demand per tile and on_grow(nbytes) is called after new
+    tiles were stored.
+    """
+
+    def __init__(
+        self,
+        image_bgr: np.ndarray,
+        tile_size: int = FEATURE_CACHE_TILE,
+        on_grow: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        self.image_bgr = image_bgr
+        self.gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
+        self.shape: Tuple[int, int] = (int(self.gray.shape[0]), int(self.gray.shape[1]))
+        self.tile_size = max(32, int(tile_size))
+        self.on_grow = on_grow
+        self._threshold: Optional[float] = None
+        self._tiles: Dict[Tuple[int, int], RoiFeatures] = {}
+        self._tile_bytes = 0
+        self._lock = Lock()
+
+    @property
+    def nbytes(self) -> int:
+        """Image, grayscale and the tiles computed so far."""
+        return int(self.image_bgr.nbytes + self.gray.nbytes + self._tile_bytes)
+
+    @property
+    def threshold(self) -> float:
+        """Otsu threshold of the whole image used by window()."""
+        with self._lock:
+            return self._image_threshold()
+
+    def _image_threshold(self) -> float:
+        if self._threshold is None:
+            blur = cv2.GaussianBlur(self.gray, (3, 3), 0)
+            self._threshold, _ = cv2.threshold(
+                blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU
+            )
+        return self._threshold
+
+    def _compute_tile(self, row: int, col: int) -> RoiFeatures:
+        h, w = self.shape
+        ts = self.tile_size
+        tx0, ty0 = col * ts, row * ts
+        tx1, ty1 = min(w, tx0 + ts), min(h, ty0 + ts)
+        hx0 = max(0, tx0 - FEATURE_TILE_HALO)
+        hy0 = max(0, ty0 - FEATURE_TILE_HALO)
+        hx1 = min(w, tx1 + FEATURE_TILE_HALO)
+        hy1 = min(h, ty1 + FEATURE_TILE_HALO)
+        gray = self.gray[hy0:hy1, hx0:hx1]
+        blur = cv2.GaussianBlur(gray, (3, 3), 0)
+        _, bin_img = cv2.threshold(blur, self._image_threshold(), 255, cv2.THRESH_BINARY_INV)
+        edges = cv2.Canny(cv2.GaussianBlur(bin_img, (3, 3), 0), 50, 150)
+        mag, ang = binary_gradients(bin_img)
+        inner = (slice(ty0 - hy0, ty1 - hy0), slice(tx0 - hx0, tx1 - hx0))
+        return RoiFeatures(
+            edge=np.where(edges[inner] > 0, 255, 0).astype(np.uint8),
+            bin=np.ascontiguousarray(bin_img[inner]),
+            mag=np.ascontiguousarray(mag[inner], dtype=np.float32),
+            ang=np.ascontiguousarray(ang[inner], dtype=np.float32),
+        )
+
+    def roi(self, x0: int, y0: int, x1: int, y1: int) -> RoiFeatures:
+        """ROI-local maps of [x0, x1) x [y0, y1), as matching computes them without a cache."""
+        return preprocess_roi(self.gray[y0:y1, x0:x1], gradients=True)
+
+    def window(self, x0: int, y0: int, x1: int, y1: int) -> "FeatureWindow":
+        """The image-wide maps of [x0, x1) x [y0, y1) as a FeatureWindow (window coordinates)."""
+        return FeatureWindow(self._tiled(x0, y0, x1, y1))
+
+    def _tiled(self, x0: int, y0: int, x1: int, y1: int) -> RoiFeatures:
+        """Image-wide maps for [x0, x1) x [y0, y1), computing missing tiles first.
+
+        Views into the tile when the area lies in one tile, a stitched copy otherwise.
+        """
+        ts = self.tile_size
+        rows = range(y0 // ts, (max(y0, y1 - 1)) // ts + 1)
+        cols = range(x0 // ts, (max(x0, x1 - 1)) // ts + 1)
+        tiles: Dict[Tuple[int, int], RoiFeatures] = {}
+        grown = 0
+        with self._lock:
+            for row in rows:
+                for col in cols:
+                    tile = self._tiles.get((row, col))
+                    if tile is None:
+                        tile = self._compute_tile(row, col)
+                        self._tiles[(row, col)] = tile
+                        size = tile.edge.nbytes + tile.bin.nbytes + tile.mag.nbytes + tile.ang.nbytes
+                        self._tile_bytes += size
+                        grown += size
+                    tiles[(row, col)] = tile
+        if grown and self.on_grow is not None:
+            self.on_grow(grown)
+        if len(tiles) == 1:
+            (row, col), tile = next(iter(tiles.items()))
+            sy = slice(y0 - row * ts, y1 - row * ts)
+            sx = slice(x0 - col * ts, x1 - col * ts)
+            return RoiFeatures(
+                edge=tile.edge[sy, sx], bin=tile.bin[sy, sx], mag=tile.mag[sy, sx], ang=tile.ang[sy, sx]
+            )
+        out = RoiFeatures(
+            edge=np.empty((y1 - y0, x1 - x0), dtype=np.uint8),
+            bin=np.empty((y1 - y0, x1 - x0), dtype=np.uint8),
+            mag=np.empty((y1 - y0, x1 - x0), dtype=np.float32),
+            ang=np.empty((y1 - y0, x1 - x0), dtype=np.float32),
+        )
+        for (row, col), tile in tiles.items():
+            ty0, tx0 = row * ts, col * ts
+            iy0, iy1 = max(y0, ty0), min(y1, ty0 + ts)
+            ix0, ix1 = max(x0, tx0), min(x1, tx0 + ts)
+            dst = (slice(iy0 - y0, iy1 - y0), slice(ix0 - x0, ix1 - x0))
+            src = (slice(iy0 - ty0, iy1 - ty0), slice(ix0 - tx0, ix1 - tx0))
+            out.edge[dst] = tile.edge[src]
+            out.bin[dst] = tile.bin[src]
+            out.mag[dst] = tile.mag[src]
+            out.ang[dst] = tile.ang[src]
+        return out
+
+
+class FeatureWindow:
+    """Precomputed maps of one image window, addressed in window coordinates.
+
+    Stands in for ImageFeatures in match_templates when a tile is matched on
+    its own (annotate_all_manual). It only holds arrays, so it can be sent to
+    tile worker processes.
+    """
+
+    def __init__(self, maps: RoiFeatures) -> None:
+        self.maps = maps
+        self.shape: Tuple[int, int] = (int(maps.bin.shape[0]), int(maps.bin.shape[1]))
+
+    def roi(self, x0: int, y0: int, x1: int, y1: int) -> RoiFeatures:
+        def view(arr: Optional[np.ndarray]) -> Optional[np.ndarray]:
+            return None if arr is None else arr[y0:y1, x0:x1]
+
+        return RoiFeatures(
+            edge=self.maps.edge[y0:y1, x0:x1],
+            bin=self.maps.bin[y0:y1, x0:x1],
+            mag=view(self.maps.mag),
+            ang=view(self.maps.ang),
+        )
+
+
+class ImageFeatureCache:
+    def __init__(self, max_bytes: int = FEATURE_CACHE_MAX_BYTES) -> None:
+        self.max_bytes = int(max_bytes)
+        self._entries: "OrderedDict[str, Tuple[Hashable, ImageFeatures]]" = OrderedDict()
+        self._charged: Dict[str, int] = {}  # bytes counted in _bytes per entry
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(
+        self, image_id: str, fingerprint: Hashable, loader: Callable[[], np.ndarray]
+    ) -> ImageFeatures:
+        """Cached features of image_id; reloaded when the fingerprint changed."""
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is not None and entry[0] == fingerprint:
+                self._entries.move_to_end(image_id)
+                return entry[1]
+        features = ImageFeatures(loader())
+        with self._lock:
+            self._drop(image_id)
+            self._entries[image_id] = (fingerprint, features)
+            self._charged[image_id] = features.nbytes
+            self._bytes += features.nbytes
+            # tiles computed later are charged as they are stored
+            features.on_grow = partial(self._charge, image_id, features)
+            self._evict()
+        return features
+
+    def _charge(self, image_id: str, features: ImageFeatures, nbytes: int) -> None:
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is None or entry[1] is not features:
+                return  # evicted or replaced; no longer counted
+            self._charged[image_id] += nbytes
+            self._bytes += nbytes
+            self._evict()
+
+    def _drop(self, image_id: str) -> bool:
+        if self._entries.pop(image_id, None) is None:
+            return False
+        self._bytes -= self._charged.pop(image_id)
+        return True
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate(self, image_id: Optional[str] = None) -> int:
+        with self._lock:
+            if image_id is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                self._charged.clear()
+                self._bytes = 0
+                return removed
+            return 1 if self._drop(image_id) else 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_cache: Optional[ImageFeatureCache] = None
+
+
+def get_feature_cache() -> ImageFeatureCache:
+    global _cache
+    if _cache is None:
+        _cache = ImageFeatureCache()
+    return _cache
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
-from typing import Iterable, List, Mapping, Optional, Tuple, Union
+from typing import Dict, Hashable, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
 
-from .nms import compute_iou
+import numpy as np
+
+from .nms import BoxIndex, iou_pairs
 
 
 BBox = Tuple[int, int, int, int]
@@ -55,9 +57,92 @@ def filter_bboxes(
     return filtered
 
 
+class ConfirmedBoxIndex:
+    """Confirmed annotations indexed once for bulk exclusion queries.
+
+    Boxes are kept in an x-sorted `BoxIndex`; a query gathers, for every
+    candidate, the confirmed boxes whose x can satisfy any of the
+    center-in / overlap / IoU tests and evaluates those pairs together.
+    """
+
+    def __init__(self, confirmed: Iterable[object]) -> None:
+        boxes: List[BBox] = []
+        self.classes: List[Optional[str]] = []
+        for item in confirmed:
+            if not item:
+                continue
+            boxes.append(_as_box_tuple(item.get("bbox") if isinstance(item, Mapping) else item))
+            self.classes.append(item.get("class_name") if isinstance(item, Mapping) else None)
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self.index = BoxIndex(self.boxes)
+        # class id 0: no class (matches any class)
+        self._class_ids: Dict[Hashable, int] = {}
+        self._box_class = np.asarray([self._class_id(c) for c in self.classes], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def _class_id(self, name: Optional[Hashable]) -> int:
+        if not name:
+            return 0
+        return self._class_ids.setdefault(name, len(self._class_ids) + 1)
+
+    def excluded(
+        self,
+        boxes: np.ndarray,
+        classes: Sequence[Optional[str]],
+        exclude_mode: str = "same_class",
+        center_check: bool = True,
+        iou_threshold: float = 0.6,
+        any_overlap: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Masks of candidates hit by a confirmed box: (with IoU test, without IoU test)."""
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        n = len(boxes)
+        if n == 0 or len(self) == 0:
+            return np.zeros(n, dtype=bool), np.zeros(n, dtype=bool)
+        cx = boxes[:, 0] + boxes[:, 2] / 2.0
+        cy = boxes[:, 1] + boxes[:, 3] / 2.0
+        max_w = int(self.boxes[:, 2].max())
+        query, idx = self.index.x_range_pairs(
+            np.minimum(boxes[:, 0], cx) - max_w,
+            np.maximum(boxes[:, 0] + boxes[:, 2], cx),
+        )
+        q, c = boxes[query], self.boxes[idx]
+        allowed = np.ones(len(query), dtype=bool)
+        if exclude_mode == "same_class":
+            cand_class = np.asarray([self._class_id(name) for name in classes], dtype=np.int64)
+            qc, bc = cand_class[query], self._box_class[idx]
+            allowed = (qc == 0) | (bc == 0) | (qc == bc)
+        hit = np.zeros(len(query), dtype=bool)
+        if any_overlap:
+            hit |= (
+                (q[:, 0] < c[:, 0] + c[:, 2])
+                & (q[:, 0] + q[:, 2] > c[:, 0])
+                & (q[:, 1] < c[:, 1] + c[:, 3])
+                & (q[:, 1] + q[:, 3] > c[:, 1])
+            )
+        if center_check:
+            pcx, pcy = cx[query], cy[query]
+            hit |= (
+                (c[:, 0] <= pcx)
+                & (pcx <= c[:, 0] + c[:, 2])
+                & (c[:, 1] <= pcy)
+                & (pcy <= c[:, 1] + c[:, 3])
+            )
+        hit_iou = hit
+        if iou_threshold > 0:
+            hit_iou = hit | (iou_pairs(q, c) >= iou_threshold)
+        strict = np.zeros(n, dtype=bool)
+        relaxed = np.zeros(n, dtype=bool)
+        strict[query[allowed & hit_iou]] = True
+        relaxed[query[allowed & hit]] = True
+        return strict, relaxed
+
+
 def exclude_confirmed_candidates(
     candidates: List[object],
-    confirmed: List[dict],
+    confirmed: Union[List[dict], ConfirmedBoxIndex],
     exclude_mode: str = "same_class",
     center_check: bool = True,
     iou_threshold: float = 0.6,
@@ -66,13 +151,6 @@ def exclude_confirmed_candidates(
     if not candidates or not confirmed:
         return candidates
 
-    def _center_in(box: BBox, cbox: BBox) -> bool:
-        x, y, w, h = box
-        cx = x + w / 2.0
-        cy = y + h / 2.0
-        bx, by, bw, bh = cbox
-        return bx <= cx <= bx + bw and by <= cy <= by + bh
-
     def _as_bbox(obj: object) -> BBox:
         if hasattr(obj, "bbox"):
             b = getattr(obj, "bbox")
@@ -88,35 +166,19 @@ def exclude_confirmed_candidates(
             return obj.get("class_name")
         return None
 
-    confirmed_pairs: List[Tuple[BBox, Optional[str]]] = []
-    for item in confirmed:
-        if not item:
-            continue
-        bbox = _as_box_tuple(item.get("bbox") if isinstance(item, Mapping) else item)
-        cname = item.get("class_name") if isinstance(item, Mapping) else None
-        confirmed_pairs.append((bbox, cname))
-    if not confirmed_pairs:
+    index = confirmed if isinstance(confirmed, ConfirmedBoxIndex) else ConfirmedBoxIndex(confirmed)
+    if len(index) == 0:
         return candidates
 
-    def _match_excluded(candidate: object, use_iou: bool) -> bool:
-        cbbox = _as_bbox(candidate)
-        cname = _as_class(candidate)
-        for bbox, cls in confirmed_pairs:
-            if exclude_mode == "same_class" and cls and cname and cls != cname:
-                continue
-            if any_overlap:
-                ax, ay, aw, ah = cbbox
-                bx, by, bw, bh = bbox
-                if (ax < bx + bw and ax + aw > bx and ay < by + bh and ay + ah > by):
-                    return True
-            if center_check and _center_in(cbbox, bbox):
-                return True
-            if use_iou and iou_threshold > 0 and compute_iou(cbbox, bbox) >= iou_threshold:
-                return True
-        return False
-
-    filtered = [c for c in candidates if not _match_excluded(c, use_iou=True)]
+    strict, relaxed = index.excluded(
+        np.asarray([_as_bbox(c) for c in candidates], dtype=np.int64),
+        [_as_class(c) for c in candidates],
+        exclude_mode=exclude_mode,
+        center_check=center_check,
+        iou_threshold=iou_threshold,
+        any_overlap=any_overlap,
+    )
+    filtered = [c for c, hit in zip(candidates, strict.tolist()) if not hit]
     if filtered:
         return filtered
-    relaxed = [c for c in candidates if not _match_excluded(c, use_iou=False)]
-    return relaxed
+    return [c for c, hit in zip(candidates, relaxed.tolist()) if not hit]
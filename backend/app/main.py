@@ -1,9 +1,10 @@
 from __future__ import annotations
 
-from typing import Dict, List, Optional
+from dataclasses import replace
+from typing import Dict, List, Optional, Tuple
 
 import cv2
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import FastAPI, File, Form, HTTPException, Response, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 import tempfile
@@ -19,6 +20,8 @@ import shutil
 from datetime import datetime
 import tempfile
 import random
+import hashlib
+import itertools
 
 from .config import (
     DEFAULT_SCALE_MAX,
@@ -27,24 +30,39 @@ from .config import (
     DEFAULT_TOPK,
     DATASETS_DIR,
     IMAGES_DIR,
+    MATCH_THREAD_WORKERS,
+    TEMPLATE_COMPACT,
+    TEMPLATE_DEDUP,
+    TEMPLATE_DEDUP_EXPAND,
+    TEMPLATE_DEDUP_HASH_DISTANCE,
+    TEMPLATE_DEDUP_MIN_CORR,
+    TEMPLATE_SCAN_WORKERS,
+    TEMPLATE_WARMUP,
+    TEMPLATE_WATCH_INTERVAL,
     TEMPLATES_ROOT,
+    TILE_PROCESS_WORKERS,
 )
 from .contours import find_roi_contours
-from .filters import exclude_confirmed_candidates, filter_bboxes
+from .feature_cache import ImageFeatures, get_feature_cache
+from .filters import ConfirmedBoxIndex, exclude_confirmed_candidates, filter_bboxes
 from .matching import (
     MatchResult,
     apply_vertical_padding,
     filter_overlapping_matches,
     clip_roi,
+    expand_group_hits,
     match_templates,
     preprocess_edge,
     refine_match_bboxes,
 )
-from .nms import nms
+from .nms import batched_nms, overlap_clusters, suppress_overlapping
 from .schemas import (
     DetectFullRequest,
+    DetectFullDebug,
+    DetectFullPrunedRegion,
     DetectFullResponse,
     DetectFullResult,
+    DetectFullTile,
     DetectPointRequest,
     DetectPointResponse,
     DetectResult,
@@ -70,16 +88,32 @@ from .schemas import (
     ExportYoloResponse,
     ProjectInfo,
     TemplateInfo,
+    TemplateReadiness,
+    TemplateReloadResponse,
     UploadResponse,
 )
 from .storage import IMAGE_EXTS, RUNS_DIR, resolve_image_path
-from .templates import scan_templates
+from .template_cache import get_template_disk_cache
+from .template_registry import TemplateRegistry
+from .templates import TemplateImage, binary_map, template_nbytes
+from .tile_scheduler import (
+    BLANK_TILE_EDGE_FRACTION,
+    TileTask,
+    edge_integral,
+    keep_owned,
+    max_template_extent,
+    merge_seam_duplicates,
+    min_template_edge_pixels,
+    min_template_extent,
+    plan_tiles,
+    run_tiles,
+)
 from .sam_service import get_sam_predictor
 from .sam_device import get_sam_device
 from .polygon import mask_to_polygon, polygon_to_bbox
 from .export_yolo import make_yolo_lines
 from .export_yolo import normalize_bbox
-from .detection_core import annotate_all, annotate_all_manual
+from .detection_core import annotate_all, annotate_all_manual, build_exclusion_mask
 
 
 app = FastAPI(title="Annotator MVP")
@@ -87,6 +121,9 @@ app = FastAPI(title="Annotator MVP")
 DATASET_IMAGE_PREFIX = "dataset::"
 MEMORY_IMAGE_PREFIX = "mem::"
 IN_MEMORY_IMAGES: Dict[str, bytes] = {}
+# upload number of each in-memory image (feature-cache fingerprint); ids of bytes objects get reused
+IN_MEMORY_IMAGE_VERSIONS: Dict[str, int] = {}
+_memory_uploads = itertools.count(1)
 
 app.add_middleware(
     CORSMiddleware,
@@ -96,7 +133,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-templates_cache = scan_templates(TEMPLATES_ROOT)
+templates_cache = TemplateRegistry(
+    TEMPLATES_ROOT,
+    cache=get_template_disk_cache(),
+    workers=TEMPLATE_SCAN_WORKERS,
+    compact=TEMPLATE_COMPACT,
+    dedup_hash_distance=TEMPLATE_DEDUP_HASH_DISTANCE,
+    dedup_min_corr=TEMPLATE_DEDUP_MIN_CORR,
+    warmup=TEMPLATE_WARMUP,
+)
+if TEMPLATE_WARMUP:
+    templates_cache.start_warmup()
+if TEMPLATE_WATCH_INTERVAL > 0:
+    templates_cache.start_watcher(TEMPLATE_WATCH_INTERVAL)
+# /detect/full halo tiling: IoU above which seam-crossing copies of a class are merged
+SEAM_IOU_THRESHOLD = 0.5
 BBOX_PAD_DEFAULT_TOP = 0
 BBOX_PAD_DEFAULT_BOTTOM = 0
 BBOX_PAD_MAP: Dict[str, Dict[str, int]] = {}
@@ -114,6 +165,14 @@ def _get_project_class_names(project: str) -> List[str]:
     return []
 
 
+def _matching_templates(project: str) -> Optional[Dict[str, List[TemplateImage]]]:
+    """Templates to match for a project: one per near-duplicate group when TEMPLATE_DEDUP is on."""
+    project_templates = templates_cache.get(project)
+    if project_templates is None or not TEMPLATE_DEDUP:
+        return project_templates
+    return templates_cache.representatives(project)
+
+
 def _split_counts(total: int, ratios: List[int]) -> List[int]:
     ratio_sum = sum(max(0, r) for r in ratios)
     if total <= 0 or ratio_sum <= 0:
@@ -217,6 +276,26 @@ def _read_image_bgr(image_id: str) -> np.ndarray:
     return image
 
 
+def _image_fingerprint(image_id: str) -> Tuple:
+    if image_id.startswith(MEMORY_IMAGE_PREFIX):
+        data = IN_MEMORY_IMAGES.get(image_id)
+        if not data:
+            raise FileNotFoundError(image_id)
+        version = IN_MEMORY_IMAGE_VERSIONS.get(image_id)
+        if version is None:
+            # stored without _save_upload_memory: identify the content itself
+            return ("memory-sha1", hashlib.sha1(data).hexdigest())
+        return ("memory", version, len(data))
+    stat = _resolve_any_image_path(image_id).stat()
+    return ("file", stat.st_mtime_ns, stat.st_size)
+
+
+def _get_image_features(image_id: str) -> ImageFeatures:
+    return get_feature_cache().get(
+        image_id, _image_fingerprint(image_id), lambda: _read_image_bgr(image_id)
+    )
+
+
 def _save_upload_memory(image_file: UploadFile) -> UploadResponse:
     suffix = Path(image_file.filename or "").suffix.lower()
     if suffix not in IMAGE_EXTS:
@@ -231,6 +310,7 @@ def _save_upload_memory(image_file: UploadFile) -> UploadResponse:
         raise ValueError("invalid image") from exc
     image_id = f"{MEMORY_IMAGE_PREFIX}{uuid4().hex}{suffix}"
     IN_MEMORY_IMAGES[image_id] = data
+    IN_MEMORY_IMAGE_VERSIONS[image_id] = next(_memory_uploads)
     return UploadResponse(image_id=image_id, width=width, height=height)
 
 
@@ -400,12 +480,35 @@ def _project_stats(project_name: str) -> Dict[str, object]:
     }
 
 
+@app.get("/health/ready", response_model=TemplateReadiness)
+def health_ready(response: Response) -> TemplateReadiness:
+    status = TemplateReadiness(**templates_cache.status())
+    if not status.ready:
+        response.status_code = 503
+    return status
+
+
+@app.post("/templates/reload", response_model=TemplateReloadResponse)
+def reload_templates() -> TemplateReloadResponse:
+    return TemplateReloadResponse(**templates_cache.rescan())
+
+
 @app.get("/templates", response_model=List[ProjectInfo])
 def list_templates() -> List[ProjectInfo]:
     projects: List[ProjectInfo] = []
     for project, classes in templates_cache.items():
+        groups = templates_cache.groups(project)
         templates: List[TemplateInfo] = [
-            TemplateInfo(class_name=class_name, count=len(items))
+            TemplateInfo(
+                class_name=class_name,
+                count=len(items),
+                bytes=sum(template_nbytes(t) for t in items),
+                duplicates=[
+                    [t.template_name for t in group.templates]
+                    for group in groups.get(class_name, [])
+                    if group.members
+                ],
+            )
             for class_name, items in classes.items()
         ]
         templates.sort(key=lambda t: t.class_name)
@@ -430,7 +533,7 @@ def get_template_preview(project: str, class_name: str, template_name: str) -> D
     tpl = next((t for t in class_templates if t.template_name == template_name), None)
     if tpl is None:
         raise HTTPException(status_code=404, detail="template not found")
-    img = tpl.image_proc_edge
+    img = binary_map(tpl.image_proc_edge)
     if img is None or getattr(img, "size", 0) == 0:
         return {"base64": None}
     ok, buffer = cv2.imencode(".png", img)
@@ -1005,8 +1108,13 @@ def upload_image(file: UploadFile = File(...)) -> UploadResponse:
 
 @app.post("/detect/point", response_model=DetectPointResponse)
 def detect_point(payload: DetectPointRequest) -> DetectPointResponse:
+    features: Optional[ImageFeatures] = None
     try:
-        image = _read_image_bgr(payload.image_id)
+        if payload.feature_cache:
+            features = _get_image_features(payload.image_id)
+            image = features.image_bgr
+        else:
+            image = _read_image_bgr(payload.image_id)
     except FileNotFoundError:
         raise HTTPException(status_code=400, detail="invalid image_id")
     except ValueError:
@@ -1081,17 +1189,34 @@ def detect_point(payload: DetectPointRequest) -> DetectPointResponse:
     if project_templates is None:
         raise HTTPException(status_code=400, detail="invalid project")
 
-    matches = match_templates(
+    match_stats: Dict[str, object] = {}
+    match_kwargs = dict(
         image_bgr=image,
         x=payload.x,
         y=payload.y,
         roi_size=payload.roi_size,
-        templates=project_templates,
         scale_min=payload.scale_min or DEFAULT_SCALE_MIN,
         scale_max=payload.scale_max or DEFAULT_SCALE_MAX,
         scale_steps=5,
         line_art_enhanced=True,
+        search_mode=payload.search_mode,
+        correlation_backend=payload.correlation_backend,
+        workers=MATCH_THREAD_WORKERS,
+        features=features,
+        hist_prefilter=payload.hist_prefilter,
     )
+    matches = match_templates(
+        templates=_matching_templates(payload.project),
+        stats=match_stats,
+        **match_kwargs,
+    )
+    if TEMPLATE_DEDUP and TEMPLATE_DEDUP_EXPAND:
+        matches = expand_group_hits(
+            matches,
+            templates_cache.groups(payload.project),
+            lambda members: match_templates(templates=members, **match_kwargs),
+            top_classes=3,
+        )
     confirmed = []
     if payload.confirmed_annotations:
         confirmed = [ann.model_dump() for ann in payload.confirmed_annotations]
@@ -1101,14 +1226,15 @@ def detect_point(payload: DetectPointRequest) -> DetectPointResponse:
     matches_sorted = sorted(matches, key=lambda r: r.score, reverse=True)
     representative: List[MatchResult] = []
     seen_classes = set()
+    confirmed_index = ConfirmedBoxIndex(confirmed) if confirmed else None
     for match in matches_sorted:
         if match.class_name in seen_classes:
             continue
-        if confirmed:
+        if confirmed_index is not None:
             if (
                 exclude_confirmed_candidates(
                     [match],
-                    confirmed,
+                    confirmed_index,
                     exclude_mode=payload.exclude_mode,
                     center_check=False,
                     iou_threshold=payload.exclude_iou_threshold,
@@ -1145,6 +1271,7 @@ def detect_point(payload: DetectPointRequest) -> DetectPointResponse:
         "roi_preview_base64": roi_preview_base64,
         "roi_preview_marked_base64": roi_preview_marked_base64,
         "roi_edge_preview_base64": roi_edge_preview_base64,
+        "prefilter": match_stats.get("prefilter"),
     }
     if representative:
         best_match = representative[0]
@@ -1168,7 +1295,7 @@ def detect_point(payload: DetectPointRequest) -> DetectPointResponse:
         tpl_preview = None
         for tpl in project_templates.get(best_match.class_name, []):
             if tpl.template_name == best_match.template_name:
-                tpl_preview = tpl.image_proc_edge
+                tpl_preview = binary_map(tpl.image_proc_edge)
                 break
         if tpl_preview is not None and tpl_preview.size > 0:
             ok4, buffer4 = cv2.imencode(".png", tpl_preview)
@@ -1208,65 +1335,121 @@ def detect_full(payload: DetectFullRequest) -> DetectFullResponse:
     except ValueError:
         raise HTTPException(status_code=400, detail="failed to read image")
 
-    project_templates = templates_cache.get(payload.project)
+    project_templates = _matching_templates(payload.project)
     if project_templates is None:
         raise HTTPException(status_code=400, detail="invalid project")
 
     tile_size = 1024
     height, width = image.shape[:2]
+    scale_min = payload.scale_min or DEFAULT_SCALE_MIN
+    scale_max = payload.scale_max or DEFAULT_SCALE_MAX
     matches: List[MatchResult] = []
 
-    for y0 in range(0, height, tile_size):
-        y1 = min(height, y0 + tile_size)
-        for x0 in range(0, width, tile_size):
-            x1 = min(width, x0 + tile_size)
-            tile = image[y0:y1, x0:x1]
-            tile_w = x1 - x0
-            tile_h = y1 - y0
-            if tile_w <= 0 or tile_h <= 0:
-                continue
-            cx = tile_w // 2
-            cy = tile_h // 2
-            roi_size = max(tile_w, tile_h)
-            tile_matches = match_templates(
-                image_bgr=tile,
-                x=cx,
-                y=cy,
-                roi_size=roi_size,
-                templates=project_templates,
-                scale_min=payload.scale_min or DEFAULT_SCALE_MIN,
-                scale_max=payload.scale_max or DEFAULT_SCALE_MAX,
-                scale_steps=payload.scale_steps or DEFAULT_SCALE_STEPS,
-                line_art_enhanced=True,
+    halo = 0
+    integral = None
+    min_edge_pixels = 0
+    if payload.tiling == "halo":
+        halo = max_template_extent(project_templates, scale_max)
+        if payload.skip_blank_tiles:
+            integral = edge_integral(preprocess_edge(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)))
+            min_edge_pixels = int(
+                min_template_edge_pixels(project_templates, scale_min) * BLANK_TILE_EDGE_FRACTION
             )
-            for match in tile_matches:
-                matches.append(
-                    MatchResult(
-                        class_name=match.class_name,
-                        template_name=match.template_name,
-                        score=match.score,
-                        scale=match.scale,
-                        bbox=(
-                            match.bbox[0] + x0,
-                            match.bbox[1] + y0,
-                            match.bbox[2],
-                            match.bbox[3],
-                        ),
-                        outer_bbox=(
-                            match.outer_bbox[0] + x0,
-                            match.outer_bbox[1] + y0,
-                            match.outer_bbox[2],
-                            match.outer_bbox[3],
-                        ),
-                        tight_bbox=(
-                            match.tight_bbox[0] + x0,
-                            match.tight_bbox[1] + y0,
-                            match.tight_bbox[2],
-                            match.tight_bbox[3],
-                        ),
-                        mode=match.mode,
-                    )
-                )
+    plans = plan_tiles(width, height, tile_size, halo, integral, min_edge_pixels)
+    exclusion = None
+    if payload.prune_mask:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        exclusion = build_exclusion_mask(
+            (gray < 128).astype(np.uint8) * 255,
+            min_template_extent(project_templates, scale_min),
+            max_template_extent(project_templates, scale_max),
+        )
+        # a tile only keeps matches centred in its core
+        plans = [
+            replace(plan, skipped=True, pruned=True)
+            if not plan.skipped and exclusion.covers(plan.core)
+            else plan
+            for plan in plans
+        ]
+    active = [plan for plan in plans if not plan.skipped]
+
+    tasks: List[TileTask] = []
+    for plan in active:
+        x0, y0, x1, y1 = plan.region
+        tasks.append(
+            TileTask(
+                x0=x0,
+                y0=y0,
+                tile=image[y0:y1, x0:x1],
+                match_kwargs={
+                    "scale_min": scale_min,
+                    "scale_max": scale_max,
+                    "scale_steps": payload.scale_steps or DEFAULT_SCALE_STEPS,
+                    "line_art_enhanced": True,
+                    "search_mode": payload.search_mode,
+                    "correlation_backend": payload.correlation_backend,
+                    "hist_prefilter": payload.hist_prefilter,
+                },
+            )
+        )
+    timings: List[float] = []
+    tile_results = run_tiles(
+        tasks, project_templates, workers=TILE_PROCESS_WORKERS, timings=timings
+    )
+    seam_duplicates = 0
+    if payload.tiling == "halo":
+        # each object is kept by the tile owning its centre, then seam copies are merged
+        cores = []
+        for plan, tile_matches in zip(active, tile_results):
+            owned = keep_owned(tile_matches, plan)
+            matches.extend(owned)
+            cores.extend([plan.core] * len(owned))
+        matches, seam_duplicates = merge_seam_duplicates(matches, cores, SEAM_IOU_THRESHOLD)
+    else:
+        for tile_matches in tile_results:
+            matches.extend(tile_matches)
+    if exclusion is not None:
+        matches = [m for m in matches if exclusion.keeps(m.bbox)]
+
+    tile_stats = iter(zip(tile_results, timings))
+    tiles_debug: List[DetectFullTile] = []
+    for plan in plans:
+        x0, y0, x1, y1 = plan.region
+        tile_matches, seconds = ([], 0.0) if plan.skipped else next(tile_stats)
+        tiles_debug.append(
+            DetectFullTile(
+                x=x0,
+                y=y0,
+                w=x1 - x0,
+                h=y1 - y0,
+                skipped=plan.skipped,
+                pruned=plan.pruned,
+                edge_pixels=plan.edge_pixels,
+                matches=len(tile_matches),
+                seconds=round(seconds, 4),
+            )
+        )
+    debug = DetectFullDebug(
+        tiling=payload.tiling,
+        tile_size=tile_size,
+        halo=halo,
+        tiles_total=len(plans),
+        tiles_skipped=len(plans) - len(active),
+        seam_duplicates=seam_duplicates,
+        tiles=tiles_debug,
+    )
+    if exclusion is not None:
+        debug.pruned_fraction = round(exclusion.fraction, 4)
+        debug.pruned_regions = [
+            DetectFullPrunedRegion(
+                kind=region.kind,
+                bbox={"x": region.bbox[0], "y": region.bbox[1], "w": region.bbox[2], "h": region.bbox[3]},
+            )
+            for region in exclusion.regions
+        ]
+        ok, buffer = cv2.imencode(".png", exclusion.mask)
+        if ok:
+            debug.prune_mask_base64 = base64.b64encode(buffer.tobytes()).decode("ascii")
 
     matches = apply_vertical_padding(
         matches,
@@ -1278,16 +1461,13 @@ def detect_full(payload: DetectFullRequest) -> DetectFullResponse:
 
     filtered_matches = filter_bboxes(matches, tile_size, payload.score_threshold)
 
-    grouped: Dict[str, List[int]] = {}
-    for idx, match in enumerate(filtered_matches):
-        grouped.setdefault(match.class_name, []).append(idx)
-
-    kept_matches: List[MatchResult] = []
-    for indices in grouped.values():
-        class_boxes = [filtered_matches[i].bbox for i in indices]
-        class_scores = [filtered_matches[i].score for i in indices]
-        kept_indices = nms(class_boxes, class_scores, payload.iou_threshold)
-        kept_matches.extend(filtered_matches[indices[i]] for i in kept_indices)
+    kept_indices = batched_nms(
+        [m.bbox for m in filtered_matches],
+        [m.score for m in filtered_matches],
+        [m.class_name for m in filtered_matches],
+        payload.iou_threshold,
+    )
+    kept_matches: List[MatchResult] = [filtered_matches[i] for i in kept_indices]
 
     best_per_class: Dict[str, MatchResult] = {}
     for match in kept_matches:
@@ -1321,7 +1501,7 @@ def detect_full(payload: DetectFullRequest) -> DetectFullResponse:
         for match in representative
     ]
 
-    return DetectFullResponse(results=results)
+    return DetectFullResponse(results=results, debug=debug)
 
 
 @app.post("/segment/candidate", response_model=SegmentCandidateResponse)
@@ -1520,7 +1700,7 @@ def annotate_auto(payload: AutoAnnotateRequest) -> AutoAnnotateResponse:
     except ValueError:
         raise HTTPException(status_code=400, detail="failed to read image")
 
-    project_templates = templates_cache.get(payload.project)
+    project_templates = _matching_templates(payload.project)
     if project_templates is None:
         raise HTTPException(status_code=400, detail="invalid project")
 
@@ -1560,6 +1740,10 @@ def annotate_auto(payload: AutoAnnotateRequest) -> AutoAnnotateResponse:
                 scale_max=payload.scale_max or DEFAULT_SCALE_MAX,
                 scale_steps=payload.scale_steps or DEFAULT_SCALE_STEPS,
                 stride=payload.stride,
+                workers=TILE_PROCESS_WORKERS,
+                peaks_per_map=payload.peaks_per_map,
+                precompute_features=payload.precompute_features,
+                prune_mask=payload.prune_mask,
             )
         else:
             result = annotate_all(
@@ -1572,6 +1756,10 @@ def annotate_auto(payload: AutoAnnotateRequest) -> AutoAnnotateResponse:
                 scale_max=payload.scale_max or DEFAULT_SCALE_MAX,
                 scale_steps=payload.scale_steps or DEFAULT_SCALE_STEPS,
                 stride=payload.stride,
+                search_mode=payload.search_mode,
+                correlation_backend=payload.correlation_backend,
+                suppress_peaks=payload.suppress_peaks,
+                prune_mask=payload.prune_mask,
             )
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc)) from exc
@@ -1581,49 +1769,18 @@ def annotate_auto(payload: AutoAnnotateRequest) -> AutoAnnotateResponse:
     def _dedup_any_overlap(cands: list) -> list:
         if not cands:
             return cands
-        sorted_candidates = sorted(
-            cands, key=lambda c: c.get("final_score", 0.0), reverse=True
+        order = sorted(
+            range(len(cands)), key=lambda i: cands[i].get("final_score", 0.0), reverse=True
         )
-        kept = []
-        for cand in sorted_candidates:
-            bx, by, bw, bh = cand["bbox"]
-            overlap = False
-            for kept_c in kept:
-                kx, ky, kw, kh = kept_c["bbox"]
-                if (bx < kx + kw and bx + bw > kx and by < ky + kh and by + bh > ky):
-                    overlap = True
-                    break
-            if not overlap:
-                kept.append(cand)
-        return kept
-
-    def _boxes_overlap(a: tuple[int, int, int, int], b: tuple[int, int, int, int]) -> bool:
-        ax, ay, aw, ah = a
-        bx, by, bw, bh = b
-        return ax < bx + bw and ax + aw > bx and ay < by + bh and ay + ah > by
+        keep = suppress_overlapping([c["bbox"] for c in cands], order)
+        return [cands[i] for i in keep]
 
     def _dedup_overlap_clusters(cands: list) -> list:
         if not cands:
             return cands
         ambiguity_margin = 0.01
-        visited = [False] * len(cands)
         kept = []
-        for start in range(len(cands)):
-            if visited[start]:
-                continue
-            stack = [start]
-            visited[start] = True
-            component: list[int] = []
-            while stack:
-                i = stack.pop()
-                component.append(i)
-                ibox = cands[i]["bbox"]
-                for j in range(len(cands)):
-                    if visited[j]:
-                        continue
-                    if _boxes_overlap(ibox, cands[j]["bbox"]):
-                        visited[j] = True
-                        stack.append(j)
+        for component in overlap_clusters([c["bbox"] for c in cands]):
             ranked = sorted(
                 component,
                 key=lambda idx: float(cands[idx].get("final_score", 0.0)),
@@ -1,18 +1,79 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Optional, Tuple
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
 
 import cv2
 import numpy as np
 
-from .nms import BoxLike, compute_iou
-from .templates import TemplateImage, TemplateVariant
+from .config import MATCH_THREAD_WORKERS
+from .nms import BoxIndex, BoxLike, boxes_to_array, compute_iou, iou_pairs
+from .template_bank import ScaledTemplate, get_template_bank
+from .templates import TemplateGroup, TemplateImage, TemplateVariant, angle_bin_index, binary_map
+
+if TYPE_CHECKING:
+    from .feature_cache import FeatureWindow, ImageFeatures
 
 
 LINEART_TOPK_RERANK = 24
 LINEART_TIE_EPS = 0.01
 LINEART_HIST_BINS = 18
+# rerank histograms: the integral table is built once the windows' pixels plus this
+# per-window overhead (in pixels) reach this many times the area of their union
+LINEART_HIST_WINDOW_OVERHEAD = 30000
+LINEART_HIST_TABLE_COST = 130
+
+# coarse-to-fine search (search_mode="pyramid")
+PYRAMID_DOWNSCALE = 2
+PYRAMID_MIN_TEMPLATE = 8
+PYRAMID_REFINE_SCALES = 3
+PYRAMID_REFINE_MARGIN = 2
+
+# frequency-domain correlation (correlation_backend="fft")
+FFT_BATCH_MAX_BYTES = 256 * 1024 * 1024
+FFT_MIN_BLOCK = 32
+# packed masked sums stay exact integers below this magnitude
+FFT_PACKED_MAX = float(2**44)
+
+# normalized responses above 1 + RESPONSE_EPS are rounding artifacts, not matches
+RESPONSE_EPS = 1e-3
+
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, MATCH_THREAD_WORKERS), thread_name_prefix="match"
+            )
+        return _executor
+
+
+def _map_ordered(fn: Callable[[_T], _R], items: Sequence[_T], workers: int) -> List[_R]:
+    """Apply fn to every item, spreading contiguous chunks over the shared pool.
+
+    cv2.matchTemplate releases the GIL, so the chunks run concurrently; results
+    come back in input order, identical to the serial loop.
+    """
+    workers = min(int(workers), MATCH_THREAD_WORKERS, len(items))
+    if workers <= 1:
+        return [fn(item) for item in items]
+    size = -(-len(items) // workers)
+    chunks = [items[i : i + size] for i in range(0, len(items), size)]
+    executor = _get_executor()
+    futures = [executor.submit(lambda chunk: [fn(item) for item in chunk], c) for c in chunks]
+    out: List[_R] = []
+    for future in futures:
+        out.extend(future.result())
+    return out
 
 
 def preprocess_edge(gray: np.ndarray) -> np.ndarray:
@@ -32,29 +93,135 @@ def preprocess_binary_inv(gray: np.ndarray) -> np.ndarray:
     return bin_img
 
 
-def _angle_hist_from_window(
-    angle_patch: np.ndarray, mag_patch: np.ndarray, edge_patch: np.ndarray, bins: int = LINEART_HIST_BINS
-) -> np.ndarray:
-    if (
-        angle_patch is None
-        or mag_patch is None
-        or edge_patch is None
-        or angle_patch.size == 0
-        or mag_patch.size == 0
-        or edge_patch.size == 0
-    ):
-        return np.zeros((bins,), dtype=np.float32)
-    sel = (edge_patch > 0) & (mag_patch > 1e-3)
-    if int(np.count_nonzero(sel)) == 0:
-        return np.zeros((bins,), dtype=np.float32)
-    hist, _ = np.histogram(
-        angle_patch[sel], bins=bins, range=(0.0, 180.0), weights=mag_patch[sel]
-    )
-    hist = hist.astype(np.float32)
-    norm = float(np.linalg.norm(hist))
-    if norm > 1e-6:
-        hist /= norm
-    return hist
+def binary_gradients(bin_img: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sobel magnitude and orientation (degrees in [0, 180)) of a binary map."""
+    bin_f = bin_img.astype(np.float32)
+    gx = cv2.Sobel(bin_f, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(bin_f, cv2.CV_32F, 0, 1, ksize=3)
+    return cv2.magnitude(gx, gy), np.mod(cv2.phase(gx, gy, angleInDegrees=True), 180.0)
+
+
+@dataclass(frozen=True)
+class RoiFeatures:
+    """Preprocessed maps of one ROI (ROI-local, or views into an ImageFeatures cache)."""
+
+    edge: np.ndarray
+    bin: np.ndarray
+    mag: Optional[np.ndarray] = None
+    ang: Optional[np.ndarray] = None
+
+
+def preprocess_roi(gray: np.ndarray, gradients: bool) -> RoiFeatures:
+    """Maps of one grayscale ROI, binarized with the ROI's own Otsu threshold."""
+    roi_bin = preprocess_binary_inv(gray)
+    roi_edge = preprocess_edge(gray)
+    mag = ang = None
+    if gradients:
+        mag, ang = binary_gradients(roi_bin)
+    return RoiFeatures(edge=roi_edge, bin=roi_bin, mag=mag, ang=ang)
+
+
+def _roi_features(
+    image_bgr: Optional[np.ndarray],
+    features: Optional["ImageFeatures | FeatureWindow"],
+    x: float,
+    y: float,
+    roi_size: int,
+    gradients: bool,
+) -> Optional[Tuple[int, int, RoiFeatures]]:
+    if features is not None:
+        height, width = features.shape
+    else:
+        height, width = image_bgr.shape[:2]
+    x0, y0, x1, y1 = _clip_roi(x, y, roi_size, width, height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    if features is not None:
+        return x0, y0, features.roi(x0, y0, x1, y1)
+    roi = cv2.cvtColor(image_bgr[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+    return x0, y0, preprocess_roi(roi, gradients)
+
+
+class _AngleHistWindows:
+    """Weighted orientation histograms (Sobel magnitude on edge pixels) of ROI windows.
+
+    Windows are histogrammed directly by default. prepare() builds float32
+    per-bin integral images over the union of the windows to come, so that
+    each is four lookups per bin, but only when that is cheaper than
+    histogramming them one by one (LINEART_HIST_TABLE_COST).
+    """
+
+    def __init__(
+        self,
+        ang: np.ndarray,
+        mag: np.ndarray,
+        edge: np.ndarray,
+        bins: int = LINEART_HIST_BINS,
+    ) -> None:
+        self.bins = bins
+        self.ang = ang
+        self.mag = mag
+        self.sel = (edge > 0) & (mag > 1e-3)
+        self.table: Optional[np.ndarray] = None
+        self.origin = (0, 0)
+        self.noise = 0.0
+
+    def _clip(self, x: int, y: int, w: int, h: int) -> Tuple[int, int, int, int]:
+        rh, rw = self.sel.shape[:2]
+        return max(0, x), max(0, y), min(rw, x + w), min(rh, y + h)
+
+    def prepare(self, boxes: np.ndarray) -> None:
+        """Build the integral table over the union of boxes (rows of x, y, w, h) if it pays off."""
+        if len(boxes) == 0:
+            return
+        clipped = np.array([self._clip(*(int(v) for v in box)) for box in boxes])
+        areas = np.clip(clipped[:, 2] - clipped[:, 0], 0, None) * np.clip(
+            clipped[:, 3] - clipped[:, 1], 0, None
+        )
+        x0, y0 = int(clipped[:, 0].min()), int(clipped[:, 1].min())
+        x1, y1 = int(clipped[:, 2].max()), int(clipped[:, 3].max())
+        if x1 <= x0 or y1 <= y0:
+            return
+        direct_cost = float(areas.sum()) + LINEART_HIST_WINDOW_OVERHEAD * len(boxes)
+        if direct_cost < LINEART_HIST_TABLE_COST * (x1 - x0) * (y1 - y0):
+            return
+        table = np.zeros((y1 - y0 + 1, x1 - x0 + 1, self.bins), dtype=np.float32)
+        sel = self.sel[y0:y1, x0:x1]
+        ys, xs = np.nonzero(sel)
+        if ys.size:
+            idx = angle_bin_index(self.ang[y0:y1, x0:x1][sel], self.bins)
+            weights = self.mag[y0:y1, x0:x1][sel]
+            table[ys + 1, xs + 1, idx] = weights
+            np.cumsum(table, axis=0, out=table)
+            np.cumsum(table, axis=1, out=table)
+            # a non-empty bin holds at least one whole magnitude; float32 cancellation
+            # noise of the prefix sums stays far below that
+            self.noise = 0.5 * float(weights.min())
+        self.table = table
+        self.origin = (x0, y0)
+
+    def window(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        """Normalised histogram of the window (zeros when it has no edge energy)."""
+        x0, y0, x1, y1 = self._clip(x, y, w, h)
+        if x1 <= x0 or y1 <= y0:
+            return np.zeros((self.bins,), dtype=np.float32)
+        t = self.table
+        ox, oy = self.origin
+        if t is not None and ox <= x0 and oy <= y0 and x1 - ox < t.shape[1] and y1 - oy < t.shape[0]:
+            tx0, ty0, tx1, ty1 = x0 - ox, y0 - oy, x1 - ox, y1 - oy
+            hist = t[ty1, tx1] - t[ty0, tx1] - t[ty1, tx0] + t[ty0, tx0]
+            hist[hist < self.noise] = 0.0
+        else:
+            sel = self.sel[y0:y1, x0:x1]
+            hist = np.bincount(
+                angle_bin_index(self.ang[y0:y1, x0:x1][sel], self.bins),
+                weights=self.mag[y0:y1, x0:x1][sel],
+                minlength=self.bins,
+            ).astype(np.float32)
+        norm = float(np.linalg.norm(hist))
+        if norm > 1e-6:
+            hist /= norm
+        return hist
 
 
 def _cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
@@ -82,21 +249,102 @@ def _chamfer_score(dist_patch: np.ndarray, template_edge: np.ndarray) -> float:
     return float(1.0 / (1.0 + mean_dist))
 
 
-def _match_template_with_optional_mask(
+def _response_with_optional_mask(
     roi_edge: np.ndarray, tpl_edge: np.ndarray, tpl_mask: Optional[np.ndarray]
-) -> Tuple[float, Tuple[int, int]]:
+) -> np.ndarray:
     if tpl_mask is not None and tpl_mask.shape == tpl_edge.shape and int(np.count_nonzero(tpl_mask)) > 0:
         try:
-            res = cv2.matchTemplate(
-                roi_edge, tpl_edge, cv2.TM_CCORR_NORMED, mask=tpl_mask
-            )
-            _min_val, max_val, _min_loc, max_loc = cv2.minMaxLoc(res)
-            return float(max_val), max_loc
+            return cv2.matchTemplate(roi_edge, tpl_edge, cv2.TM_CCORR_NORMED, mask=tpl_mask)
         except cv2.error:
             pass
-    res = cv2.matchTemplate(roi_edge, tpl_edge, cv2.TM_CCOEFF_NORMED)
-    _min_val, max_val, _min_loc, max_loc = cv2.minMaxLoc(res)
-    return float(max_val), max_loc
+    return cv2.matchTemplate(roi_edge, tpl_edge, cv2.TM_CCOEFF_NORMED)
+
+
+def _masked_energy_valid(
+    roi_edge: np.ndarray, tpl_edge: np.ndarray, tpl_mask: Optional[np.ndarray]
+) -> Optional[np.ndarray]:
+    """Windows with image energy under the template mask (None when unmasked)."""
+    if tpl_mask is None or tpl_mask.shape != tpl_edge.shape or int(np.count_nonzero(tpl_mask)) == 0:
+        return None
+    # masked TM_CCORR_NORMED divides by the image energy under the mask; windows
+    # without any are 0/0 and come back as nan, inf or rounding noise
+    support = (tpl_mask > 0).astype(np.float32)
+    return cv2.matchTemplate((roi_edge > 0).astype(np.float32), support, cv2.TM_CCORR) >= 0.5
+
+
+def _response_peaks(
+    roi_edge: np.ndarray,
+    tpl_edge: np.ndarray,
+    tpl_mask: Optional[np.ndarray],
+    max_peaks: int,
+    checked: Optional[bool] = None,
+) -> List[Tuple[float, Tuple[int, int]]]:
+    # checked (default: max_peaks > 1) drops invalid responses; otherwise
+    # a single peak is the raw cv2.minMaxLoc maximum
+    if checked is None:
+        checked = max_peaks > 1
+    res = _response_with_optional_mask(roi_edge, tpl_edge, tpl_mask)
+    valid = None
+    if checked:
+        valid = _masked_energy_valid(roi_edge, tpl_edge, tpl_mask)
+        if valid is None:
+            valid = np.ones(res.shape, dtype=bool)
+    return find_response_peaks(res, max_peaks, _peak_distance(tpl_edge), valid)
+
+
+def find_response_peaks(
+    response: np.ndarray,
+    max_peaks: int,
+    min_distance: int,
+    valid: Optional[np.ndarray] = None,
+) -> List[Tuple[float, Tuple[int, int]]]:
+    """Top local maxima of a response map, best first.
+
+    Local maxima are found with a (2*min_distance-1)^2 dilation, then picked
+    greedily by score; a peak closer than min_distance (Chebyshev) to an
+    already picked one is suppressed. Responses outside [0, 1 + RESPONSE_EPS]
+    (nan, inf, degenerate normalizations) and windows outside the optional
+    valid mask are dropped, so every score is in [0, 1]; the result may be
+    empty. max_peaks <= 1 without a valid mask is the plain global maximum
+    (cv2.minMaxLoc).
+    """
+    if max_peaks <= 1 and valid is None:
+        _min_val, max_val, _min_loc, max_loc = cv2.minMaxLoc(response)
+        return [(float(max_val), max_loc)]
+    radius = max(1, int(min_distance))
+    keep = np.isfinite(response) & (response >= 0.0) & (response <= 1.0 + RESPONSE_EPS)
+    if valid is not None:
+        keep &= valid
+    resp = np.where(keep, np.minimum(response, 1.0), -np.inf).astype(np.float32)
+    kernel = np.ones((2 * radius - 1, 2 * radius - 1), dtype=np.uint8)
+    dilated = cv2.dilate(resp, kernel)
+    ys, xs = np.nonzero((resp >= dilated) & keep)
+    if ys.size == 0:
+        return []
+    scores = resp[ys, xs]
+    # stable: equal scores keep raster order, so on a clean map the first peak is minMaxLoc's
+    order = np.argsort(-scores, kind="stable")
+    picked_x: List[int] = []
+    picked_y: List[int] = []
+    peaks: List[Tuple[float, Tuple[int, int]]] = []
+    for i in order:
+        px, py = int(xs[i]), int(ys[i])
+        if picked_x and (
+            np.min(np.maximum(np.abs(np.array(picked_x) - px), np.abs(np.array(picked_y) - py)))
+            < radius
+        ):
+            continue
+        picked_x.append(px)
+        picked_y.append(py)
+        peaks.append((float(scores[i]), (px, py)))
+        if len(peaks) >= max_peaks:
+            break
+    return peaks
+
+
+def _peak_distance(template: np.ndarray) -> int:
+    # peaks closer than half the template size belong to the same instance
+    return max(1, min(template.shape[:2]) // 2)
 
 
 @dataclass(frozen=True)
@@ -112,35 +360,12 @@ class MatchResult:
     shape_ratio: float = 0.0
 
 
-def _trim_template_margin(template: np.ndarray) -> np.ndarray:
-    """Trim zero-value outer margins from a processed template image."""
-    if template is None or template.size == 0:
-        return template
-    ys, xs = np.where(template > 0)
+def _nonzero_bounds(binary: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    ys, xs = np.where(binary)
     if ys.size == 0 or xs.size == 0:
-        return template
-    y0, y1 = ys.min(), ys.max() + 1
-    x0, x1 = xs.min(), xs.max() + 1
-    trimmed = template[y0:y1, x0:x1]
-    return trimmed if trimmed.size > 0 else template
-
-
-def _trim_template_pair(template: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
-    if (
-        template is None
-        or mask is None
-        or template.size == 0
-        or mask.size == 0
-        or template.shape != mask.shape
-    ):
-        return template, mask
-    combined = (template > 0) | (mask > 0)
-    ys, xs = np.where(combined)
-    if ys.size == 0 or xs.size == 0:
-        return template, mask
-    y0, y1 = ys.min(), ys.max() + 1
-    x0, x1 = xs.min(), xs.max() + 1
-    return template[y0:y1, x0:x1], mask[y0:y1, x0:x1]
+        return None
+    x0, y0 = int(xs.min()), int(ys.min())
+    return x0, y0, int(xs.max()) + 1 - x0, int(ys.max()) + 1 - y0
 
 
 def _foreground_match_ratio(template_proc: np.ndarray, patch_proc: np.ndarray) -> float:
@@ -186,54 +411,522 @@ def clip_roi(
     return _clip_roi(x, y, roi_size, width, height)
 
 
-def _iter_scaled_templates(
-    template: np.ndarray,
-    scale_min: float,
-    scale_max: float,
-    scale_steps: int,
-) -> Iterable[Tuple[float, np.ndarray]]:
+def _iter_scales(scale_min: float, scale_max: float, scale_steps: int) -> Iterable[float]:
     if scale_steps <= 1:
-        yield 1.0, template
+        yield 1.0
         return
-    scales = np.linspace(scale_min, scale_max, scale_steps)
-    for scale in scales:
+    for scale in np.linspace(scale_min, scale_max, scale_steps):
         if scale <= 0:
             continue
-        h, w = template.shape[:2]
-        new_w = max(1, int(round(w * scale)))
-        new_h = max(1, int(round(h * scale)))
-        resized = cv2.resize(template, (new_w, new_h), interpolation=cv2.INTER_AREA)
-        yield float(scale), resized
+        yield float(scale)
+
+
+def _resize_to_scale(template: np.ndarray, scale: float, interpolation: int) -> np.ndarray:
+    h, w = template.shape[:2]
+    new_w = max(1, int(round(w * scale)))
+    new_h = max(1, int(round(h * scale)))
+    if new_w == w and new_h == h:
+        return template
+    return cv2.resize(template, (new_w, new_h), interpolation=interpolation)
 
 
-@dataclass
-class _LineArtCandidate:
+def _line_variant_key(
+    tpl: TemplateImage, variant: TemplateVariant, scale: float, trim: bool
+) -> Tuple:
+    return (str(tpl.path), tpl.generation, "line", variant.rotation_deg, round(scale, 6), bool(trim))
+
+
+def _scaled_line_variant(
+    tpl: TemplateImage, variant: TemplateVariant, scale: float, trim: bool
+) -> ScaledTemplate:
+    def build() -> ScaledTemplate:
+        edge = _resize_to_scale(binary_map(variant.edge), scale, cv2.INTER_AREA)
+        mask = cv2.resize(
+            binary_map(variant.mask), (edge.shape[1], edge.shape[0]), interpolation=cv2.INTER_NEAREST
+        )
+        bounds = (0, 0, edge.shape[1], edge.shape[0])
+        if trim:
+            trimmed = _nonzero_bounds((edge > 0) | (mask > 0))
+            if trimmed is not None:
+                bx, by, bw, bh = trimmed
+                edge = edge[by : by + bh, bx : bx + bw]
+                mask = mask[by : by + bh, bx : bx + bw]
+                bounds = trimmed
+        return ScaledTemplate(
+            scale=scale,
+            edge=edge,
+            mask=mask,
+            bounds=bounds,
+            fg_count=int(np.count_nonzero(edge)),
+        )
+
+    return get_template_bank().get(_line_variant_key(tpl, variant, scale, trim), build)
+
+
+def _processed_key(tpl: TemplateImage, kind: str, scale: float, trim: bool) -> Tuple:
+    return (str(tpl.path), tpl.generation, kind, 0, round(scale, 6), bool(trim))
+
+
+def _scaled_processed(tpl: TemplateImage, kind: str, scale: float, trim: bool) -> ScaledTemplate:
+    def build() -> ScaledTemplate:
+        source = binary_map(tpl.image_proc_edge if kind == "edge" else tpl.image_proc_bin)
+        scaled = _resize_to_scale(source, scale, cv2.INTER_AREA)
+        bounds = (0, 0, scaled.shape[1], scaled.shape[0])
+        if trim:
+            trimmed = _nonzero_bounds(scaled > 0)
+            if trimmed is not None:
+                bx, by, bw, bh = trimmed
+                scaled = scaled[by : by + bh, bx : bx + bw]
+                bounds = trimmed
+        return ScaledTemplate(
+            scale=scale,
+            edge=scaled,
+            mask=None,
+            bounds=bounds,
+            fg_count=int(np.count_nonzero(scaled)),
+        )
+
+    return get_template_bank().get(_processed_key(tpl, kind, scale, trim), build)
+
+
+@dataclass(frozen=True)
+class _MatchJob:
+    """One template/variant/scale to correlate against the ROI."""
+
     class_name: str
-    template_name: str
-    scale: float
-    mode: str
-    score_stage1: float
-    shape_ratio: float
-    bbox: Tuple[int, int, int, int]
-    outer_bbox: Tuple[int, int, int, int]
-    tight_bbox: Tuple[int, int, int, int]
-    tpl_edge_scaled: np.ndarray
-    tpl_hist: np.ndarray
-    score_chamfer: float = 0.0
-    score_hist: float = 0.0
-    score_final: float = 0.0
+    tpl: TemplateImage
+    variant: Optional[TemplateVariant]  # None for the plain edge/bin path
+    scaled: ScaledTemplate
+    key: Tuple
+    group: int  # jobs sharing a template (and variant) differ only by scale
+
+    @property
+    def geometry(self) -> object:
+        return self.variant if self.variant is not None else self.tpl
+
+
+def _downsample_map(image: np.ndarray, factor: int) -> np.ndarray:
+    h, w = image.shape[:2]
+    return cv2.resize(
+        image,
+        (max(1, w // factor), max(1, h // factor)),
+        interpolation=cv2.INTER_AREA,
+    )
+
+
+def _coarse_template(job: _MatchJob, factor: int) -> ScaledTemplate:
+    def build() -> ScaledTemplate:
+        edge = _downsample_map(job.scaled.edge, factor)
+        mask = None
+        if job.scaled.mask is not None:
+            mask = cv2.resize(
+                job.scaled.mask,
+                (edge.shape[1], edge.shape[0]),
+                interpolation=cv2.INTER_NEAREST,
+            )
+        return ScaledTemplate(
+            scale=job.scaled.scale,
+            edge=edge,
+            mask=mask,
+            bounds=(0, 0, edge.shape[1], edge.shape[0]),
+            fg_count=int(np.count_nonzero(edge)),
+        )
+
+    return get_template_bank().get(job.key + ("pyramid", factor), build)
+
+
+def _refine_in_window(
+    roi_proc: np.ndarray,
+    scaled: ScaledTemplate,
+    x: int,
+    y: int,
+    margin: int,
+    checked: bool = False,
+) -> List[Tuple[float, Tuple[int, int]]]:
+    th, tw = scaled.edge.shape[:2]
+    wx0 = max(0, min(x - margin, roi_proc.shape[1] - tw))
+    wy0 = max(0, min(y - margin, roi_proc.shape[0] - th))
+    wx1 = max(wx0, min(roi_proc.shape[1] - tw, x + margin))
+    wy1 = max(wy0, min(roi_proc.shape[0] - th, y + margin))
+    window = roi_proc[wy0 : wy1 + th, wx0 : wx1 + tw]
+    return [
+        (score, (loc[0] + wx0, loc[1] + wy0))
+        for score, loc in _response_peaks(window, scaled.edge, scaled.mask, 1, checked)
+    ]
+
+
+def _locate_pyramid(
+    roi_proc: np.ndarray, jobs: List[_MatchJob], workers: int = 1, peaks_per_map: int = 1
+) -> List[List[Tuple[float, Tuple[int, int]]]]:
+    """Coarse-to-fine search: correlate downsampled maps, refine the best scales locally."""
+    factor = PYRAMID_DOWNSCALE
+    roi_coarse = _downsample_map(roi_proc, factor)
+    coarse_templates = [_coarse_template(job, factor) for job in jobs]
+
+    def coarse_match(coarse: ScaledTemplate) -> Optional[List[Tuple[float, Tuple[int, int]]]]:
+        ch, cw = coarse.edge.shape[:2]
+        if (
+            min(ch, cw) < PYRAMID_MIN_TEMPLATE
+            or ch > roi_coarse.shape[0]
+            or cw > roi_coarse.shape[1]
+            or coarse.fg_count == 0
+        ):
+            return None
+        return _response_peaks(roi_coarse, coarse.edge, coarse.mask, peaks_per_map)
+
+    coarse_hits = _map_ordered(coarse_match, coarse_templates, workers)
+
+    # keep the best coarse scales of every template/variant; tiny templates stay exhaustive
+    by_group: Dict[int, List[int]] = {}
+    for idx, hits in enumerate(coarse_hits):
+        if hits:
+            by_group.setdefault(jobs[idx].group, []).append(idx)
+    selected = set()
+    for indices in by_group.values():
+        ranked = sorted(indices, key=lambda i: -_finite_score(coarse_hits[i][0][0]))
+        selected.update(ranked[:PYRAMID_REFINE_SCALES])
+
+    margin = factor * PYRAMID_REFINE_MARGIN
+
+    def refine(idx: int) -> List[Tuple[float, Tuple[int, int]]]:
+        job = jobs[idx]
+        hits = coarse_hits[idx]
+        if hits is None:
+            return _response_peaks(roi_proc, job.scaled.edge, job.scaled.mask, peaks_per_map)
+        if idx not in selected:
+            return []
+        return [
+            hit
+            for _score, (cx, cy) in hits
+            for hit in _refine_in_window(
+                roi_proc, job.scaled, cx * factor, cy * factor, margin, peaks_per_map > 1
+            )
+        ]
+
+    return _map_ordered(refine, range(len(jobs)), workers)
+
+
+def _finite_score(score: float) -> float:
+    return score if np.isfinite(score) else -1.0
+
+
+def _fft_axis_blocks(extent: int, kernel_extent: int) -> List[Tuple[int, int]]:
+    """(block, tile count) candidates along one axis; the last one is a single block."""
+    outputs = extent - kernel_extent + 1
+    full = cv2.getOptimalDFTSize(extent)
+    blocks: List[Tuple[int, int]] = []
+    size = FFT_MIN_BLOCK
+    while size < full:
+        step = size - kernel_extent + 1
+        if step > 0:
+            blocks.append((size, -(-outputs // step)))
+        size *= 2
+    blocks.append((full, 1))
+    return blocks
+
+
+def _fft_layout(
+    roi_shape: Tuple[int, int], kernel_shape: Tuple[int, int]
+) -> Tuple[int, int, int, int]:
+    """Overlap-save DFT block and tile counts (bh, bw, ny, nx) for a kernel.
+
+    pocketfft costs about the same per sample at every size, so the cost is
+    the transformed samples: the inverse transform of every tile plus the
+    kernel's own forward transform. A block >= the ROI extent is one tile.
+    """
+    best: Optional[Tuple[int, Tuple[int, int, int, int]]] = None
+    for bh, ny in _fft_axis_blocks(roi_shape[0], kernel_shape[0]):
+        for bw, nx in _fft_axis_blocks(roi_shape[1], kernel_shape[1]):
+            cost = (ny * nx + 1) * bh * bw
+            if best is None or cost < best[0]:
+                best = (cost, (bh, bw, ny, nx))
+    assert best is not None
+    return best[1]
+
+
+class _FFTCorrelator:
+    """Frequency-domain correlation of many templates against one ROI.
+
+    Overlap-save: every kernel gets a DFT block size and tile count from
+    _fft_layout, so small templates are not padded to the ROI's DFT size.
+    Kernels with the same layout form a group; the group's ROI tiles are
+    transformed once and its kernels go through stacked rfft2/irfft2 batches
+    (bounded by FFT_BATCH_MAX_BYTES). Inputs are integer-valued, so
+    correlations are rounded back to exact sums.
+    """
+
+    def __init__(self, roi: np.ndarray) -> None:
+        self.roi_h, self.roi_w = roi.shape[:2]
+        self._roi = roi.astype(np.float64)
+        self._roi_sq: Optional[np.ndarray] = None
+        self._tiles: Dict[Tuple[bool, int, int, int, int], np.ndarray] = {}
+
+    def _tile_spectra(
+        self, squared: bool, block: Tuple[int, int], step: Tuple[int, int], count: Tuple[int, int]
+    ) -> np.ndarray:
+        """Spectra (ny, nx, bh, bw//2+1) of the ROI tiles at the given step."""
+        key = (squared, block[0], block[1], step[0], step[1])
+        spec = self._tiles.get(key)
+        if spec is None:
+            if squared:
+                if self._roi_sq is None:
+                    self._roi_sq = self._roi * self._roi
+                src = self._roi_sq
+            else:
+                src = self._roi
+            (bh, bw), (sy, sx), (ny, nx) = block, step, count
+            padded = np.zeros(((ny - 1) * sy + bh, (nx - 1) * sx + bw), dtype=np.float64)
+            h, w = min(self.roi_h, padded.shape[0]), min(self.roi_w, padded.shape[1])
+            padded[:h, :w] = src[:h, :w]
+            tiles = np.lib.stride_tricks.sliding_window_view(padded, (bh, bw))[::sy, ::sx]
+            spec = np.fft.rfft2(tiles)
+            self._tiles[key] = spec
+        return spec
+
+    def correlate(
+        self, kernels: List[np.ndarray], squared: bool = False
+    ) -> Iterator[Tuple[int, np.ndarray]]:
+        """Valid-mode cross-correlation of the ROI (or its square) with each kernel.
+
+        Yields (kernel index, map) one batch at a time, grouped by tile layout;
+        the order only depends on the kernel shapes.
+        """
+        groups: Dict[Tuple[int, int, int, int], List[int]] = {}
+        for i, kernel in enumerate(kernels):
+            layout = _fft_layout((self.roi_h, self.roi_w), kernel.shape[:2])
+            groups.setdefault(layout, []).append(i)
+
+        for (bh, bw, ny, nx), members in groups.items():
+            # kernels of a group share the tile step of the largest one; a single
+            # block covers the whole axis
+            sy = bh if ny == 1 else bh - max(kernels[i].shape[0] for i in members) + 1
+            sx = bw if nx == 1 else bw - max(kernels[i].shape[1] for i in members) + 1
+            ny = -(-(self.roi_h - min(kernels[i].shape[0] for i in members) + 1) // sy)
+            nx = -(-(self.roi_w - min(kernels[i].shape[1] for i in members) + 1) // sx)
+            spec = self._tile_spectra(squared, (bh, bw), (sy, sx), (ny, nx))
+
+            # spectrum product, inverse transform and the reassembled maps
+            per_kernel = ny * nx * bh * bw * 8 * 4
+            batch_size = max(1, int(FFT_BATCH_MAX_BYTES // per_kernel))
+            for start in range(0, len(members), batch_size):
+                batch = members[start : start + batch_size]
+                stack = np.zeros((len(batch), bh, bw), dtype=np.float64)
+                for j, i in enumerate(batch):
+                    stack[j, : kernels[i].shape[0], : kernels[i].shape[1]] = kernels[i]
+                kspec = np.fft.rfft2(stack)
+                np.conjugate(kspec, out=kspec)
+                prod = spec[None] * kspec[:, None, None]
+                corr = np.fft.irfft2(prod, s=(bh, bw))[..., :sy, :sx]
+                corr = corr.transpose(0, 1, 3, 2, 4).reshape(len(batch), ny * sy, nx * sx)
+                np.rint(corr, out=corr)
+                for j, i in enumerate(batch):
+                    kh, kw = kernels[i].shape[:2]
+                    yield i, corr[j, : self.roi_h - kh + 1, : self.roi_w - kw + 1]
+
+
+def _binary_level(image: np.ndarray) -> Optional[int]:
+    """v when every pixel of a uint8 map is 0 or v (1 for an empty map), else None."""
+    if image.dtype != np.uint8:
+        return None
+    levels = np.flatnonzero(np.bincount(image.ravel(), minlength=256)[1:]) + 1
+    if levels.size > 1:
+        return None
+    return int(levels[0]) if levels.size else 1
+
+
+def _masked_responses(
+    fft: _FFTCorrelator, roi_proc: np.ndarray, jobs: List[_MatchJob], with_valid: bool
+) -> Iterator[Tuple[int, np.ndarray, Optional[np.ndarray]]]:
+    """(job index, masked TM_CCORR_NORMED map, windows with image energy) in correlator order.
+
+    sum(T*M*I) / (||T*M|| * sqrt(sum(M*I^2))). On a 0/v ROI, I^2 = v*I, so
+    both sums come from one correlation with K + C*M, where K is T*M (divided
+    by t when the template is 0/t) and C = sum(K) + 1: the quotient by v*C
+    counts the masked image pixels and the remainder is v*sum(K*I/v), which
+    normalized by ||K|| gives the same score. Non-binary ROIs, and kernels
+    whose packed sums could lose integer precision, take two passes.
+    """
+    masks = [(job.scaled.mask > 0).astype(np.float64) for job in jobs]
+    kernels = [job.scaled.edge.astype(np.float64) * m for job, m in zip(jobs, masks)]
+    level = _binary_level(roi_proc)
+    packed: List[int] = []
+    separate: List[int] = []
+    units: Dict[int, np.ndarray] = {}
+    for i, (job, kernel, mask) in enumerate(zip(jobs, kernels, masks)):
+        unit = kernel / (_binary_level(job.scaled.edge) or 1)
+        if level is not None and level * (np.sum(unit) + 1.0) * (np.sum(mask) + 1.0) < FFT_PACKED_MAX:
+            packed.append(i)
+            units[i] = unit
+        else:
+            separate.append(i)
+
+    def normalized(num: np.ndarray, denom: np.ndarray) -> np.ndarray:
+        # windows without any image energy score 0 instead of inf/nan
+        res = np.zeros(num.shape, dtype=np.float32)
+        np.divide(num, denom, out=res, where=denom > 0)
+        return res
+
+    if packed:
+        scales = [float(np.sum(units[i])) + 1.0 for i in packed]
+        stacked = [units[i] + c * masks[i] for i, c in zip(packed, scales)]
+        for k, corr in fft.correlate(stacked):
+            i = packed[k]
+            # exact: the packed sums stay far below 2**53
+            count = corr / (level * scales[k])
+            np.floor(count, out=count)
+            num = count * (level * scales[k])
+            np.subtract(corr, num, out=num)
+            valid = count > 0 if with_valid else None
+            np.sqrt(count, out=count)
+            count *= level * float(np.sqrt(np.sum(units[i] * units[i])))
+            yield i, normalized(num, count), valid
+    if separate:
+        # both passes see the same shapes, so they yield in the same order
+        pairs = zip(
+            fft.correlate([kernels[i] for i in separate]),
+            fft.correlate([masks[i] for i in separate], squared=True),
+        )
+        for (k, num), (_k, img_norm) in pairs:
+            i = separate[k]
+            # img_norm sums integer squares; below 0.5 the window is empty
+            valid = img_norm >= 0.5 if with_valid else None
+            denom = np.sqrt(img_norm)
+            denom *= float(np.sqrt(np.sum(kernels[i] * kernels[i])))
+            yield i, normalized(num, denom), valid
+
+
+def _locate_fft(
+    roi_proc: np.ndarray, jobs: List[_MatchJob], peaks_per_map: int = 1
+) -> List[List[Tuple[float, Tuple[int, int]]]]:
+    if not jobs:
+        return []
+    fft = _FFTCorrelator(roi_proc)
+    masked: List[int] = []
+    plain: List[int] = []
+    for idx, job in enumerate(jobs):
+        mask = job.scaled.mask
+        if mask is not None and mask.shape == job.scaled.edge.shape and np.count_nonzero(mask) > 0:
+            masked.append(idx)
+        else:
+            plain.append(idx)
+
+    # cv2's unmasked TM_CCOEFF_NORMED is faster than a NumPy FFT pass at every
+    # template size; masked maps are reduced to peaks as the correlator yields them
+    hits: Dict[int, List[Tuple[float, Tuple[int, int]]]] = {}
+    for idx in plain:
+        scaled = jobs[idx].scaled
+        hits[idx] = _response_peaks(roi_proc, scaled.edge, scaled.mask, peaks_per_map)
+    if masked:
+        responses = _masked_responses(fft, roi_proc, [jobs[i] for i in masked], peaks_per_map > 1)
+        for k, res, valid in responses:
+            idx = masked[k]
+            hits[idx] = find_response_peaks(
+                res, peaks_per_map, _peak_distance(jobs[idx].scaled.edge), valid
+            )
+
+    return [hits[idx] for idx in range(len(jobs))]
+
+
+def _locate_jobs(
+    roi_proc: np.ndarray,
+    jobs: List[_MatchJob],
+    search_mode: str,
+    correlation_backend: str = "spatial",
+    workers: int = 1,
+    peaks_per_map: int = 1,
+) -> List[List[Tuple[float, Tuple[int, int]]]]:
+    """Hits (score, top-left) of every job, best first; at most peaks_per_map each."""
+    if search_mode == "pyramid":
+        return _locate_pyramid(roi_proc, jobs, workers, peaks_per_map)
+    if correlation_backend == "fft":
+        return _locate_fft(roi_proc, jobs, peaks_per_map)
+
+    def locate(job: _MatchJob) -> List[Tuple[float, Tuple[int, int]]]:
+        return _response_peaks(roi_proc, job.scaled.edge, job.scaled.mask, peaks_per_map)
+
+    return _map_ordered(locate, jobs, workers)
+
+
+# columnar stage-1 candidates of the line-art path; "job" indexes the _MatchJob list
+_CANDIDATE_DTYPE = np.dtype(
+    [
+        ("job", np.int32),
+        ("score_stage1", np.float64),
+        ("shape_ratio", np.float64),
+        ("score_chamfer", np.float64),
+        ("score_hist", np.float64),
+        ("score_final", np.float64),
+        ("bbox", np.int32, (4,)),
+        ("outer_bbox", np.int32, (4,)),
+    ]
+)
+
+
+def _descending_order(scores: np.ndarray) -> np.ndarray:
+    """Stable descending order, identical to list.sort(key=..., reverse=True)."""
+    if np.isnan(scores).any():
+        # NaN keys make list.sort order depend on the merge sequence; keep it exact
+        return np.array(
+            sorted(range(len(scores)), key=lambda i: scores[i], reverse=True), dtype=np.intp
+        )
+    return np.argsort(-scores, kind="stable")
+
+
+def _hist_tie_break_order(cands: np.ndarray) -> np.ndarray:
+    """Order after the near-tie swap pass on candidates sorted by score_final.
+
+    Adjacent candidates whose final scores differ by at most LINEART_TIE_EPS
+    and whose boxes overlap (IoU >= 0.3) are swapped while the lower one has
+    the better orientation-histogram score, repeated until stable. On
+    descending scores swaps only happen inside runs of close neighbours and
+    never move an element across a run boundary, so each run is settled on
+    its own. NaN scores leave the list unordered (see _descending_order), so
+    then the whole list is passed over as one run, exactly as before.
+    """
+    order = np.arange(len(cands))
+    if len(cands) < 2:
+        return order
+    scores = cands["score_final"]
+    if np.isnan(scores).any():
+        close = np.ones(len(cands) - 1, dtype=bool)
+    else:
+        with np.errstate(invalid="ignore"):  # inf - inf
+            close = ~(np.abs(scores[:-1] - scores[1:]) > LINEART_TIE_EPS)
+    if not np.any(close):
+        return order
+    boxes = cands["bbox"]
+    hists = cands["score_hist"]
+    # start/end of every run of close neighbours
+    edges = np.diff(np.concatenate(([0], close.astype(np.int8), [0])))
+    for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+        run = list(range(int(start), int(end) + 1))
+        swapped = True
+        while swapped:
+            swapped = False
+            for i in range(len(run) - 1):
+                a, b = run[i], run[i + 1]
+                if abs(float(scores[a]) - float(scores[b])) > LINEART_TIE_EPS:
+                    continue
+                if compute_iou(tuple(boxes[a]), tuple(boxes[b])) < 0.30:
+                    continue
+                if hists[b] > hists[a] + 1e-6:
+                    run[i], run[i + 1] = b, a
+                    swapped = True
+        order[start : end + 1] = run
+    return order
 
 
 def _build_template_variants(tpl: TemplateImage) -> List[TemplateVariant]:
     if tpl.line_variants:
         return list(tpl.line_variants)
-    h, w = tpl.image_proc_edge.shape[:2]
+    edge = binary_map(tpl.image_proc_edge)
+    h, w = edge.shape[:2]
     zero_hist = tuple(0.0 for _ in range(LINEART_HIST_BINS))
     return [
         TemplateVariant(
             rotation_deg=0,
-            edge=tpl.image_proc_edge,
-            mask=np.where(tpl.image_proc_edge > 0, 255, 0).astype(np.uint8),
+            edge=edge,
+            mask=np.where(edge > 0, 255, 0).astype(np.uint8),
             angle_hist=zero_hist,
             tight_bbox=(0, 0, w, h),
             outer_bbox=(0, 0, w, h),
@@ -252,135 +945,159 @@ def _match_templates_line_art(
     scale_steps: int,
     trim_template_margin: bool,
     rerank_topk: int,
+    search_mode: str,
+    correlation_backend: str,
+    workers: int,
+    features: Optional["ImageFeatures | FeatureWindow"],
+    peaks_per_map: int,
+    hist_prefilter: float,
+    stats: Optional[Dict[str, object]],
 ) -> List[MatchResult]:
-    image_gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
-    height, width = image_gray.shape[:2]
-    x0, y0, x1, y1 = _clip_roi(x, y, roi_size, width, height)
-    roi = image_gray[y0:y1, x0:x1]
-    if roi.size == 0:
+    loaded = _roi_features(image_bgr, features, x, y, roi_size, gradients=True)
+    if loaded is None:
         return []
-
-    roi_bin = preprocess_binary_inv(roi)
-    roi_edge = preprocess_edge(roi)
+    x0, y0, roi_features = loaded
+    roi_edge = roi_features.edge
     if int(np.count_nonzero(roi_edge)) == 0:
         return []
 
+    # nearest-edge distances depend on the ROI extent, so they stay ROI-local
     dist_src = np.where(roi_edge > 0, 0, 255).astype(np.uint8)
     roi_dist = cv2.distanceTransform(dist_src, cv2.DIST_L2, 3)
-    roi_bin_f = roi_bin.astype(np.float32)
-    gx = cv2.Sobel(roi_bin_f, cv2.CV_32F, 1, 0, ksize=3)
-    gy = cv2.Sobel(roi_bin_f, cv2.CV_32F, 0, 1, ksize=3)
-    roi_mag = cv2.magnitude(gx, gy)
-    roi_ang = np.mod(cv2.phase(gx, gy, angleInDegrees=True), 180.0)
+    roi_mag = roi_features.mag
+    roi_ang = roi_features.ang
+    hist_windows = _AngleHistWindows(roi_ang, roi_mag, roi_edge)
+    roi_hist = None
+    if hist_prefilter > 0:
+        roi_hist = hist_windows.window(0, 0, roi_edge.shape[1], roi_edge.shape[0])
 
-    stage1: List[_LineArtCandidate] = []
+    prefilter = {
+        "threshold": float(hist_prefilter),
+        "variants_total": 0,
+        "variants_skipped": 0,
+        "classes_total": len(templates),
+        "classes_skipped": 0,
+    }
+    jobs: List[_MatchJob] = []
+    group = 0
     for class_name, template_list in templates.items():
+        class_kept = False
         for tpl in template_list:
             for variant in _build_template_variants(tpl):
-                tpl_hist = np.array(variant.angle_hist, dtype=np.float32)
-                for scale, scaled_edge in _iter_scaled_templates(
-                    variant.edge, scale_min, scale_max, scale_steps
-                ):
-                    scaled_mask = cv2.resize(
-                        variant.mask,
-                        (scaled_edge.shape[1], scaled_edge.shape[0]),
-                        interpolation=cv2.INTER_NEAREST,
-                    )
-                    if trim_template_margin:
-                        scaled_edge, scaled_mask = _trim_template_pair(
-                            scaled_edge, scaled_mask
-                        )
-                    th, tw = scaled_edge.shape[:2]
+                prefilter["variants_total"] += 1
+                if hist_prefilter > 0:
+                    # orientations absent from the whole ROI cannot match; empty hists never skip
+                    tpl_hist = np.array(variant.angle_hist, dtype=np.float32)
+                    if (
+                        float(np.linalg.norm(roi_hist)) > 1e-6
+                        and float(np.linalg.norm(tpl_hist)) > 1e-6
+                        and _cosine_sim(roi_hist, tpl_hist) < hist_prefilter
+                    ):
+                        prefilter["variants_skipped"] += 1
+                        group += 1
+                        continue
+                class_kept = True
+                for scale in _iter_scales(scale_min, scale_max, scale_steps):
+                    scaled = _scaled_line_variant(tpl, variant, scale, trim_template_margin)
+                    th, tw = scaled.edge.shape[:2]
                     if th > roi_edge.shape[0] or tw > roi_edge.shape[1]:
                         continue
-                    if np.count_nonzero(scaled_edge) < max(8, int(scaled_edge.size * 0.002)):
+                    if scaled.fg_count < max(8, int(scaled.edge.size * 0.002)):
                         continue
-                    score1, max_loc = _match_template_with_optional_mask(
-                        roi_edge, scaled_edge, scaled_mask
-                    )
-                    patch_edge = roi_edge[
-                        max_loc[1] : max_loc[1] + th, max_loc[0] : max_loc[0] + tw
-                    ]
-                    shape_ratio = _foreground_match_ratio(scaled_edge, patch_edge)
-                    tight_x = x0 + max_loc[0]
-                    tight_y = y0 + max_loc[1]
-                    tx, ty, _tw0, _th0 = variant.tight_bbox
-                    outer_x = int(round(tight_x - (tx * scale)))
-                    outer_y = int(round(tight_y - (ty * scale)))
-                    outer_w = int(round(variant.outer_bbox[2] * scale))
-                    outer_h = int(round(variant.outer_bbox[3] * scale))
-                    stage1.append(
-                        _LineArtCandidate(
+                    jobs.append(
+                        _MatchJob(
                             class_name=class_name,
-                            template_name=tpl.template_name,
-                            scale=scale,
-                            mode="edge",
-                            score_stage1=score1,
-                            shape_ratio=shape_ratio,
-                            bbox=(tight_x, tight_y, tw, th),
-                            outer_bbox=(outer_x, outer_y, outer_w, outer_h),
-                            tight_bbox=(tight_x, tight_y, tw, th),
-                            tpl_edge_scaled=scaled_edge,
-                            tpl_hist=tpl_hist,
+                            tpl=tpl,
+                            variant=variant,
+                            scaled=scaled,
+                            key=_line_variant_key(tpl, variant, scale, trim_template_margin),
+                            group=group,
                         )
                     )
+                group += 1
+        if template_list and not class_kept:
+            prefilter["classes_skipped"] += 1
+    prefilter["jobs"] = len(jobs)
+    if stats is not None:
+        stats["prefilter"] = prefilter
 
-    if not stage1:
+    hits = _locate_jobs(roi_edge, jobs, search_mode, correlation_backend, workers, peaks_per_map)
+    count = sum(len(job_hits) for job_hits in hits)
+    if count == 0:
         return []
 
-    stage1.sort(key=lambda c: c.score_stage1, reverse=True)
-    topn = max(1, min(rerank_topk, len(stage1)))
+    cands = np.zeros((count,), dtype=_CANDIDATE_DTYPE)
+    row = 0
+    for job_index, (job, job_hits) in enumerate(zip(jobs, hits)):
+        variant = job.variant
+        scale = job.scaled.scale
+        scaled_edge = job.scaled.edge
+        th, tw = scaled_edge.shape[:2]
+        tx, ty, _tw0, _th0 = variant.tight_bbox
+        outer_w = int(round(variant.outer_bbox[2] * scale))
+        outer_h = int(round(variant.outer_bbox[3] * scale))
+        for score1, max_loc in job_hits:
+            patch_edge = roi_edge[max_loc[1] : max_loc[1] + th, max_loc[0] : max_loc[0] + tw]
+            tight_x = x0 + max_loc[0]
+            tight_y = y0 + max_loc[1]
+            cand = cands[row]
+            cand["job"] = job_index
+            cand["score_stage1"] = score1
+            cand["shape_ratio"] = _foreground_match_ratio(scaled_edge, patch_edge)
+            cand["bbox"] = (tight_x, tight_y, tw, th)
+            cand["outer_bbox"] = (
+                int(round(tight_x - (tx * scale))),
+                int(round(tight_y - (ty * scale))),
+                outer_w,
+                outer_h,
+            )
+            row += 1
+
+    # stable descending order (equal scores keep job order, like list.sort(reverse=True))
+    cands = cands[_descending_order(cands["score_stage1"])]
+    # rerank_topk <= 0 reranks every stage-1 candidate
+    topn = count if rerank_topk <= 0 else max(1, min(rerank_topk, count))
+    hist_windows.prepare(cands["bbox"][:topn] - np.array([x0, y0, 0, 0], dtype=np.int32))
     for i in range(topn):
-        c = stage1[i]
-        bx, by, bw, bh = c.bbox
+        cand = cands[i]
+        scaled_edge = jobs[int(cand["job"])].scaled.edge
+        bx, by, bw, bh = (int(v) for v in cand["bbox"])
         rx = bx - x0
         ry = by - y0
         dist_patch = roi_dist[ry : ry + bh, rx : rx + bw]
-        edge_patch = roi_edge[ry : ry + bh, rx : rx + bw]
-        ang_patch = roi_ang[ry : ry + bh, rx : rx + bw]
-        mag_patch = roi_mag[ry : ry + bh, rx : rx + bw]
-        hist_patch = _angle_hist_from_window(ang_patch, mag_patch, edge_patch)
-        hist_sim = _cosine_sim(hist_patch, c.tpl_hist)
-        chamfer = _chamfer_score(dist_patch, c.tpl_edge_scaled)
-        c.score_chamfer = chamfer
-        c.score_hist = hist_sim
-        c.score_final = float(
-            0.60 * c.score_stage1 + 0.32 * chamfer + 0.08 * c.shape_ratio
-        )
+        hist_patch = hist_windows.window(rx, ry, bw, bh)
+        tpl_hist = np.array(jobs[int(cand["job"])].variant.angle_hist, dtype=np.float32)
+        cand["score_hist"] = _cosine_sim(hist_patch, tpl_hist)
+        cand["score_chamfer"] = _chamfer_score(dist_patch, scaled_edge)
 
-    for i in range(topn, len(stage1)):
-        c = stage1[i]
-        c.score_final = float(0.95 * c.score_stage1 + 0.05 * c.shape_ratio)
-
-    stage1.sort(key=lambda c: c.score_final, reverse=True)
-    swapped = True
-    while swapped:
-        swapped = False
-        for i in range(len(stage1) - 1):
-            a = stage1[i]
-            b = stage1[i + 1]
-            if abs(a.score_final - b.score_final) > LINEART_TIE_EPS:
-                continue
-            if compute_iou(a.bbox, b.bbox) < 0.30:
-                continue
-            if b.score_hist > a.score_hist + 1e-6:
-                stage1[i], stage1[i + 1] = b, a
-                swapped = True
+    head = cands[:topn]
+    head["score_final"] = (
+        0.60 * head["score_stage1"] + 0.32 * head["score_chamfer"] + 0.08 * head["shape_ratio"]
+    )
+    tail = cands[topn:]
+    tail["score_final"] = 0.95 * tail["score_stage1"] + 0.05 * tail["shape_ratio"]
 
-    return [
-        MatchResult(
-            class_name=c.class_name,
-            template_name=c.template_name,
-            score=float(c.score_final),
-            scale=float(c.scale),
-            bbox=c.bbox,
-            outer_bbox=c.outer_bbox,
-            tight_bbox=c.tight_bbox,
-            mode=c.mode,
-            shape_ratio=float(c.shape_ratio),
+    cands = cands[_descending_order(cands["score_final"])]
+    cands = cands[_hist_tie_break_order(cands)]
+
+    results: List[MatchResult] = []
+    for cand in cands:
+        job = jobs[int(cand["job"])]
+        bbox = tuple(int(v) for v in cand["bbox"])
+        results.append(
+            MatchResult(
+                class_name=job.class_name,
+                template_name=job.tpl.template_name,
+                score=float(cand["score_final"]),
+                scale=float(job.scaled.scale),
+                bbox=bbox,
+                outer_bbox=tuple(int(v) for v in cand["outer_bbox"]),
+                tight_bbox=bbox,
+                mode="edge",
+                shape_ratio=float(cand["shape_ratio"]),
+            )
         )
-        for c in stage1
-    ]
+    return results
 
 
 def match_templates(
@@ -395,8 +1112,35 @@ def match_templates(
     trim_template_margin: bool = False,
     line_art_enhanced: bool = False,
     rerank_topk: int = LINEART_TOPK_RERANK,
+    search_mode: str = "exhaustive",
+    correlation_backend: str = "spatial",
+    workers: int = 1,
+    features: Optional["ImageFeatures | FeatureWindow"] = None,
+    peaks_per_map: int = 1,
+    hist_prefilter: float = 0.0,
+    stats: Optional[Dict[str, object]] = None,
 ) -> List[MatchResult]:
-    if image_bgr is None:
+    """Match templates around (x, y).
+
+    search_mode: "exhaustive" correlates every template/scale over the full
+    ROI; "pyramid" correlates downsampled maps first and refines only the
+    best scales in small full-resolution windows.
+    correlation_backend: "spatial" runs cv2.matchTemplate per template;
+    "fft" correlates all templates of the ROI in batched NumPy FFT passes
+    (exhaustive search only).
+    workers: number of threads evaluating template/scale jobs (capped by
+    MATCH_THREAD_WORKERS); results are identical to the serial path.
+    features: optional per-image feature cache (feature_cache.ImageFeatures,
+    whose cached grayscale is preprocessed per ROI exactly as image_bgr would
+    be, or a FeatureWindow of precomputed tile maps, which are sliced);
+    image_bgr may then be None.
+    peaks_per_map: local maxima kept per template/scale response map (1 keeps
+    only the global maximum); >1 finds several instances in one pass.
+    hist_prefilter: line-art only; skip template variants whose orientation
+    histogram has cosine similarity below this with the ROI's (0 disables).
+    stats: optional dict filled with per-call statistics ("prefilter").
+    """
+    if image_bgr is None and features is None:
         return []
     if line_art_enhanced:
         return _match_templates_line_art(
@@ -410,104 +1154,81 @@ def match_templates(
             scale_steps=scale_steps,
             trim_template_margin=trim_template_margin,
             rerank_topk=rerank_topk,
+            search_mode=search_mode,
+            correlation_backend=correlation_backend,
+            workers=workers,
+            features=features,
+            peaks_per_map=peaks_per_map,
+            hist_prefilter=hist_prefilter,
+            stats=stats,
         )
-    image_gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
-    height, width = image_gray.shape[:2]
-    x0, y0, x1, y1 = _clip_roi(x, y, roi_size, width, height)
-    roi = image_gray[y0:y1, x0:x1]
-    if roi.size == 0:
+    loaded = _roi_features(image_bgr, features, x, y, roi_size, gradients=False)
+    if loaded is None:
         return []
-    roi_edge = preprocess_edge(roi)
-    roi_bin = preprocess_binary_inv(roi)
-    roi_proc = roi_edge
+    x0, y0, roi_features = loaded
+    roi_edge = roi_features.edge
+    roi_bin = roi_features.bin
 
+    # fallback to binary-inverted matching if edge matching yields nothing
     results: List[MatchResult] = []
-
-    for class_name, template_list in templates.items():
-        for tpl in template_list:
-            for scale, scaled in _iter_scaled_templates(
-                tpl.image_proc_edge, scale_min, scale_max, scale_steps
-            ):
-                if trim_template_margin:
-                    scaled = _trim_template_margin(scaled)
-                th, tw = scaled.shape[:2]
-                if th > roi_proc.shape[0] or tw > roi_proc.shape[1]:
-                    continue
-                if np.count_nonzero(scaled) < max(10, int(scaled.size * 0.002)):
-                    continue
-                res = cv2.matchTemplate(roi_proc, scaled, cv2.TM_CCOEFF_NORMED)
-                _min_val, max_val, _min_loc, max_loc = cv2.minMaxLoc(res)
-                tight_x = x0 + max_loc[0]
-                tight_y = y0 + max_loc[1]
-                patch = roi_proc[max_loc[1] : max_loc[1] + th, max_loc[0] : max_loc[0] + tw]
-                shape_ratio = _foreground_match_ratio(scaled, patch)
-                tx, ty, tw_tight, th_tight = tpl.tight_bbox
-                outer_x = int(round(tight_x - (tx * scale)))
-                outer_y = int(round(tight_y - (ty * scale)))
-                outer_w = int(round(tpl.outer_bbox[2] * scale))
-                outer_h = int(round(tpl.outer_bbox[3] * scale))
-                tight_w = tw
-                tight_h = th
-                results.append(
-                    MatchResult(
-                        class_name=class_name,
-                        template_name=tpl.template_name,
-                        score=float(max_val),
-                        scale=scale,
-                        bbox=(tight_x, tight_y, tight_w, tight_h),
-                        outer_bbox=(outer_x, outer_y, outer_w, outer_h),
-                        tight_bbox=(tight_x, tight_y, tight_w, tight_h),
-                        mode="edge",
-                        shape_ratio=shape_ratio,
+    for mode, roi_proc in (("edge", roi_edge), ("bin", roi_bin)):
+        jobs: List[_MatchJob] = []
+        group = 0
+        for class_name, template_list in templates.items():
+            for tpl in template_list:
+                for scale in _iter_scales(scale_min, scale_max, scale_steps):
+                    entry = _scaled_processed(tpl, mode, scale, trim_template_margin)
+                    th, tw = entry.edge.shape[:2]
+                    if th > roi_proc.shape[0] or tw > roi_proc.shape[1]:
+                        continue
+                    if entry.fg_count < max(10, int(entry.edge.size * 0.002)):
+                        continue
+                    jobs.append(
+                        _MatchJob(
+                            class_name=class_name,
+                            tpl=tpl,
+                            variant=None,
+                            scaled=entry,
+                            key=_processed_key(tpl, mode, scale, trim_template_margin),
+                            group=group,
+                        )
                     )
-                )
-
-    results.sort(key=lambda r: r.score, reverse=True)
-    if results:
-        return results
-
-    # fallback to binary-inverted matching if edge matching yields nothing
-    roi_proc = roi_bin
-    results = []
-    for class_name, template_list in templates.items():
-        for tpl in template_list:
-            for scale, scaled in _iter_scaled_templates(
-                tpl.image_proc_bin, scale_min, scale_max, scale_steps
-            ):
-                if trim_template_margin:
-                    scaled = _trim_template_margin(scaled)
+                group += 1
+        results = []
+        hits = _locate_jobs(
+            roi_proc, jobs, search_mode, correlation_backend, workers, peaks_per_map
+        )
+        for job, job_hits in zip(jobs, hits):
+            for max_val, max_loc in job_hits:
+                scale = job.scaled.scale
+                scaled = job.scaled.edge
                 th, tw = scaled.shape[:2]
-                if th > roi_proc.shape[0] or tw > roi_proc.shape[1]:
-                    continue
-                if np.count_nonzero(scaled) < max(10, int(scaled.size * 0.002)):
-                    continue
-                res = cv2.matchTemplate(roi_proc, scaled, cv2.TM_CCOEFF_NORMED)
-                _min_val, max_val, _min_loc, max_loc = cv2.minMaxLoc(res)
                 tight_x = x0 + max_loc[0]
                 tight_y = y0 + max_loc[1]
                 patch = roi_proc[max_loc[1] : max_loc[1] + th, max_loc[0] : max_loc[0] + tw]
                 shape_ratio = _foreground_match_ratio(scaled, patch)
-                tx, ty, tw_tight, th_tight = tpl.tight_bbox
+                tpl = job.tpl
+                tx, ty, _tw_tight, _th_tight = tpl.tight_bbox
                 outer_x = int(round(tight_x - (tx * scale)))
                 outer_y = int(round(tight_y - (ty * scale)))
                 outer_w = int(round(tpl.outer_bbox[2] * scale))
                 outer_h = int(round(tpl.outer_bbox[3] * scale))
-                tight_w = tw
-                tight_h = th
                 results.append(
                     MatchResult(
-                        class_name=class_name,
+                        class_name=job.class_name,
                         template_name=tpl.template_name,
                         score=float(max_val),
                         scale=scale,
-                        bbox=(tight_x, tight_y, tight_w, tight_h),
+                        bbox=(tight_x, tight_y, tw, th),
                         outer_bbox=(outer_x, outer_y, outer_w, outer_h),
-                        tight_bbox=(tight_x, tight_y, tight_w, tight_h),
-                        mode="bin",
+                        tight_bbox=(tight_x, tight_y, tw, th),
+                        mode=mode,
                         shape_ratio=shape_ratio,
                     )
                 )
-    results.sort(key=lambda r: r.score, reverse=True)
+        results.sort(key=lambda r: r.score, reverse=True)
+        if results:
+            return results
     return results
 
 
@@ -659,13 +1380,46 @@ def filter_overlapping_matches(
     confirmed = [c for c in confirmed_boxes if c is not None]
     if not confirmed:
         return matches
-    filtered: List[MatchResult] = []
-    for match in matches:
-        keep = True
-        for box in confirmed:
-            if compute_iou(match.bbox, box) >= iou_threshold:
-                keep = False
-                break
-        if keep:
-            filtered.append(match)
+    if iou_threshold <= 0:
+        # IoU >= 0 holds for every pair
+        return []
+    index = BoxIndex(boxes_to_array(confirmed))
+    boxes = boxes_to_array([m.bbox for m in matches])
+    query, idx = index.overlapping_pairs(boxes)
+    hit = np.zeros(len(matches), dtype=bool)
+    ious = iou_pairs(boxes[query], index.boxes[idx])
+    hit[query[ious >= iou_threshold]] = True
+    filtered = [m for m, drop in zip(matches, hit.tolist()) if not drop]
     return filtered
+
+
+def expand_group_hits(
+    matches: List[MatchResult],
+    groups: Dict[str, List[TemplateGroup]],
+    rematch: Callable[[Dict[str, List[TemplateImage]]], List[MatchResult]],
+    top_classes: Optional[int] = None,
+) -> List[MatchResult]:
+    """Add matches of the other members of every group whose representative matched.
+
+    `matches` come from matching group representatives only; `rematch` runs the
+    same matcher on a class -> templates dict. With top_classes, only groups of
+    the best-scoring top_classes classes are expanded.
+    """
+    hits = matches
+    if top_classes is not None:
+        ranked = sorted(matches, key=lambda m: m.score, reverse=True)
+        best: List[str] = []
+        for m in ranked:
+            if m.class_name not in best:
+                best.append(m.class_name)
+        keep = set(best[: max(0, int(top_classes))])
+        hits = [m for m in matches if m.class_name in keep]
+    hit = {(m.class_name, m.template_name) for m in hits}
+    members: Dict[str, List[TemplateImage]] = {}
+    for class_name, class_groups in groups.items():
+        for group in class_groups:
+            if group.members and (class_name, group.representative.template_name) in hit:
+                members.setdefault(class_name, []).extend(group.members)
+    if not members:
+        return matches
+    return list(matches) + list(rematch(members))
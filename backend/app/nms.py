@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from typing import Iterable, List, Mapping, Tuple, Union
+from typing import Dict, Hashable, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
 
 
 BBox = Tuple[int, int, int, int]
@@ -43,6 +45,128 @@ def compute_iou(box1: BoxLike, box2: BoxLike) -> float:
     return float(inter_area / union)
 
 
+def boxes_to_array(bboxes: Sequence[BoxLike]) -> np.ndarray:
+    """(n, 4) int64 array of (x, y, w, h), coerced like compute_iou."""
+    if not bboxes:
+        return np.zeros((0, 4), dtype=np.int64)
+    return np.asarray([_as_box_tuple(b) for b in bboxes], dtype=np.int64)
+
+
+def iou_pairs(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Element-wise IoU of two aligned (n, 4) int arrays, same rules as compute_iou."""
+    ax, ay, aw, ah = a[:, 0], a[:, 1], a[:, 2], a[:, 3]
+    bx, by, bw, bh = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+    inter_w = np.minimum(ax + aw, bx + bw) - np.maximum(ax, bx)
+    inter_h = np.minimum(ay + ah, by + bh) - np.maximum(ay, by)
+    inter = inter_w * inter_h
+    union = aw * ah + bw * bh - inter
+    valid = (aw > 0) & (ah > 0) & (bw > 0) & (bh > 0) & (inter_w > 0) & (inter_h > 0) & (union > 0)
+    out = np.zeros(len(a), dtype=np.float64)
+    out[valid] = inter[valid] / union[valid]
+    return out
+
+
+def iou_one_to_many(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """IoU of one (x, y, w, h) box against an (n, 4) array, same rules as compute_iou."""
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.float64)
+    one = np.asarray([int(v) for v in box], dtype=np.int64).reshape(1, 4)
+    return iou_pairs(np.broadcast_to(one, boxes.shape), boxes)
+
+
+class BoxIndex:
+    """Sorted sweep over box x coordinates for overlap queries.
+
+    A box (x, y, w, h) can only overlap the query if its x lies in
+    (qx - max_w, qx + qw), so each query binary-searches that x range and
+    tests the exact predicate on it. Comparisons are done on the raw
+    coordinates (no w/h sign check), like the pairwise overlap tests.
+    """
+
+    def __init__(self, boxes: np.ndarray) -> None:
+        self.boxes = np.asarray(boxes).reshape(-1, 4)
+        self._order = np.argsort(self.boxes[:, 0], kind="stable")
+        self._xs = self.boxes[self._order, 0]
+        self._max_w = self.boxes[:, 2].max() if len(self.boxes) else 0
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def overlapping(self, box: Sequence[float]) -> np.ndarray:
+        """Ascending indices of boxes with a positive-area overlap test against box."""
+        qx, qy, qw, qh = box
+        lo = np.searchsorted(self._xs, qx - self._max_w, side="right")
+        hi = np.searchsorted(self._xs, qx + qw, side="left")
+        if hi <= lo:
+            return np.zeros(0, dtype=np.intp)
+        idx = self._order[lo:hi]
+        cand = self.boxes[idx]
+        hit = (
+            (cand[:, 0] + cand[:, 2] > qx)
+            & (cand[:, 1] < qy + qh)
+            & (cand[:, 1] + cand[:, 3] > qy)
+        )
+        return np.sort(idx[hit])
+
+    def x_range_pairs(self, lo: np.ndarray, hi: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(query, box) index pairs with lo[q] <= box x <= hi[q], for bulk queries."""
+        start = np.searchsorted(self._xs, lo, side="left")
+        stop = np.searchsorted(self._xs, hi, side="right")
+        counts = np.maximum(stop - start, 0)
+        total = int(counts.sum())
+        query = np.repeat(np.arange(len(counts)), counts)
+        offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return query, self._order[np.repeat(start, counts) + offset]
+
+    def overlapping_pairs(self, boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(query, box) pairs passing the positive-area overlap test, for an (n, 4) query array."""
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        query, idx = self.x_range_pairs(
+            boxes[:, 0] - self._max_w, boxes[:, 0] + boxes[:, 2]
+        )
+        q, c = boxes[query], self.boxes[idx]
+        hit = (
+            (c[:, 0] < q[:, 0] + q[:, 2])
+            & (c[:, 0] + c[:, 2] > q[:, 0])
+            & (c[:, 1] < q[:, 1] + q[:, 3])
+            & (c[:, 1] + c[:, 3] > q[:, 1])
+        )
+        return query[hit], idx[hit]
+
+
+def greedy_nms(
+    boxes: np.ndarray,
+    order: Sequence[int],
+    iou_threshold: float,
+    inclusive: bool = False,
+    index: Optional[BoxIndex] = None,
+) -> List[int]:
+    """Greedy NMS over an (n, 4) int array, visiting boxes in `order`.
+
+    A later box is suppressed when it intersects a kept box with
+    IoU > iou_threshold (>= when inclusive). Boxes that do not intersect
+    are never suppressed.
+    """
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    index = index if index is not None else BoxIndex(boxes)
+    rank = np.full(len(boxes), -1, dtype=np.int64)
+    rank[np.asarray(order, dtype=np.intp)] = np.arange(len(order))
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep: List[int] = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(int(i))
+        near = index.overlapping(boxes[i])
+        near = near[(rank[near] > rank[i]) & ~suppressed[near]]
+        if near.size == 0:
+            continue
+        iou = iou_one_to_many(boxes[i], boxes[near])
+        hit = (iou >= iou_threshold) if inclusive else (iou > iou_threshold)
+        suppressed[near[hit & (iou > 0)]] = True
+    return keep
+
+
 def nms(bboxes: List[BoxLike], scores: List[float], iou_threshold: float) -> List[int]:
     if len(bboxes) != len(scores):
         raise ValueError("bboxes and scores must have same length")
@@ -50,18 +174,75 @@ def nms(bboxes: List[BoxLike], scores: List[float], iou_threshold: float) -> Lis
         return []
 
     order = sorted(range(len(scores)), key=lambda i: (-scores[i], i))
+    if iou_threshold < 0:
+        # every pair has IoU >= 0 > threshold: only the best box survives
+        return [order[0]]
+    return greedy_nms(boxes_to_array(bboxes), order, iou_threshold)
+
+
+def batched_nms(
+    bboxes: List[BoxLike],
+    scores: List[float],
+    labels: Sequence[Hashable],
+    iou_threshold: float,
+) -> List[int]:
+    """Class-aware nms; kept indices are grouped by label in first-seen order."""
+    if not (len(bboxes) == len(scores) == len(labels)):
+        raise ValueError("bboxes, scores and labels must have same length")
+    grouped: Dict[Hashable, List[int]] = {}
+    for idx, label in enumerate(labels):
+        grouped.setdefault(label, []).append(idx)
     keep: List[int] = []
+    for indices in grouped.values():
+        kept = nms([bboxes[i] for i in indices], [scores[i] for i in indices], iou_threshold)
+        keep.extend(indices[i] for i in kept)
+    return keep
 
-    while order:
-        current = order.pop(0)
-        keep.append(current)
-        if not order:
-            break
-        remaining: List[int] = []
-        current_box = bboxes[current]
-        for idx in order:
-            if compute_iou(current_box, bboxes[idx]) <= iou_threshold:
-                remaining.append(idx)
-        order = remaining
 
+def suppress_overlapping(bboxes: Sequence[Sequence[float]], order: Sequence[int]) -> List[int]:
+    """Visit boxes in `order` and keep those not overlapping any kept box at all."""
+    if not len(bboxes):
+        return []
+    boxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    index = BoxIndex(boxes)
+    rank = np.full(len(boxes), -1, dtype=np.int64)
+    rank[np.asarray(order, dtype=np.intp)] = np.arange(len(order))
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep: List[int] = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(int(i))
+        near = index.overlapping(boxes[i])
+        suppressed[near[rank[near] > rank[i]]] = True
     return keep
+
+
+def overlap_clusters(bboxes: Sequence[Sequence[float]]) -> List[List[int]]:
+    """Connected components of the box overlap graph.
+
+    Components are listed by their smallest index and their members in
+    depth-first visiting order (neighbours pushed in index order), the
+    order the pairwise search produced.
+    """
+    if not len(bboxes):
+        return []
+    boxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    index = BoxIndex(boxes)
+    visited = np.zeros(len(boxes), dtype=bool)
+    clusters: List[List[int]] = []
+    for start in range(len(boxes)):
+        if visited[start]:
+            continue
+        visited[start] = True
+        stack = [start]
+        component: List[int] = []
+        while stack:
+            i = stack.pop()
+            component.append(i)
+            near = index.overlapping(boxes[i])
+            near = near[~visited[near]]
+            visited[near] = True
+            stack.extend(near.tolist())
+        clusters.append(component)
+    return clusters
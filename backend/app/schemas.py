@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -8,6 +8,8 @@ from pydantic import BaseModel, Field
 class TemplateInfo(BaseModel):
     class_name: str
     count: int
+    bytes: int = 0  # resident size of the class's template arrays
+    duplicates: List[List[str]] = []  # near-duplicate groups (representative first), size > 1 only
 
 
 class ProjectInfo(BaseModel):
@@ -15,6 +17,27 @@ class ProjectInfo(BaseModel):
     classes: List[TemplateInfo]
 
 
+class TemplateReadiness(BaseModel):
+    ready: bool
+    warmup_running: bool
+    projects_total: int
+    projects_loaded: int
+    templates_loaded: int
+    template_bytes: int
+    loading: List[str]
+    load_seconds: Dict[str, float]
+    errors: Dict[str, str]
+
+
+class TemplateReloadResponse(BaseModel):
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+    projects_added: List[str]
+    projects_removed: List[str]
+    seconds: float
+
+
 class UploadResponse(BaseModel):
     image_id: str
     width: int
@@ -43,6 +66,10 @@ class DetectPointRequest(BaseModel):
     exclude_mode: str = Field("same_class", pattern="^(same_class|any_class)$")
     exclude_center: bool = True
     exclude_iou_threshold: float = Field(0.6, ge=0, le=1)
+    search_mode: str = Field("exhaustive", pattern="^(exhaustive|pyramid)$")
+    correlation_backend: str = Field("spatial", pattern="^(spatial|fft)$")
+    hist_prefilter: float = Field(0.0, ge=0, le=1)
+    feature_cache: bool = True
 
 
 class BBox(BaseModel):
@@ -79,6 +106,7 @@ class DetectPointDebug(BaseModel):
     match_mode: Optional[str] = None
     outer_bbox: Optional[dict] = None
     tight_bbox: Optional[dict] = None
+    prefilter: Optional[dict] = None
 
 
 class DebugPoint(BaseModel):
@@ -102,6 +130,14 @@ class DetectFullRequest(BaseModel):
     exclude_mode: str = Field("same_class", pattern="^(same_class|any_class)$")
     exclude_center: bool = True
     exclude_iou_threshold: float = Field(0.6, ge=0, le=1)
+    search_mode: str = Field("exhaustive", pattern="^(exhaustive|pyramid)$")
+    correlation_backend: str = Field("spatial", pattern="^(spatial|fft)$")
+    hist_prefilter: float = Field(0.0, ge=0, le=1)
+    # grid: disjoint 1024px tiles; halo: tiles overlap by the largest scaled template
+    tiling: str = Field("grid", pattern="^(grid|halo)$")
+    skip_blank_tiles: bool = True  # halo tiling only
+    # skip frame margins, title blocks, tables and text lines (see detection_core)
+    prune_mask: bool = False
 
 
 class DetectFullResult(BaseModel):
@@ -117,6 +153,37 @@ class ConfirmedAnnotation(BaseModel):
 
 class DetectFullResponse(BaseModel):
     results: List[DetectFullResult]
+    debug: Optional["DetectFullDebug"] = None
+
+
+class DetectFullTile(BaseModel):
+    x: int
+    y: int
+    w: int
+    h: int
+    skipped: bool = False
+    pruned: bool = False
+    edge_pixels: int = 0
+    matches: int = 0
+    seconds: float = 0.0
+
+
+class DetectFullDebug(BaseModel):
+    tiling: str
+    tile_size: int
+    halo: int = 0
+    tiles_total: int
+    tiles_skipped: int = 0
+    seam_duplicates: int = 0
+    tiles: List[DetectFullTile] = Field(default_factory=list)
+    pruned_fraction: float = 0.0
+    pruned_regions: List["DetectFullPrunedRegion"] = Field(default_factory=list)
+    prune_mask_base64: Optional[str] = None  # PNG, white = excluded
+
+
+class DetectFullPrunedRegion(BaseModel):
+    kind: str  # margin / ruled / text
+    bbox: BBox
 
 
 class Point(BaseModel):
@@ -283,6 +350,13 @@ class AutoAnnotateRequest(BaseModel):
     scale_steps: Optional[int] = None
     stride: Optional[int] = None
     roi_size: Optional[int] = None
+    peaks_per_map: int = Field(1, ge=1)
+    precompute_features: bool = False  # method="scaled_templates" only
+    # method="combined" only
+    search_mode: str = Field("exhaustive", pattern="^(exhaustive|pyramid)$")
+    correlation_backend: str = Field("spatial", pattern="^(spatial|bitpack)$")
+    suppress_peaks: bool = False
+    prune_mask: bool = False
     project_name: Optional[str] = None
     image_key: Optional[str] = None
 
@@ -0,0 +1,100 @@
+"""Bank of pre-scaled template arrays shared by the matchers.
+
+Resizing and trimming a template variant only depends on the template,
+the variant, the scale and the trim flag, so the results are built once
+and reused by every `/detect/point`, `/detect/full` and auto-annotation
+call. Entries are evicted in LRU order once the byte budget is exceeded.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+from .config import TEMPLATE_BANK_MAX_BYTES
+
+
+@dataclass(frozen=True)
+class ScaledTemplate:
+    """Resized (and optionally trimmed) template ready for correlation."""
+
+    scale: float
+    edge: np.ndarray
+    mask: Optional[np.ndarray]
+    bounds: Tuple[int, int, int, int]  # trimmed (x, y, w, h) inside the resized template
+    fg_count: int
+
+    @property
+    def nbytes(self) -> int:
+        size = int(self.edge.nbytes)
+        if self.mask is not None:
+            size += int(self.mask.nbytes)
+        return size
+
+
+class ScaledTemplateBank:
+    def __init__(self, max_bytes: int = TEMPLATE_BANK_MAX_BYTES) -> None:
+        self.max_bytes = int(max_bytes)
+        self._entries: "OrderedDict[Hashable, ScaledTemplate]" = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = Lock()
+
+    def get(self, key: Hashable, builder: Callable[[], ScaledTemplate]) -> ScaledTemplate:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry
+            self._misses += 1
+        entry = builder()
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None:
+                self._entries.move_to_end(key)
+                return current
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _old_key, old = self._entries.popitem(last=False)
+                self._bytes -= old.nbytes
+        return entry
+
+    def invalidate(self, path: Optional[str] = None) -> int:
+        """Drop entries of one template file (keys start with its path), or all."""
+        with self._lock:
+            if path is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                self._bytes = 0
+                return removed
+            stale = [k for k in self._entries if isinstance(k, tuple) and k and k[0] == path]
+            for key in stale:
+                self._bytes -= self._entries.pop(key).nbytes
+            return len(stale)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+
+_bank: Optional[ScaledTemplateBank] = None
+
+
+def get_template_bank() -> ScaledTemplateBank:
+    global _bank
+    if _bank is None:
+        _bank = ScaledTemplateBank()
+    return _bank
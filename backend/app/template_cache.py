@@ -0,0 +1,267 @@
+"""On-disk cache of preprocessed templates.
+
+`scan_templates` decodes every template and rebuilds its binary/edge maps,
+rotation variants and angle histograms. With this cache each template's
+arrays are stored as a bundle directory of `.npy` files under
+`TEMPLATE_CACHE_DIR`, and a JSON manifest maps the template path to its
+size, mtime and content hash. Unchanged files load from the bundle with
+`mmap_mode="r"`, so their arrays are paged in from the file on first use
+instead of being read at startup; a file whose stat changed but whose
+content hash did not is also reused. The manifest records a code version
+(hash of `templates.py` plus the OpenCV/NumPy versions); on mismatch the
+whole cache is discarded.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+import cv2
+import numpy as np
+
+from . import templates as templates_module
+from .config import TEMPLATE_CACHE_DIR
+from .templates import TemplateImage, TemplateVariant, binary_map
+
+
+MANIFEST_NAME = "manifest.json"
+CACHE_FORMAT = 2
+
+Builder = Callable[[str, str, Path], Optional[TemplateImage]]
+
+
+def code_version() -> str:
+    """Hash of everything the cached arrays depend on."""
+    digest = hashlib.sha1()
+    digest.update(str(CACHE_FORMAT).encode())
+    digest.update(Path(templates_module.__file__).read_bytes())
+    digest.update(cv2.__version__.encode())
+    digest.update(np.__version__.encode())
+    return digest.hexdigest()
+
+
+def _file_sha1(path: Path) -> str:
+    digest = hashlib.sha1()
+    with path.open("rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _to_arrays(template: TemplateImage) -> Dict[str, np.ndarray]:
+    arrays: Dict[str, np.ndarray] = {
+        "gray": np.asarray(template.image_gray),
+        "edge": np.asarray(binary_map(template.image_proc_edge)),
+        "bin": np.asarray(binary_map(template.image_proc_bin)),
+        "tight_bbox": np.asarray(template.tight_bbox, dtype=np.int64),
+        "outer_bbox": np.asarray(template.outer_bbox, dtype=np.int64),
+        "variants": np.asarray(len(template.line_variants), dtype=np.int64),
+    }
+    for i, variant in enumerate(template.line_variants):
+        arrays[f"v{i}_edge"] = np.asarray(binary_map(variant.edge))
+        arrays[f"v{i}_mask"] = np.asarray(binary_map(variant.mask))
+        arrays[f"v{i}_hist"] = np.asarray(variant.angle_hist, dtype=np.float64)
+        arrays[f"v{i}_meta"] = np.asarray(
+            (variant.rotation_deg, *variant.tight_bbox, *variant.outer_bbox), dtype=np.int64
+        )
+    return arrays
+
+
+def _remove_bundle(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+def _bbox(values: np.ndarray):
+    return tuple(int(v) for v in values.tolist())
+
+
+def _from_arrays(
+    arrays: Dict[str, np.ndarray], project: str, class_name: str, img_path: Path
+) -> TemplateImage:
+    variants = []
+    for i in range(int(arrays["variants"])):
+        meta = arrays[f"v{i}_meta"].tolist()
+        variants.append(
+            TemplateVariant(
+                rotation_deg=int(meta[0]),
+                edge=arrays[f"v{i}_edge"],
+                mask=arrays[f"v{i}_mask"],
+                angle_hist=tuple(float(v) for v in arrays[f"v{i}_hist"].tolist()),
+                tight_bbox=tuple(int(v) for v in meta[1:5]),
+                outer_bbox=tuple(int(v) for v in meta[5:9]),
+            )
+        )
+    return TemplateImage(
+        project=project,
+        class_name=class_name,
+        template_name=img_path.name,
+        path=img_path,
+        image_gray=arrays["gray"],
+        tight_bbox=_bbox(arrays["tight_bbox"]),
+        outer_bbox=_bbox(arrays["outer_bbox"]),
+        image_proc_edge=arrays["edge"],
+        image_proc_bin=arrays["bin"],
+        line_variants=tuple(variants),
+    )
+
+
+class TemplateDiskCache:
+    def __init__(self, root: Path = TEMPLATE_CACHE_DIR) -> None:
+        self.root = Path(root)
+        self.version = code_version()
+        self.entries: Dict[str, Dict[str, object]] = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._lock = Lock()  # guards entries / counters; builds run outside it
+        self._load_manifest()
+
+    def _load_manifest(self) -> None:
+        try:
+            manifest = json.loads((self.root / MANIFEST_NAME).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") != self.version:
+            # preprocessing changed: every bundle is stale (.npz files of format 1 included)
+            for bundle in self.root.iterdir():
+                if bundle.name != MANIFEST_NAME:
+                    _remove_bundle(bundle)
+            self._dirty = True
+            return
+        entries = manifest.get("entries")
+        if isinstance(entries, dict):
+            self.entries = entries
+
+    def _bundle_path(self, key: str) -> Path:
+        return self.root / hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _read_bundle(
+        self, key: str, project: str, class_name: str, img_path: Path
+    ) -> Optional[TemplateImage]:
+        try:
+            arrays = {
+                npy.stem: np.asarray(np.load(npy, mmap_mode="r", allow_pickle=False))
+                for npy in self._bundle_path(key).glob("*.npy")
+            }
+            return _from_arrays(arrays, project, class_name, img_path)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _write_bundle(self, key: str, template: TemplateImage) -> bool:
+        tmp: Optional[str] = None
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            path = self._bundle_path(key)
+            tmp = tempfile.mkdtemp(dir=self.root, suffix=".tmp")
+            for name, array in _to_arrays(template).items():
+                np.save(os.path.join(tmp, name + ".npy"), array, allow_pickle=False)
+            # a directory cannot be renamed over a non-empty one; readers of the old
+            # bundle keep their mappings after it is removed
+            _remove_bundle(path)
+            os.replace(tmp, path)
+            tmp = None
+            return True
+        except OSError:
+            return False
+        finally:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    def get_or_build(
+        self, project: str, class_name: str, img_path: Path, build: Builder
+    ) -> Optional[TemplateImage]:
+        """Cached template for img_path, or build() it and store the result."""
+        key = str(img_path.resolve())
+        try:
+            stat = img_path.stat()
+        except OSError:
+            return build(project, class_name, img_path)
+        with self._lock:
+            entry = dict(self.entries.get(key) or {})
+        sha1: Optional[str] = None
+        if entry:
+            same_stat = entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns
+            if not same_stat:
+                sha1 = _file_sha1(img_path)
+            if same_stat or entry.get("sha1") == sha1:
+                template = self._read_bundle(key, project, class_name, img_path)
+                if template is not None:
+                    with self._lock:
+                        if not same_stat:
+                            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                            self.entries[key] = entry
+                            self._dirty = True
+                        self.hits += 1
+                    return template
+        with self._lock:
+            self.misses += 1
+        template = build(project, class_name, img_path)
+        if template is None:
+            with self._lock:
+                if self.entries.pop(key, None) is not None:
+                    self._dirty = True
+            return None
+        if self._write_bundle(key, template):
+            record = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha1": sha1 or _file_sha1(img_path),
+            }
+            with self._lock:
+                self.entries[key] = record
+                self._dirty = True
+        return template
+
+    def flush(self) -> None:
+        """Drop entries of deleted files and write the manifest if anything changed."""
+        with self._lock:
+            for key in [k for k in self.entries if not Path(k).exists()]:
+                del self.entries[key]
+                _remove_bundle(self._bundle_path(key))
+                self._dirty = True
+            if not self._dirty:
+                return
+            tmp: Optional[str] = None
+            try:
+                self.root.mkdir(parents=True, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".json.tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                    json.dump({"version": self.version, "entries": self.entries}, fh)
+                os.replace(tmp, self.root / MANIFEST_NAME)
+                tmp = None
+                self._dirty = False
+            except OSError:
+                pass
+            finally:
+                if tmp is not None:
+                    try:
+                        os.unlink(tmp)
+                    except OSError:
+                        pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+_cache: Optional[TemplateDiskCache] = None
+
+
+def get_template_disk_cache() -> TemplateDiskCache:
+    global _cache
+    if _cache is None:
+        _cache = TemplateDiskCache()
+    return _cache
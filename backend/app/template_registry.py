@@ -0,0 +1,367 @@
+"""Lazily loaded, per-project view of the template library.
+
+`TemplateRegistry` replaces the dict returned by `scan_templates` in
+`main.py`. Only the directory layout is read at startup; a project's
+templates are loaded the first time `get(project)` (or `[project]`) asks
+for it. `start_warmup()` loads the remaining projects on a background
+thread, and `status()` reports progress for `/health/ready`. A registry
+created with `warmup=True` is only ready once that thread has finished
+and every project loaded without errors.
+
+`rescan()` picks up template edits without a restart: loaded projects are
+diffed file by file (size/mtime), only added or changed files are
+processed, and the new project dicts are swapped in as a whole, so a
+request that already holds a project dict keeps a consistent view.
+
+`groups(project)` collapses near-identical templates of each class
+(`group_near_duplicates`); the grouping is cached per loaded project dict
+and recomputed after a rescan swaps that dict.
+"""
+
+from __future__ import annotations
+
+import time
+from collections.abc import Mapping
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .template_bank import get_template_bank
+from .template_cache import TemplateDiskCache
+from .templates import (
+    IMAGE_EXTS,
+    TemplateGroup,
+    TemplateImage,
+    build_template,
+    compact_template,
+    discover_projects,
+    group_near_duplicates,
+    scan_project,
+    template_nbytes,
+)
+
+
+ProjectTemplates = Dict[str, List[TemplateImage]]
+ProjectGroups = Dict[str, List[TemplateGroup]]
+FileStamp = Tuple[int, int]  # (size, mtime_ns)
+
+
+def _has_image_files(class_dirs: List[Path]) -> bool:
+    return any(
+        p.suffix.lower() in IMAGE_EXTS for class_dir in class_dirs for p in class_dir.iterdir()
+    )
+
+
+def _image_files(class_dirs: List[Path]) -> Dict[str, Tuple[str, Path, FileStamp]]:
+    """path -> (class name, path, stamp) in scan order; unreadable files are skipped."""
+    files: Dict[str, Tuple[str, Path, FileStamp]] = {}
+    for class_dir in class_dirs:
+        for img_path in class_dir.iterdir():
+            if img_path.suffix.lower() not in IMAGE_EXTS:
+                continue
+            try:
+                stat = img_path.stat()
+            except OSError:
+                continue
+            files[str(img_path)] = (class_dir.name, img_path, (stat.st_size, stat.st_mtime_ns))
+    return files
+
+
+class TemplateRegistry(Mapping):
+    """project -> class -> templates, loaded on first access per project.
+
+    Projects whose files all fail to load behave as missing, as with the
+    eager scan; they are only known to be empty after their first load.
+    """
+
+    def __init__(
+        self,
+        templates_root: Path,
+        cache: Optional[TemplateDiskCache] = None,
+        workers: int = 1,
+        compact: bool = False,
+        dedup_hash_distance: int = 10,
+        dedup_min_corr: float = 0.9,
+        warmup: bool = False,
+    ) -> None:
+        self.templates_root = templates_root
+        self.warmup = bool(warmup)
+        self.cache = cache
+        self.workers = max(1, int(workers))
+        self.compact = bool(compact)
+        self.dedup_hash_distance = int(dedup_hash_distance)
+        self.dedup_min_corr = float(dedup_min_corr)
+        self._layout: Dict[str, List[Path]] = {
+            project: class_dirs
+            for project, class_dirs in discover_projects(templates_root).items()
+            if _has_image_files(class_dirs)
+        }
+        self._loaded: Dict[str, ProjectTemplates] = {}
+        self._stamps: Dict[str, Dict[str, FileStamp]] = {}
+        self._load_seconds: Dict[str, float] = {}
+        self._errors: Dict[str, str] = {}
+        self._groups: Dict[str, Tuple[ProjectTemplates, ProjectGroups]] = {}
+        self._project_locks: Dict[str, Lock] = {project: Lock() for project in self._layout}
+        self._lock = Lock()
+        self._loading: List[str] = []
+        self._warmup: Optional[Thread] = None
+        self._reload_lock = Lock()
+        self._watcher: Optional[Thread] = None
+        self._watcher_stop = Event()
+
+    def _load(self, project: str) -> ProjectTemplates:
+        loaded = self._loaded.get(project)
+        if loaded is not None:
+            return loaded
+        with self._project_locks[project]:
+            loaded = self._loaded.get(project)
+            if loaded is not None:
+                return loaded
+            with self._lock:
+                self._loading.append(project)
+            start = time.perf_counter()
+            try:
+                class_dirs = self._layout[project]
+                stamps = {key: item[2] for key, item in _image_files(class_dirs).items()}
+                loaded = scan_project(project, class_dirs, self.cache, self.workers, self.compact)
+                if self.cache is not None:
+                    self.cache.flush()
+            except Exception as exc:
+                with self._lock:
+                    self._errors[project] = str(exc)
+                raise
+            finally:
+                with self._lock:
+                    self._loading.remove(project)
+            with self._lock:
+                self._loaded[project] = loaded
+                self._stamps[project] = stamps
+                self._load_seconds[project] = time.perf_counter() - start
+                self._errors.pop(project, None)
+            return loaded
+
+    def __getitem__(self, project: str) -> ProjectTemplates:
+        if project not in self._layout:
+            raise KeyError(project)
+        loaded = self._load(project)
+        if not loaded:
+            raise KeyError(project)
+        return loaded
+
+    def __iter__(self) -> Iterator[str]:
+        for project in list(self._layout):
+            loaded = self._loaded.get(project)
+            if loaded is None or loaded:
+                yield project
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def items(self) -> List[Tuple[str, ProjectTemplates]]:  # type: ignore[override]
+        """Loads every project; empty ones are skipped."""
+        pairs: List[Tuple[str, ProjectTemplates]] = []
+        for project in list(self._layout):
+            loaded = self._load(project)
+            if loaded:
+                pairs.append((project, loaded))
+        return pairs
+
+    def values(self) -> List[ProjectTemplates]:  # type: ignore[override]
+        return [loaded for _project, loaded in self.items()]
+
+    def _build(self, project: str, class_name: str, img_path: Path) -> Optional[TemplateImage]:
+        if self.cache is not None:
+            template = self.cache.get_or_build(project, class_name, img_path, build_template)
+        else:
+            template = build_template(project, class_name, img_path)
+        if self.compact and template is not None:
+            template = compact_template(template)
+        return template
+
+    def _rescan_project(
+        self, project: str, class_dirs: List[Path], report: Dict[str, List[str]]
+    ) -> Tuple[ProjectTemplates, Dict[str, FileStamp]]:
+        old_stamps = self._stamps.get(project, {})
+        old_templates = {
+            str(t.path): t for items in self._loaded[project].values() for t in items
+        }
+        files = _image_files(class_dirs)
+        rebuilt: ProjectTemplates = {}
+        for key, (class_name, img_path, stamp) in files.items():
+            old_stamp = old_stamps.get(key)
+            template: Optional[TemplateImage]
+            if old_stamp == stamp:
+                template = old_templates.get(key)  # None: failed to load last time
+            else:
+                report["changed" if old_stamp is not None else "added"].append(key)
+                template = self._build(project, class_name, img_path)
+            if template is not None:
+                rebuilt.setdefault(class_name, []).append(template)
+        report["removed"].extend(key for key in old_stamps if key not in files)
+        return rebuilt, {key: item[2] for key, item in files.items()}
+
+    def rescan(self) -> Dict[str, object]:
+        """Re-read the template tree and swap in updated projects.
+
+        Projects that were never loaded only get their layout refreshed.
+        Scaled-template bank entries of changed or removed files are dropped.
+        """
+        start = time.perf_counter()
+        report: Dict[str, List[str]] = {"added": [], "changed": [], "removed": []}
+        with self._reload_lock:
+            layout = {
+                project: class_dirs
+                for project, class_dirs in discover_projects(self.templates_root).items()
+                if _has_image_files(class_dirs)
+            }
+            with self._lock:
+                loaded_projects = list(self._loaded)
+                for project in layout:
+                    self._project_locks.setdefault(project, Lock())
+            updated: Dict[str, Tuple[ProjectTemplates, Dict[str, FileStamp]]] = {}
+            for project in loaded_projects:
+                if project not in layout:
+                    report["removed"].extend(self._stamps.get(project, {}))
+                    continue
+                with self._project_locks[project]:
+                    updated[project] = self._rescan_project(project, layout[project], report)
+            if self.cache is not None:
+                self.cache.flush()
+            projects_added = [p for p in layout if p not in self._layout]
+            projects_removed = [p for p in self._layout if p not in layout]
+            with self._lock:
+                # new dicts, never mutated in place: readers keep the snapshot they hold
+                loaded = {p: t for p, t in self._loaded.items() if p in layout}
+                stamps = {p: st for p, st in self._stamps.items() if p in layout}
+                for project, (templates, project_stamps) in updated.items():
+                    loaded[project] = templates
+                    stamps[project] = project_stamps
+                self._layout = layout
+                self._loaded = loaded
+                self._stamps = stamps
+                for project in projects_removed:
+                    self._groups.pop(project, None)
+                    self._load_seconds.pop(project, None)
+                    self._errors.pop(project, None)
+        if self.warmup:
+            # keep a warmed-up registry fully loaded (and ready) after new projects appear
+            for project in projects_added:
+                try:
+                    self._load(project)
+                except Exception:
+                    continue
+        # bank keys carry the template generation, so this only frees memory
+        bank = get_template_bank()
+        for key in report["changed"] + report["removed"]:
+            bank.invalidate(key)
+        return {
+            **report,
+            "projects_added": projects_added,
+            "projects_removed": projects_removed,
+            "seconds": time.perf_counter() - start,
+        }
+
+    def _watch(self, interval: float) -> None:
+        while not self._watcher_stop.wait(interval):
+            try:
+                self.rescan()
+            except Exception:
+                # transient filesystem errors; try again on the next tick
+                continue
+
+    def start_watcher(self, interval: float) -> Thread:
+        """Call rescan() every `interval` seconds on a daemon thread (idempotent)."""
+        with self._lock:
+            if self._watcher is None:
+                self._watcher_stop.clear()
+                self._watcher = Thread(
+                    target=self._watch, args=(float(interval),), name="template-watcher", daemon=True
+                )
+                self._watcher.start()
+            return self._watcher
+
+    def stop_watcher(self) -> None:
+        self._watcher_stop.set()
+        with self._lock:
+            watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            watcher.join()
+
+    def groups(self, project: str) -> ProjectGroups:
+        """class -> near-duplicate groups of the project, in scan order."""
+        templates = self[project]
+        with self._lock:
+            cached = self._groups.get(project)
+        if cached is not None and cached[0] is templates:
+            return cached[1]
+        grouped = {
+            class_name: group_near_duplicates(
+                items,
+                max_hash_distance=self.dedup_hash_distance,
+                min_correlation=self.dedup_min_corr,
+            )
+            for class_name, items in templates.items()
+        }
+        with self._lock:
+            self._groups[project] = (templates, grouped)
+        return grouped
+
+    def representatives(self, project: str) -> ProjectTemplates:
+        """The project's templates with one representative per near-duplicate group."""
+        return {
+            class_name: [group.representative for group in items]
+            for class_name, items in self.groups(project).items()
+        }
+
+    def is_loaded(self, project: str) -> bool:
+        return project in self._loaded
+
+    def _warmup_all(self) -> None:
+        for project in list(self._layout):
+            try:
+                self._load(project)
+            except Exception:
+                # recorded in status(); the request path retries the load
+                continue
+
+    def start_warmup(self) -> Thread:
+        """Load all projects on a daemon thread (idempotent)."""
+        with self._lock:
+            if self._warmup is None:
+                self._warmup = Thread(target=self._warmup_all, name="template-warmup", daemon=True)
+                self._warmup.start()
+            return self._warmup
+
+    def status(self) -> Dict[str, object]:
+        with self._lock:
+            loaded = dict(self._loaded)
+            warmup = self._warmup
+            warmup_running = warmup is not None and warmup.is_alive()
+            if self.warmup:
+                ready = (
+                    warmup is not None
+                    and not warmup_running
+                    and not self._errors
+                    and len(loaded) == len(self._layout)
+                )
+            else:
+                # projects load on demand, so the service is ready at once
+                ready = True
+            return {
+                "ready": ready,
+                "warmup_running": warmup_running,
+                "projects_total": len(self._layout),
+                "projects_loaded": len(loaded),
+                "templates_loaded": sum(
+                    len(items) for classes in loaded.values() for items in classes.values()
+                ),
+                "template_bytes": sum(
+                    template_nbytes(t)
+                    for classes in loaded.values()
+                    for items in classes.values()
+                    for t in items
+                ),
+                "loading": list(self._loading),
+                "load_seconds": {p: round(s, 3) for p, s in self._load_seconds.items()},
+                "errors": dict(self._errors),
+            }
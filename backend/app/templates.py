@@ -1,21 +1,74 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
 
+if TYPE_CHECKING:
+    from .template_cache import TemplateDiskCache
+
 
 IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
 
+# identifies each built/loaded TemplateImage; kept by replace() and pickling
+_generations = itertools.count(1)
+
+
+def _next_generation() -> int:
+    return next(_generations)
+
+
+@dataclass(frozen=True, eq=False)
+class PackedBinary:
+    """0/255 uint8 map stored one bit per pixel (compact template mode)."""
+
+    bits: np.ndarray
+    shape: Tuple[int, int]
+
+    @classmethod
+    def pack(cls, arr: np.ndarray) -> Optional["PackedBinary"]:
+        """Packed copy of arr, or None if arr is not a non-empty 2-D 0/255 uint8 map."""
+        if arr.dtype != np.uint8 or arr.ndim != 2 or arr.size == 0:
+            return None
+        ones = arr == 255
+        if int(np.count_nonzero(ones)) + int(np.count_nonzero(arr == 0)) != arr.size:
+            return None
+        return cls(bits=np.packbits(ones, axis=None), shape=(int(arr.shape[0]), int(arr.shape[1])))
+
+    @property
+    def size(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.bits.nbytes)
+
+    def unpack(self) -> np.ndarray:
+        bits = np.unpackbits(self.bits, count=self.size)
+        return (bits * np.uint8(255)).reshape(self.shape)
+
+
+BinaryMap = Union["cv2.typing.MatLike", PackedBinary]
+
+
+def binary_map(value: BinaryMap) -> np.ndarray:
+    """Plain uint8 array of a template map, unpacking compact storage."""
+    if isinstance(value, PackedBinary):
+        return value.unpack()
+    return value
+
 
 @dataclass(frozen=True)
 class TemplateVariant:
     rotation_deg: int
-    edge: "cv2.typing.MatLike"
-    mask: "cv2.typing.MatLike"
+    edge: BinaryMap
+    mask: BinaryMap
     angle_hist: Tuple[float, ...]
     tight_bbox: Tuple[int, int, int, int]
     outer_bbox: Tuple[int, int, int, int]
@@ -30,19 +83,126 @@ class TemplateImage:
     image_gray: "cv2.typing.MatLike"
     tight_bbox: Tuple[int, int, int, int]
     outer_bbox: Tuple[int, int, int, int]
-    image_proc_edge: "cv2.typing.MatLike"
-    image_proc_bin: "cv2.typing.MatLike"
+    image_proc_edge: BinaryMap
+    image_proc_bin: BinaryMap
     line_variants: Tuple[TemplateVariant, ...]
+    # distinguishes a rebuilt file from the old TemplateImage of the same path
+    generation: int = field(default_factory=_next_generation, compare=False)
+
+
+def _packed(arr: BinaryMap) -> BinaryMap:
+    if isinstance(arr, PackedBinary):
+        return arr
+    packed = PackedBinary.pack(np.asarray(arr))
+    return packed if packed is not None else arr
+
+
+def compact_template(template: TemplateImage) -> TemplateImage:
+    """Same template with its binary maps bit-packed (non-binary maps stay as they are)."""
+    return replace(
+        template,
+        image_proc_edge=_packed(template.image_proc_edge),
+        image_proc_bin=_packed(template.image_proc_bin),
+        line_variants=tuple(
+            replace(v, edge=_packed(v.edge), mask=_packed(v.mask)) for v in template.line_variants
+        ),
+    )
 
 
-def scan_templates(templates_root: Path) -> Dict[str, Dict[str, List[TemplateImage]]]:
-    templates: Dict[str, Dict[str, List[TemplateImage]]] = {}
+def template_nbytes(template: TemplateImage) -> int:
+    """Resident bytes of a template's arrays."""
+    size = int(np.asarray(template.image_gray).nbytes)
+    size += int(template.image_proc_edge.nbytes) + int(template.image_proc_bin.nbytes)
+    for variant in template.line_variants:
+        size += int(variant.edge.nbytes) + int(variant.mask.nbytes)
+    return size
+
+
+@dataclass(frozen=True)
+class TemplateGroup:
+    """Near-duplicate templates of one class; only the representative is matched."""
+
+    representative: TemplateImage
+    members: Tuple[TemplateImage, ...] = ()  # the other templates of the group
+
+    @property
+    def templates(self) -> Tuple[TemplateImage, ...]:
+        return (self.representative,) + self.members
+
+
+def perceptual_hash(template: TemplateImage) -> int:
+    """64-bit difference hash of the template's binary map."""
+    bin_img = binary_map(template.image_proc_bin)
+    if bin_img.size == 0:
+        return 0
+    small = cv2.resize(bin_img.astype(np.float32), (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(sum(1 << i for i, bit in enumerate(bits.tolist()) if bit))
+
+
+def _reference_correlation(a: TemplateImage, b: TemplateImage, size: int) -> float:
+    """TM_CCOEFF_NORMED of the two binary maps resized to the same reference size."""
+    ia = binary_map(a.image_proc_bin)
+    ib = binary_map(b.image_proc_bin)
+    if ia.size == 0 or ib.size == 0:
+        return 0.0
+    h, w = ia.shape[:2]
+    ref = float(size) / max(h, w)
+    dims = (max(1, int(round(w * ref))), max(1, int(round(h * ref))))
+    ra = cv2.resize(ia, dims, interpolation=cv2.INTER_AREA).astype(np.float32)
+    rb = cv2.resize(ib, dims, interpolation=cv2.INTER_AREA).astype(np.float32)
+    score = float(cv2.matchTemplate(ra, rb, cv2.TM_CCOEFF_NORMED)[0, 0])
+    return score if np.isfinite(score) else 0.0
+
+
+def group_near_duplicates(
+    templates: List[TemplateImage],
+    max_hash_distance: int = 10,
+    min_correlation: float = 0.9,
+    max_aspect_ratio: float = 1.2,
+    reference_size: int = 64,
+) -> List[TemplateGroup]:
+    """Group near-identical templates (in scan order, first one is the representative).
+
+    A template joins the first group whose representative has a similar
+    aspect ratio, a perceptual hash within max_hash_distance bits and a
+    normalized correlation of at least min_correlation at reference_size.
+    """
+    reps: List[Tuple[TemplateImage, int, float]] = []
+    members: List[List[TemplateImage]] = []
+    for template in templates:
+        h, w = template.image_proc_bin.shape[:2]
+        aspect = w / h if h > 0 else 0.0
+        phash = perceptual_hash(template)
+        for idx, (rep, rep_hash, rep_aspect) in enumerate(reps):
+            if aspect <= 0 or rep_aspect <= 0:
+                continue
+            if max(aspect, rep_aspect) / min(aspect, rep_aspect) > max_aspect_ratio:
+                continue
+            if bin(phash ^ rep_hash).count("1") > max_hash_distance:
+                continue
+            if _reference_correlation(rep, template, reference_size) < min_correlation:
+                continue
+            members[idx].append(template)
+            break
+        else:
+            reps.append((template, phash, aspect))
+            members.append([])
+    return [
+        TemplateGroup(representative=rep, members=tuple(extra))
+        for (rep, _hash, _aspect), extra in zip(reps, members)
+    ]
+
+
+def discover_projects(templates_root: Path) -> Dict[str, List[Path]]:
+    """project -> class directories, without loading any image."""
+    projects: Dict[str, List[Path]] = {}
     if not templates_root.exists():
-        return templates
+        return projects
 
     class_dirs = [p for p in templates_root.iterdir() if p.is_dir()]
     if not class_dirs:
-        return templates
+        return projects
 
     has_nested = any(any(child.is_dir() for child in d.iterdir()) for d in class_dirs)
 
@@ -51,60 +211,119 @@ def scan_templates(templates_root: Path) -> Dict[str, Dict[str, List[TemplateIma
             for class_dir in level1.iterdir():
                 if not class_dir.is_dir():
                     continue
-                _load_class_dir(level1.name, class_dir, templates)
+                projects.setdefault(level1.name, []).append(class_dir)
     else:
-        for class_dir in class_dirs:
-            _load_class_dir("default", class_dir, templates)
+        projects["default"] = class_dirs
 
-    return templates
+    return projects
 
 
-def _load_class_dir(
+def scan_project(
     project: str,
-    class_dir: Path,
-    templates: Dict[str, Dict[str, List[TemplateImage]]],
-) -> None:
-    class_name = class_dir.name
-    for img_path in class_dir.iterdir():
-        if img_path.suffix.lower() not in IMAGE_EXTS:
-            continue
-        loaded = _load_template_gray_and_mask(img_path)
-        if loaded is None:
-            continue
-        img_gray, alpha_mask = loaded
-        h, w = img_gray.shape[:2]
-        outer_bbox = (0, 0, w, h)
-        tight_bbox = _compute_tight_bbox(img_gray)
-        if tight_bbox[2] <= 0 or tight_bbox[3] <= 0:
-            tight_bbox = outer_bbox
-        tx, ty, tw, th = tight_bbox
-        cropped_tight = img_gray[ty : ty + th, tx : tx + tw] if tw > 0 and th > 0 else img_gray
-        if cropped_tight.size == 0:
-            cropped_tight = img_gray
-        cropped_mask = (
-            alpha_mask[ty : ty + th, tx : tx + tw]
-            if tw > 0 and th > 0
-            else alpha_mask
-        )
-        if cropped_mask.size == 0:
-            cropped_mask = alpha_mask
-        image_proc_edge = _preprocess_edge(cropped_tight, cropped_mask)
-        image_proc_bin = _preprocess_binary_inv(cropped_tight, cropped_mask)
-        line_variants = _build_line_variants(cropped_tight, cropped_mask)
-        templates.setdefault(project, {}).setdefault(class_name, []).append(
-            TemplateImage(
-                project=project,
-                class_name=class_name,
-                template_name=img_path.name,
-                path=img_path,
-                image_gray=img_gray,
-                tight_bbox=tight_bbox,
-                outer_bbox=outer_bbox,
-                image_proc_edge=image_proc_edge,
-                image_proc_bin=image_proc_bin,
-                line_variants=line_variants,
-            )
-        )
+    class_dirs: List[Path],
+    cache: Optional["TemplateDiskCache"] = None,
+    workers: int = 1,
+    compact: bool = False,
+) -> Dict[str, List[TemplateImage]]:
+    """class -> templates of one project (classes without a readable template are omitted).
+
+    With workers > 1 the files are preprocessed on a thread pool (OpenCV
+    releases the GIL); the result order is the sequential one. compact
+    bit-packs the binary maps of every template.
+    """
+    files = [
+        (class_dir.name, img_path)
+        for class_dir in class_dirs
+        for img_path in class_dir.iterdir()
+        if img_path.suffix.lower() in IMAGE_EXTS
+    ]
+
+    def load(item: Tuple[str, Path]) -> Optional[TemplateImage]:
+        class_name, img_path = item
+        if cache is not None:
+            template = cache.get_or_build(project, class_name, img_path, build_template)
+        else:
+            template = build_template(project, class_name, img_path)
+        if compact and template is not None:
+            template = compact_template(template)
+        return template
+
+    workers = min(int(workers), len(files))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="template-scan") as pool:
+            loaded = list(pool.map(load, files))
+    else:
+        loaded = [load(item) for item in files]
+
+    templates: Dict[str, List[TemplateImage]] = {}
+    for (class_name, _img_path), template in zip(files, loaded):
+        if template is not None:
+            templates.setdefault(class_name, []).append(template)
+    return templates
+
+
+def scan_templates(
+    templates_root: Path,
+    cache: Optional["TemplateDiskCache"] = None,
+    workers: int = 1,
+    timings: Optional[Dict[str, float]] = None,
+    compact: bool = False,
+) -> Dict[str, Dict[str, List[TemplateImage]]]:
+    """Load every template under templates_root; unchanged files come from cache if given.
+
+    If timings is given it receives the load time in seconds of each project.
+    """
+    templates: Dict[str, Dict[str, List[TemplateImage]]] = {}
+    for project, class_dirs in discover_projects(templates_root).items():
+        start = time.perf_counter()
+        classes = scan_project(project, class_dirs, cache, workers, compact)
+        if timings is not None:
+            timings[project] = time.perf_counter() - start
+        if classes:
+            templates[project] = classes
+
+    if cache is not None:
+        cache.flush()
+    return templates
+
+
+def build_template(project: str, class_name: str, img_path: Path) -> Optional[TemplateImage]:
+    """Decode and preprocess one template file (None if it cannot be read)."""
+    loaded = _load_template_gray_and_mask(img_path)
+    if loaded is None:
+        return None
+    img_gray, alpha_mask = loaded
+    h, w = img_gray.shape[:2]
+    outer_bbox = (0, 0, w, h)
+    tight_bbox = _compute_tight_bbox(img_gray)
+    if tight_bbox[2] <= 0 or tight_bbox[3] <= 0:
+        tight_bbox = outer_bbox
+    tx, ty, tw, th = tight_bbox
+    cropped_tight = img_gray[ty : ty + th, tx : tx + tw] if tw > 0 and th > 0 else img_gray
+    if cropped_tight.size == 0:
+        cropped_tight = img_gray
+    cropped_mask = (
+        alpha_mask[ty : ty + th, tx : tx + tw]
+        if tw > 0 and th > 0
+        else alpha_mask
+    )
+    if cropped_mask.size == 0:
+        cropped_mask = alpha_mask
+    image_proc_edge = _preprocess_edge(cropped_tight, cropped_mask)
+    image_proc_bin = _preprocess_binary_inv(cropped_tight, cropped_mask)
+    line_variants = _build_line_variants(cropped_tight, cropped_mask)
+    return TemplateImage(
+        project=project,
+        class_name=class_name,
+        template_name=img_path.name,
+        path=img_path,
+        image_gray=img_gray,
+        tight_bbox=tight_bbox,
+        outer_bbox=outer_bbox,
+        image_proc_edge=image_proc_edge,
+        image_proc_bin=image_proc_bin,
+        line_variants=line_variants,
+    )
 
 
 def _load_template_gray_and_mask(
@@ -189,6 +408,16 @@ def _preprocess_binary_inv(
     return bin_img
 
 
+def angle_bin_index(ang: np.ndarray, bins: int) -> np.ndarray:
+    """Orientation bin of each angle in [0, 180), same edges as np.histogram."""
+    edges = np.linspace(0.0, 180.0, bins + 1)
+    ang64 = np.asarray(ang, dtype=np.float64)
+    idx = np.clip(np.floor(ang64 * (bins / 180.0)).astype(np.intp), 0, bins - 1)
+    idx[ang64 < edges[idx]] -= 1
+    idx[(ang64 >= edges[idx + 1]) & (idx != bins - 1)] += 1
+    return idx
+
+
 def _angle_hist(
     gray: "cv2.typing.MatLike", edge: "cv2.typing.MatLike", bins: int = 18
 ) -> Tuple[float, ...]:
@@ -203,10 +432,9 @@ def _angle_hist(
     sel = (edge > 0) & (mag > 1e-3)
     if int(np.count_nonzero(sel)) == 0:
         return tuple(0.0 for _ in range(bins))
-    hist, _ = np.histogram(
-        ang[sel], bins=bins, range=(0.0, 180.0), weights=mag[sel]
-    )
-    hist = hist.astype(np.float32)
+    hist = np.bincount(
+        angle_bin_index(ang[sel], bins), weights=mag[sel], minlength=bins
+    ).astype(np.float32)
     norm = float(np.linalg.norm(hist))
     if norm > 1e-6:
         hist /= norm
@@ -0,0 +1,357 @@
+"""Process-pool scheduler for tiled template matching.
+
+`/detect/full` and `annotate_all_manual` run the full matcher on many
+independent tiles. Tiles are sent to a pool of worker processes; the
+templates are handed to every worker once through the pool initializer
+(not pickled per task). A pool is kept per template set (up to
+`TILE_POOL_MAX`, least recently used first out) and shared by concurrent
+requests, so alternating projects do not restart workers. Workers are
+started with `TILE_POOL_START_METHOD`, never forked from the threaded
+server. Results are returned in tile order.
+
+`plan_tiles` lays out the seam-aware tiling of `/detect/full`: every tile
+owns a core cell of a regular grid and is matched over the core plus a
+halo as wide as the largest scaled template, so objects on a core border
+are seen whole by the tile that owns their centre. Tiles whose region holds
+fewer edge pixels than the sparsest template (from an edge-count integral
+image) are marked as skipped. `keep_owned` and `merge_seam_duplicates`
+then drop the copies of an object found by neighbouring tiles.
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from threading import Lock
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from .config import MATCH_THREAD_WORKERS, TILE_POOL_MAX, TILE_POOL_START_METHOD
+from .feature_cache import FeatureWindow
+from .matching import MatchResult, match_templates
+from .nms import batched_nms
+from .templates import TemplateImage, binary_map
+
+
+TemplateSet = Dict[str, List[TemplateImage]]
+Box = Tuple[int, int, int, int]  # x0, y0, x1, y1
+
+# a tile is blank when its region has fewer edge pixels than this fraction of
+# the sparsest template's edge pixels at the smallest scale
+BLANK_TILE_EDGE_FRACTION = 0.5
+
+
+@dataclass(frozen=True)
+class TileTask:
+    x0: int
+    y0: int
+    tile: Optional[np.ndarray]  # may be None when features are given
+    roi_size: Optional[int] = None  # None: cover the whole tile
+    match_kwargs: Dict[str, Any] = field(default_factory=dict)
+    features: Optional[FeatureWindow] = None  # precomputed maps of the tile
+
+
+_worker_templates: Optional[TemplateSet] = None
+
+
+def _init_worker(templates: TemplateSet) -> None:
+    global _worker_templates
+    _worker_templates = templates
+    # one process per core; keep OpenCV from oversubscribing inside workers
+    cv2.setNumThreads(1)
+
+
+def _offset_match(match: MatchResult, dx: int, dy: int) -> MatchResult:
+    def shift(box: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+        return (box[0] + dx, box[1] + dy, box[2], box[3])
+
+    return MatchResult(
+        class_name=match.class_name,
+        template_name=match.template_name,
+        score=match.score,
+        scale=match.scale,
+        bbox=shift(match.bbox),
+        outer_bbox=shift(match.outer_bbox),
+        tight_bbox=shift(match.tight_bbox),
+        mode=match.mode,
+        shape_ratio=match.shape_ratio,
+    )
+
+
+def _match_tile(task: TileTask, templates: TemplateSet, workers: int) -> List[MatchResult]:
+    if task.features is not None:
+        h, w = task.features.shape
+    else:
+        h, w = task.tile.shape[:2]
+    if h <= 0 or w <= 0:
+        return []
+    roi_size = task.roi_size if task.roi_size is not None else max(w, h)
+    matches = match_templates(
+        image_bgr=task.tile,
+        x=w // 2,
+        y=h // 2,
+        roi_size=max(1, int(roi_size)),
+        templates=templates,
+        workers=workers,
+        features=task.features,
+        **task.match_kwargs,
+    )
+    return [_offset_match(m, task.x0, task.y0) for m in matches]
+
+
+def _timed_match_tile(
+    task: TileTask, templates: TemplateSet, workers: int
+) -> Tuple[List[MatchResult], float]:
+    start = perf_counter()
+    matches = _match_tile(task, templates, workers)
+    return matches, perf_counter() - start
+
+
+def _run_in_worker(task: TileTask) -> Tuple[List[MatchResult], float]:
+    assert _worker_templates is not None
+    return _timed_match_tile(task, _worker_templates, workers=1)
+
+
+def _template_fingerprint(templates: TemplateSet) -> Tuple:
+    # generations change when a template is rebuilt, unlike ids they are never reused
+    return tuple(
+        (name, tuple((str(t.path), t.generation) for t in tpls)) for name, tpls in templates.items()
+    )
+
+
+class _PoolSlot:
+    def __init__(self, pool: ProcessPoolExecutor) -> None:
+        self.pool = pool
+        self.users = 0  # runs currently mapping on the pool
+
+
+class TileScheduler:
+    def __init__(
+        self, max_pools: int = TILE_POOL_MAX, start_method: str = TILE_POOL_START_METHOD
+    ) -> None:
+        self.max_pools = max(1, int(max_pools))
+        self.start_method = start_method
+        self._pools: "OrderedDict[Tuple, _PoolSlot]" = OrderedDict()
+        self._lock = Lock()  # guards _pools only; never held while tiles run
+
+    def _acquire(self, templates: TemplateSet, workers: int) -> Tuple[Tuple, _PoolSlot]:
+        key = (_template_fingerprint(templates), workers)
+        with self._lock:
+            slot = self._pools.get(key)
+            if slot is None:
+                slot = _PoolSlot(
+                    ProcessPoolExecutor(
+                        max_workers=workers,
+                        mp_context=multiprocessing.get_context(self.start_method),
+                        initializer=_init_worker,
+                        initargs=(templates,),
+                    )
+                )
+                self._pools[key] = slot
+            self._pools.move_to_end(key)
+            slot.users += 1
+            self._trim()
+            return key, slot
+
+    def _release(self, key: Tuple, slot: _PoolSlot, broken: bool) -> None:
+        with self._lock:
+            slot.users -= 1
+            if broken and self._pools.get(key) is slot:
+                del self._pools[key]
+                slot.pool.shutdown(wait=False, cancel_futures=True)
+            self._trim()
+
+    def _trim(self) -> None:
+        # oldest idle pools first; a pool in use is closed once its last run releases it
+        for key in list(self._pools):
+            if len(self._pools) <= self.max_pools:
+                break
+            slot = self._pools[key]
+            if slot.users == 0:
+                del self._pools[key]
+                slot.pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(
+        self,
+        tasks: Sequence[TileTask],
+        templates: TemplateSet,
+        workers: int,
+        timings: Optional[List[float]] = None,
+    ) -> List[List[MatchResult]]:
+        """Match every tile; the i-th result list belongs to tasks[i] (image coordinates).
+
+        timings, if given, receives the matching seconds of every tile in the same order.
+        """
+        workers = int(workers)
+        results: Optional[List[Tuple[List[MatchResult], float]]] = None
+        if workers > 1 and len(tasks) > 1:
+            key, slot = self._acquire(templates, workers)
+            broken = False
+            try:
+                results = list(slot.pool.map(_run_in_worker, tasks))
+            except BrokenProcessPool:
+                # a worker died (e.g. OOM); drop the pool and finish in-process
+                broken = True
+            finally:
+                self._release(key, slot, broken)
+        if results is None:
+            results = [_timed_match_tile(t, templates, MATCH_THREAD_WORKERS) for t in tasks]
+        if timings is not None:
+            timings.extend(seconds for _matches, seconds in results)
+        return [matches for matches, _seconds in results]
+
+    def shutdown(self) -> None:
+        with self._lock:
+            slots = list(self._pools.values())
+            self._pools.clear()
+        for slot in slots:
+            slot.pool.shutdown(wait=False, cancel_futures=True)
+
+
+_scheduler: Optional[TileScheduler] = None
+
+
+def get_tile_scheduler() -> TileScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = TileScheduler()
+    return _scheduler
+
+
+def run_tiles(
+    tasks: Sequence[TileTask],
+    templates: TemplateSet,
+    workers: int = 1,
+    timings: Optional[List[float]] = None,
+) -> List[List[MatchResult]]:
+    return get_tile_scheduler().run(tasks, templates, workers, timings)
+
+
+@dataclass(frozen=True)
+class TilePlan:
+    region: Box  # pixels the tile is matched on (core + halo, clipped to the image)
+    core: Box  # grid cell the tile owns
+    edge_pixels: int = 0
+    skipped: bool = False  # not matched: blank region, or pruned
+    pruned: bool = False  # core entirely under the exclusion mask
+
+
+def max_template_extent(templates: TemplateSet, scale: float) -> int:
+    """Longest template side at `scale`, in pixels."""
+    extent = 0
+    for tpls in templates.values():
+        for tpl in tpls:
+            extent = max(extent, max(tpl.image_proc_edge.shape[:2]))
+    return int(np.ceil(extent * scale))
+
+
+def min_template_extent(templates: TemplateSet, scale: float) -> int:
+    """Shortest template side at `scale`, in pixels (0 without templates)."""
+    sides = [
+        min(tpl.image_proc_edge.shape[:2]) for tpls in templates.values() for tpl in tpls
+    ]
+    return int(min(sides) * scale) if sides else 0
+
+
+def min_template_edge_pixels(templates: TemplateSet, scale: float) -> int:
+    """Edge pixels of the sparsest template at `scale` (edge length scales linearly)."""
+    counts = [
+        int(np.count_nonzero(binary_map(tpl.image_proc_edge)))
+        for tpls in templates.values()
+        for tpl in tpls
+    ]
+    counts = [c for c in counts if c > 0]
+    if not counts:
+        return 0
+    return int(min(counts) * scale)
+
+
+def edge_integral(edge: np.ndarray) -> np.ndarray:
+    """(h + 1, w + 1) integral image of the nonzero pixels of an edge map."""
+    return cv2.integral((edge > 0).astype(np.uint8))
+
+
+def plan_tiles(
+    width: int,
+    height: int,
+    tile_size: int,
+    halo: int = 0,
+    integral: Optional[np.ndarray] = None,
+    min_edge_pixels: int = 0,
+) -> List[TilePlan]:
+    """Row-major grid of tile_size cores, each extended by halo on every side.
+
+    With an edge integral, tiles whose region has fewer than min_edge_pixels
+    edge pixels are marked skipped.
+    """
+    halo = max(0, int(halo))
+    plans: List[TilePlan] = []
+    for cy0 in range(0, height, tile_size):
+        cy1 = min(height, cy0 + tile_size)
+        for cx0 in range(0, width, tile_size):
+            cx1 = min(width, cx0 + tile_size)
+            x0, y0 = max(0, cx0 - halo), max(0, cy0 - halo)
+            x1, y1 = min(width, cx1 + halo), min(height, cy1 + halo)
+            edge_pixels = 0
+            skipped = False
+            if integral is not None:
+                edge_pixels = int(
+                    integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+                )
+                skipped = edge_pixels < min_edge_pixels
+            plans.append(
+                TilePlan(
+                    region=(x0, y0, x1, y1),
+                    core=(cx0, cy0, cx1, cy1),
+                    edge_pixels=edge_pixels,
+                    skipped=skipped,
+                )
+            )
+    return plans
+
+
+def _center_in(box: Tuple[int, int, int, int], core: Box) -> bool:
+    cx = box[0] + box[2] / 2.0
+    cy = box[1] + box[3] / 2.0
+    return core[0] <= cx < core[2] and core[1] <= cy < core[3]
+
+
+def keep_owned(matches: List[MatchResult], plan: TilePlan) -> List[MatchResult]:
+    """Matches of a tile whose bbox centre lies in the tile's core."""
+    return [m for m in matches if _center_in(m.bbox, plan.core)]
+
+
+def merge_seam_duplicates(
+    matches: List[MatchResult], cores: Sequence[Box], iou_threshold: float
+) -> Tuple[List[MatchResult], int]:
+    """Suppress same-class copies among matches that cross their tile's core border.
+
+    cores[i] is the core of the tile matches[i] came from. A copy found by a
+    neighbouring tile can have its centre on the other side of the seam, so
+    ownership alone keeps both; only the seam-crossing matches are compared.
+    Returns (kept matches in input order, number suppressed).
+    """
+    seam = [
+        i
+        for i, (m, core) in enumerate(zip(matches, cores))
+        if m.bbox[0] < core[0]
+        or m.bbox[1] < core[1]
+        or m.bbox[0] + m.bbox[2] > core[2]
+        or m.bbox[1] + m.bbox[3] > core[3]
+    ]
+    if len(seam) < 2:
+        return list(matches), 0
+    kept = batched_nms(
+        [matches[i].bbox for i in seam],
+        [matches[i].score for i in seam],
+        [matches[i].class_name for i in seam],
+        iou_threshold,
+    )
+    dropped = set(seam) - {seam[k] for k in kept}
+    return [m for i, m in enumerate(matches) if i not in dropped], len(dropped)
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+import pytest
+
+from app.detection_core import _merge_windows, annotate_all
+from app.templates import build_template
+
+
+@pytest.fixture
+def ring_template(tmp_path):
+    tpl = np.full((40, 40), 255, dtype=np.uint8)
+    cv2.circle(tpl, (20, 20), 7, 0, 2)
+    path = tmp_path / "ring.png"
+    cv2.imwrite(str(path), tpl)
+    return {"ring": [build_template("test", "ring", path)]}
+
+
+@pytest.mark.parametrize("search_mode", ["exhaustive", "pyramid"])
+@pytest.mark.parametrize("suppress_peaks", [False, True])
+def test_annotate_all_keeps_adjacent_instances(tmp_path, ring_template, suppress_peaks, search_mode):
+    # two rings 19 px apart: closer than the template size, boxes overlap with IoU ~0.36
+    page = np.full((80, 120), 255, dtype=np.uint8)
+    cv2.circle(page, (40, 40), 7, 0, 2)
+    cv2.circle(page, (59, 40), 7, 0, 2)
+    page[33:35, 57:61] = 255  # a small gap so the two peaks do not tie
+    path = tmp_path / "page.png"
+    cv2.imwrite(str(path), page)
+
+    result = annotate_all(
+        path,
+        ring_template,
+        0.7,
+        "coco",
+        scale_min=1.0,
+        scale_steps=1,
+        suppress_peaks=suppress_peaks,
+        search_mode=search_mode,
+    )
+
+    centers = sorted(
+        (c["bbox"][0] + c["bbox"][2] // 2, c["bbox"][1] + c["bbox"][3] // 2)
+        for c in result["confirmed"]
+    )
+    assert any(abs(x - 40) <= 1 and abs(y - 40) <= 1 for x, y in centers)
+    assert any(abs(x - 59) <= 1 and abs(y - 40) <= 1 for x, y in centers)
+
+
+def test_merge_windows_covers_windows_with_disjoint_rectangles():
+    rng = np.random.default_rng(0)
+    shape = (300, 400)
+    xy = np.column_stack((rng.integers(0, 400, 200), rng.integers(0, 300, 200)))
+    windows = np.column_stack(
+        (
+            np.maximum(0, xy[:, 0] - 8),
+            np.maximum(0, xy[:, 1] - 8),
+            np.minimum(shape[1], xy[:, 0] + 9),
+            np.minimum(shape[0], xy[:, 1] + 9),
+        )
+    )
+    merged = _merge_windows(windows, shape, 8)
+
+    cover = np.zeros(shape, dtype=np.int32)
+    for x0, y0, x1, y1 in merged:
+        assert 0 <= x0 < x1 <= shape[1] and 0 <= y0 < y1 <= shape[0]
+        cover[y0:y1, x0:x1] += 1
+    assert cover.max() == 1
+    for x0, y0, x1, y1 in windows:
+        assert cover[y0:y1, x0:x1].all()
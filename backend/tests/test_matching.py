@@ -0,0 +1,147 @@
+import cv2
+import numpy as np
+
+from app.matching import (
+    LINEART_TIE_EPS,
+    _CANDIDATE_DTYPE,
+    _descending_order,
+    _hist_tie_break_order,
+    _locate_fft,
+    _FFTCorrelator,
+    _MatchJob,
+    _masked_energy_valid,
+    _masked_responses,
+    _response_peaks,
+    _response_with_optional_mask,
+    find_response_peaks,
+)
+from app.template_bank import ScaledTemplate
+from app.nms import compute_iou
+
+
+def _random_candidates(rng, nan_fraction):
+    count = int(rng.integers(2, 12))
+    cands = np.zeros((count,), dtype=_CANDIDATE_DTYPE)
+    cands["job"] = np.arange(count)
+    # clustered scores so that near ties and swaps happen
+    scores = 0.8 + 0.004 * rng.integers(0, 6, count)
+    scores[rng.random(count) < nan_fraction] = np.nan
+    cands["score_final"] = scores
+    cands["score_hist"] = rng.random(count)
+    cands["bbox"] = np.column_stack(
+        (rng.integers(0, 6, count), rng.integers(0, 6, count), np.full(count, 10), np.full(count, 10))
+    )
+    return cands
+
+
+def _reference_order(cands):
+    """sorted(..., reverse=True) followed by the whole-list swap loop."""
+    rows = [
+        (float(c["score_final"]), float(c["score_hist"]), tuple(int(v) for v in c["bbox"]), int(c["job"]))
+        for c in cands
+    ]
+    rows = sorted(rows, key=lambda r: r[0], reverse=True)
+    swapped = True
+    while swapped:
+        swapped = False
+        for i in range(len(rows) - 1):
+            a, b = rows[i], rows[i + 1]
+            if abs(a[0] - b[0]) > LINEART_TIE_EPS:
+                continue
+            if compute_iou(a[2], b[2]) < 0.30:
+                continue
+            if b[1] > a[1] + 1e-6:
+                rows[i], rows[i + 1] = b, a
+                swapped = True
+    return [r[3] for r in rows]
+
+
+def _order(cands):
+    cands = cands[_descending_order(cands["score_final"])]
+    return [int(j) for j in cands[_hist_tie_break_order(cands)]["job"]]
+
+
+def test_hist_tie_break_order_matches_reference():
+    rng = np.random.default_rng(1)
+    for trial in range(200):
+        cands = _random_candidates(rng, nan_fraction=0.0)
+        assert _order(cands) == _reference_order(cands), trial
+
+
+def test_hist_tie_break_order_matches_reference_with_nan_scores():
+    rng = np.random.default_rng(0)
+    for trial in range(200):
+        cands = _random_candidates(rng, nan_fraction=0.3)
+        assert _order(cands) == _reference_order(cands), trial
+
+
+def _ring_scene():
+    # edges in the top half only: masked windows over the blank half have no energy
+    rng = np.random.default_rng(2)
+    roi = np.zeros((160, 160), dtype=np.uint8)
+    for _ in range(6):
+        x, y = rng.integers(15, 145), rng.integers(15, 70)
+        cv2.circle(roi, (int(x), int(y)), int(rng.integers(5, 12)), 255, 1)
+    tpl = np.zeros((25, 25), dtype=np.uint8)
+    cv2.circle(tpl, (12, 12), 8, 255, 1)
+    mask = cv2.dilate(tpl, np.ones((3, 3), dtype=np.uint8))
+    return roi, tpl, mask
+
+
+def _window_energy(roi, mask, loc):
+    th, tw = mask.shape
+    x, y = loc
+    return int(np.count_nonzero(roi[y : y + th, x : x + tw][mask > 0]))
+
+
+def test_find_response_peaks_drops_invalid_responses():
+    response = np.full((40, 40), 0.2, dtype=np.float32)
+    response[5, 5] = 69.3
+    response[10, 30] = np.inf
+    response[20, 20] = np.nan
+    response[30, 5] = -0.5
+    response[30, 30] = 1.0 + 1e-4
+    response[35, 15] = 0.9
+    peaks = find_response_peaks(response, 20, 3)
+    assert peaks
+    assert all(0.0 <= score <= 1.0 for score, _loc in peaks)
+    assert peaks[0] == (1.0, (30, 30))
+    assert (0.9, (15, 35)) in [(round(s, 6), loc) for s, loc in peaks]
+
+
+def _job(edge, mask):
+    h, w = edge.shape
+    scaled = ScaledTemplate(scale=1.0, edge=edge, mask=mask, bounds=(0, 0, w, h), fg_count=1)
+    return _MatchJob(class_name="ring", tpl=None, variant=None, scaled=scaled, group=0, key=())
+
+
+def test_masked_peaks_are_in_unit_range_and_skip_empty_windows():
+    roi, tpl, mask = _ring_scene()
+    peaks = _response_peaks(roi, tpl, mask, 20)
+    assert peaks
+    for score, loc in peaks:
+        assert 0.0 <= score <= 1.0
+        assert _window_energy(roi, mask, loc) > 0
+
+    job = _job(tpl, mask)
+    (fft_peaks,) = _locate_fft(roi, [job], peaks_per_map=20)
+    assert fft_peaks
+    for score, loc in fft_peaks:
+        assert 0.0 <= score <= 1.0
+        assert _window_energy(roi, mask, loc) > 0
+
+
+def test_fft_masked_responses_match_spatial():
+    roi, tpl, mask = _ring_scene()
+    # a resized (non-binary) template and a non-binary ROI take the unpacked path
+    big = cv2.resize(tpl, (41, 37), interpolation=cv2.INTER_AREA)
+    big_mask = cv2.resize(mask, (41, 37), interpolation=cv2.INTER_NEAREST)
+    jobs = [_job(tpl, mask), _job(big, big_mask)]
+    for image in (roi, roi // 2 + (roi > 0) * (np.arange(160) % 3)[None, :].astype(np.uint8)):
+        fft = _FFTCorrelator(image)
+        for i, res, valid in _masked_responses(fft, image, jobs, True):
+            edge, m = jobs[i].scaled.edge, jobs[i].scaled.mask
+            expected = _response_with_optional_mask(image, edge, m)
+            assert np.array_equal(valid, _masked_energy_valid(image, edge, m))
+            assert np.allclose(res[valid], expected[valid], atol=1e-4)
+            assert not res[~valid].any()